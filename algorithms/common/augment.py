@@ -0,0 +1,59 @@
+"""
+Batched image augmentations on uint8 NHWC tensors, on whatever device they live on
+
+Same distribution as `pad_and_random_crop` + `random_cutout_color` + identity
+selection in the policy utils, but done in a single gather instead of
+building window views and looping over images on the host.
+"""
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+
+
+class BatchAugmenter:
+    """
+    Each image gets augmentation `randint(num_choices)`:
+    0 - zero pad by `pad` and random crop back to the original size
+    1 - cutout a box of random color (box offset and size both drawn from [min_cut, max_cut))
+    >= 2 - unchanged
+    """
+    def __init__(self, device, num_choices=3, pad=10, min_cut=10, max_cut=30, seed=None):
+        self.device = device
+        self.num_choices = num_choices
+        self.pad = pad
+        self.min_cut = min_cut
+        self.max_cut = max_cut
+        self.generator = torch.Generator(device=device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def _randint(self, low, high, size):
+        return torch.randint(low, high, size, generator=self.generator, device=self.device)
+
+    def __call__(self, imgs):
+        n, h, w, c = imgs.shape
+        aug_idx = self._randint(0, self.num_choices, (n,))
+        crop = aug_idx == 0
+        cutout = aug_idx == 1
+
+        # Crop offsets in padded coordinates are in [0, 2 * pad), same as the numpy version
+        row_off = torch.where(crop, self._randint(0, 2 * self.pad, (n,)) - self.pad, torch.zeros_like(aug_idx))
+        col_off = torch.where(crop, self._randint(0, 2 * self.pad, (n,)) - self.pad, torch.zeros_like(aug_idx))
+        rows = torch.arange(h, device=self.device)[None] + row_off[:, None]
+        cols = torch.arange(w, device=self.device)[None] + col_off[:, None]
+        valid = ((rows >= 0) & (rows < h))[:, :, None] & ((cols >= 0) & (cols < w))[:, None, :]
+        batch = torch.arange(n, device=self.device)[:, None, None]
+        out = imgs[batch, rows.clamp(0, h - 1)[:, :, None], cols.clamp(0, w - 1)[:, None, :]]
+        out = out * valid[..., None].to(out.dtype)
+
+        cut_w = self._randint(self.min_cut, self.max_cut, (n,))
+        cut_h = self._randint(self.min_cut, self.max_cut, (n,))
+        color = self._randint(0, 255, (n, c)).to(imgs.dtype)
+        r = torch.arange(h, device=self.device)[None]
+        col = torch.arange(w, device=self.device)[None]
+        in_rows = (r >= cut_h[:, None]) & (r < 2 * cut_h[:, None])
+        in_cols = (col >= cut_w[:, None]) & (col < 2 * cut_w[:, None])
+        box = (in_rows[:, :, None] & in_cols[:, None, :]) & cutout[:, None, None]
+        return torch.where(box[..., None], color[:, None, None, :], out)
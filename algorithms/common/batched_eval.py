@@ -0,0 +1,72 @@
+"""
+Batched no-grad re-evaluation of large observation buffers (e.g. the aux replay)
+"""
+import numpy as np
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+from torch.cuda.amp import autocast
+
+
+class ChunkedEvaluator:
+    """
+    Streams a host observation buffer through `model.vf_pi` in chunks of `chunk_size`
+
+    On cpu the chunks are zero-copy views of the buffer. On cuda they are staged through two pinned host buffers and copied
+    with non_blocking=True, so filling the next chunk overlaps with the forward
+    pass of the current one. Results stay on the device until the whole buffer
+    is done, so there is a single device to host copy at the end.
+    Host memory used is bounded by 2 * chunk_size observations.
+    """
+    def __init__(self, model, device, chunk_size, mixed_precision=False):
+        self.model = model
+        self.device = device
+        self.chunk_size = chunk_size
+        self.use_cuda = device.type == "cuda"
+        self.mixed_precision = mixed_precision and self.use_cuda
+        self._staging = None
+
+    def _get_staging(self, ob_shape, dtype):
+        if self._staging is None or self._staging[0].shape[1:] != ob_shape:
+            self._staging = [torch.empty((self.chunk_size, *ob_shape), dtype=dtype, pin_memory=self.use_cuda)
+                             for _ in range(2)]
+            self._copy_done = [None, None]
+        return self._staging
+
+    def _upload(self, staging, slot, chunk):
+        if self._copy_done[slot] is not None:
+            # Don't overwrite a pinned buffer that is still being copied from
+            self._copy_done[slot].synchronize()
+        buf = staging[slot][:len(chunk)]
+        buf.numpy()[...] = chunk
+        obs_dev = buf.to(self.device, non_blocking=True)
+        self._copy_done[slot] = torch.cuda.Event()
+        self._copy_done[slot].record()
+        return obs_dev
+
+    def evaluate(self, obs, start=0, end=None):
+        """
+        obs: numpy array (N, *ob_shape), any leading layout flattened by the caller
+        start, end: only evaluate obs[start:end], e.g. a learner's share of the replay
+        returns: numpy vf (end - start,) and pi logits (end - start, num_outputs)
+        """
+        end = obs.shape[0] if end is None else end
+        nobs = end - start
+        out_vf = torch.empty((nobs,), dtype=torch.float32, device=self.device)
+        out_pi = torch.empty((nobs, self.model.num_outputs), dtype=torch.float32, device=self.device)
+        if self.use_cuda:
+            staging = self._get_staging(obs.shape[1:], torch.from_numpy(obs[:1]).dtype)
+
+        with torch.no_grad():
+            for k, lo in enumerate(range(0, nobs, self.chunk_size)):
+                hi = min(lo + self.chunk_size, nobs)
+                if self.use_cuda:
+                    obs_dev = self._upload(staging, k % 2, obs[start + lo:start + hi])
+                else:
+                    obs_dev = torch.from_numpy(np.ascontiguousarray(obs[start + lo:start + hi]))
+                with autocast(enabled=self.mixed_precision):
+                    vf, pi = self.model.vf_pi(obs_dev, ret_numpy=False, no_grad=True, to_torch=False)
+                out_vf[lo:hi] = vf
+                out_pi[lo:hi] = pi
+
+        return out_vf.cpu().numpy(), out_pi.cpu().numpy()
@@ -0,0 +1,169 @@
+"""
+Split checkpoint layout, checkpoint_format: "split" in the trainer config
+
+A checkpoint-<iteration> saved by Trainer._save is one pickle of the whole
+trainer state: the policy weights, the best weights, the reward normalizer,
+the optimizer states and the AMP scaler all go through pickle. The split
+layout writes instead, next to each other:
+- checkpoint-<i>          small pickle of the rest (filters, counters,
+                          trainer state), written last
+- checkpoint-<i>.weights  the policy weights in the safetensors format, read
+                          through a memory map
+- checkpoint-<i>.training training only state (optimizers, AMP scaler,
+                          custom state vars), skipped when restoring for
+                          evaluation
+
+The files are written by a background thread from a copy of the state, so
+training goes on while they are written. checkpoint-<i> only appears once
+the other two are complete.
+
+load_checkpoint returns the state dict of Trainer.__getstate__ for the
+pickle layout. For the split layout the pickled "worker" blob is replaced by
+the "filters" and the memory mapped "weights" as they are, which
+restore_worker puts on a rollout worker without another pickle round trip.
+"""
+import copy
+import json
+import os
+import pickle
+import struct
+import threading
+
+import numpy as np
+from ray.rllib.policy.sample_batch import DEFAULT_POLICY_ID
+
+CHECKPOINT_FORMATS = ("pickle", "split")
+SPLIT_FORMAT = "split"
+WEIGHTS_SUFFIX = ".weights"
+TRAINING_SUFFIX = ".training"
+# Trainer state that is only needed to resume training
+TRAINING_KEYS = ("custom_state_vars", "optimizer_state", "aux_optimizer_state",
+                 "value_optimizer_state", "amp_scaler_state")
+
+# https://github.com/huggingface/safetensors#format
+_DTYPE_CODES = {
+    np.dtype(np.float64): "F64", np.dtype(np.float32): "F32", np.dtype(np.float16): "F16",
+    np.dtype(np.int64): "I64", np.dtype(np.int32): "I32", np.dtype(np.int16): "I16",
+    np.dtype(np.int8): "I8", np.dtype(np.uint8): "U8", np.dtype(np.bool_): "BOOL",
+}
+_CODE_DTYPES = {code: dtype for dtype, code in _DTYPE_CODES.items()}
+_ALIGNMENT = 64
+
+
+def save_tensors(path, arrays):
+    """ Writes a dict of numpy arrays in the safetensors format """
+    header, offset = {}, 0
+    for name, arr in arrays.items():
+        arr = np.asarray(arr)
+        nbytes = arr.nbytes
+        header[name] = {"dtype": _DTYPE_CODES[arr.dtype], "shape": list(arr.shape),
+                        "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header = json.dumps(header).encode()
+    # Pad the header so the data starts aligned, for zero-copy views
+    header += b" " * (-(8 + len(header)) % _ALIGNMENT)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for arr in arrays.values():
+            f.write(np.ascontiguousarray(arr).tobytes())
+
+
+def load_tensors(path):
+    """ Dict of read-only numpy arrays backed by a memory map of the file """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    if not header:
+        return {}
+    data = np.memmap(path, dtype=np.uint8, mode="r", offset=8 + header_size)
+    arrays = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        arrays[name] = data[start:end].view(_CODE_DTYPES[info["dtype"]]).reshape(info["shape"])
+    return arrays
+
+
+def _atomic_write(path, write_fn):
+    write_fn(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def _pickle_to(obj):
+    def write(path):
+        with open(path, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return write
+
+
+class CheckpointWriter:
+    """ Writes split checkpoints, in the background unless sync is set """
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def save(self, checkpoint_path, manifest, weights, training_state, sync=False):
+        """ Takes copies, the caller may keep modifying the arrays and objects passed in """
+        self.wait()
+        weights = {k: np.array(v, copy=True) for k, v in weights.items()}
+        training_state = copy.deepcopy(training_state)
+        manifest = dict(copy.deepcopy(manifest), format=SPLIT_FORMAT)
+        if sync:
+            self._write(checkpoint_path, manifest, weights, training_state)
+            return
+        self._thread = threading.Thread(target=self._run, args=(checkpoint_path, manifest, weights, training_state),
+                                        name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self, *args):
+        try:
+            self._write(*args)
+        except Exception as e:
+            self._error = e
+
+    def _write(self, checkpoint_path, manifest, weights, training_state):
+        _atomic_write(checkpoint_path + WEIGHTS_SUFFIX, lambda path: save_tensors(path, weights))
+        _atomic_write(checkpoint_path + TRAINING_SUFFIX, _pickle_to(training_state))
+        _atomic_write(checkpoint_path, _pickle_to(manifest))
+
+    def wait(self):
+        """ Blocks until the checkpoint being written is complete """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def load_checkpoint(checkpoint_path, training_state=True):
+    """ The trainer state saved at checkpoint_path in either layout, without TRAINING_KEYS unless training_state """
+    with open(checkpoint_path, "rb") as f:
+        state = pickle.load(f)
+    if state.get("format") != SPLIT_FORMAT:
+        if not training_state:
+            state = {k: v for k, v in state.items() if k not in TRAINING_KEYS}
+        return state
+
+    state["weights"] = load_tensors(checkpoint_path + WEIGHTS_SUFFIX)
+    if training_state:
+        with open(checkpoint_path + TRAINING_SUFFIX, "rb") as f:
+            state.update(pickle.load(f))
+    return state
+
+
+def worker_state(state):
+    """ The part of a load_checkpoint state that restore_worker needs, e.g. to ray.put once for many workers """
+    if "worker" in state:
+        return {"worker": state["worker"]}
+    return {"filters": state["filters"], "weights": state["weights"]}
+
+
+def restore_worker(worker, state):
+    """ Restores the filters and policy weights of a rollout worker from a load_checkpoint state, either layout """
+    if "worker" in state:
+        worker.restore(state["worker"])
+        return
+    worker.sync_filters(state["filters"])
+    worker.policy_map[DEFAULT_POLICY_ID].set_state({"current_weights": state["weights"]})
@@ -0,0 +1,184 @@
+"""
+Data-parallel learner processes for a policy, num_learners in the config
+
+The policy on the driver is rank 0. It spawns num_learners - 1 replica
+processes, each building the same policy (on its own gpu if there are
+several, on cpu otherwise) and joining a torch.distributed process group,
+gloo by default so it also runs on multi-core cpu machines.
+
+Rank 0 keeps doing everything that is not a gradient step (reward
+normalization, GAE, replay updates, checkpoints). For a training phase it
+writes the batch to shared arrays and runs the phase's method on every
+learner with the same arguments (the minibatch order, learning rates): each
+learner trains on its share of every minibatch, and gradients are averaged
+with one all-reduce before each optimizer step, so the learners stay in sync
+and the result is the same as one learner on the whole minibatch.
+
+Arrays shared between the learners (the batch, the aux replay) are file
+backed memory maps created by rank 0 and opened by path on the replicas, so
+each exists once. The files are unlinked once every learner has mapped
+them; put them on a tmpfs (e.g. /dev/shm) with replay_storage_dir to keep
+them off the disk.
+"""
+import os
+import socket
+import tempfile
+
+import numpy as np
+from ray import cloudpickle
+from ray.rllib.models import ModelCatalog
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+class SharedArrays:
+    """
+    Named numpy arrays in file backed memory maps. The owner creates them,
+    an instance made from its `specs` on another process maps the same files.
+    """
+    def __init__(self, directory=None, specs=None):
+        self.directory = directory
+        self.owner = specs is None
+        self.specs = {} if specs is None else specs
+
+    def allocate(self, name, shape, dtype):
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if not self.owner:
+            path, spec_shape, spec_dtype = self.specs[name]
+            assert (spec_shape, spec_dtype) == (shape, dtype.str), "Shared array {} differs from rank 0".format(name)
+            return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+        assert name not in self.specs, "Shared array {} allocated twice".format(name)
+        fd, path = tempfile.mkstemp(prefix=name + "_", suffix=".mmap", dir=self.directory)
+        os.close(fd)
+        self.specs[name] = (path, shape, dtype.str)
+        return np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+
+    def unlink(self):
+        """ The mappings stay valid, the files are gone once every process exits """
+        for path, _, _ in self.specs.values():
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class LearnerGroup:
+    """ The collectives between the learners, the same on every rank """
+    def __init__(self, rank, world_size):
+        self.rank = rank
+        self.world_size = world_size
+
+    def shard_range(self, n):
+        """ This learner's contiguous share of range(n) """
+        return n * self.rank // self.world_size, n * (self.rank + 1) // self.world_size
+
+    def shard_minibatches(self, inds, batch_size):
+        """ This learner's share of each consecutive minibatch of inds, minibatches of batch_size // world_size """
+        part = batch_size // self.world_size
+        return inds.reshape(-1, batch_size)[:, self.rank * part:(self.rank + 1) * part].reshape(-1)
+
+    def allreduce_gradients(self, params):
+        """ Averages the gradients of params over the learners, in one all-reduce """
+        grads = [p.grad for p in params if p.grad is not None]
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        dist.all_reduce(flat)
+        flat /= self.world_size
+        for g, reduced in zip(grads, flat.split([g.numel() for g in grads])):
+            g.copy_(reduced.view_as(g))
+
+    def broadcast_parameters(self, params):
+        """ Rank 0's values of params on every learner """
+        params = list(params)
+        flat = torch.cat([p.data.reshape(-1) for p in params])
+        dist.broadcast(flat, 0)
+        for p, value in zip(params, flat.split([p.numel() for p in params])):
+            p.data.copy_(value.view_as(p))
+
+    def barrier(self):
+        dist.barrier()
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _visible_gpus():
+    if not torch.cuda.is_available():
+        return None
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible:
+        return visible.split(",")
+    return [str(i) for i in range(torch.cuda.device_count())]
+
+
+def _replica_main(rank, world_size, init_method, backend, gpu, num_threads, payload, shared_specs, commands):
+    if gpu is not None:
+        # Before anything initializes cuda, the policy then uses "cuda"
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+    else:
+        torch.set_num_threads(num_threads)
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    policy_cls, observation_space, action_space, config, model_cls = cloudpickle.loads(payload)
+    if config["model"].get("custom_model"):
+        # Registered on the driver from a sourced file, see utils/loader.py
+        ModelCatalog.register_custom_model(config["model"]["custom_model"], model_cls)
+    policy = policy_cls(observation_space, action_space, config)
+    policy.init_training(learners=LearnerGroup(rank, world_size),
+                         shared_arrays=SharedArrays(config["replay_storage_dir"], shared_specs))
+    dist.barrier()
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        method, args = command
+        getattr(policy, method)(*args)
+    dist.destroy_process_group()
+
+
+class DataParallelLearners(LearnerGroup):
+    """ Rank 0, spawns the replicas of `policy` and sends them the methods to run """
+    def __init__(self, policy, world_size, backend, shared_arrays):
+        super().__init__(0, world_size)
+        init_method = "tcp://127.0.0.1:{}".format(_free_port())
+        gpus = _visible_gpus()
+        num_threads = max(1, torch.get_num_threads() // world_size)
+        if gpus is None:
+            torch.set_num_threads(num_threads)
+        # Replicas build the same policy, without profiling nobody would collect.
+        # Pickled by value, the model class is in a module the replicas can't import
+        config = dict(policy.config, profile_phases=False)
+        payload = cloudpickle.dumps((type(policy), policy.observation_space, policy.action_space,
+                                     config, type(policy.model)))
+        ctx = mp.get_context("spawn")
+        self.commands, self.processes = [], []
+        for rank in range(1, world_size):
+            commands = ctx.SimpleQueue()
+            gpu = gpus[rank % len(gpus)] if gpus else None
+            process = ctx.Process(target=_replica_main, name="learner-{}".format(rank), daemon=True,
+                                  args=(rank, world_size, init_method, backend, gpu, num_threads,
+                                        payload, shared_arrays.specs, commands))
+            process.start()
+            self.commands.append(commands)
+            self.processes.append(process)
+        dist.init_process_group(backend, init_method=init_method, rank=0, world_size=world_size)
+
+    def send(self, method, *args):
+        """ Runs policy.method(*args) on every replica, the caller runs it on rank 0 """
+        for process in self.processes:
+            if not process.is_alive():
+                raise RuntimeError("Learner process {} exited with code {}".format(process.name, process.exitcode))
+        for commands in self.commands:
+            commands.put((method, args))
+
+    def close(self):
+        for commands in self.commands:
+            commands.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        dist.destroy_process_group()
+        self.processes = []
@@ -0,0 +1,42 @@
+"""
+Columnar episode statistics
+
+Completed episodes are written as two extra columns of the rollout batch on
+the worker (return and length, length is 0 on steps where no episode ended),
+so the learner can read them with a mask instead of scanning every info dict.
+"""
+import numpy as np
+
+EPISODE_RETURN = "episode_return"
+EPISODE_LENGTH = "episode_length"
+
+
+def add_episode_columns(sample_batch):
+    """ Worker side, call from postprocess_trajectory """
+    count = sample_batch.count
+    ep_returns = np.zeros(count, dtype=np.float32)
+    ep_lengths = np.zeros(count, dtype=np.int32)
+    infos = sample_batch['infos']
+    # 'episode' is only ever set on the step an episode ends
+    for i in np.flatnonzero(sample_batch['dones']):
+        epinfo = infos[i].get('episode')
+        if epinfo is not None:
+            ep_returns[i] = epinfo['r']
+            ep_lengths[i] = epinfo['l']
+    sample_batch[EPISODE_RETURN] = ep_returns
+    sample_batch[EPISODE_LENGTH] = ep_lengths
+    return sample_batch
+
+
+def completed_episodes(samples):
+    """
+    Learner side, returns arrays of returns and lengths of the episodes that
+    ended in this batch, in batch order
+    Falls back to scanning the infos for batches without the columns
+    """
+    if EPISODE_LENGTH in samples.keys():
+        ended = samples[EPISODE_LENGTH] > 0
+        return samples[EPISODE_RETURN][ended], samples[EPISODE_LENGTH][ended]
+    epinfos = [info['episode'] for info in samples['infos'] if 'episode' in info]
+    return (np.array([epinfo['r'] for epinfo in epinfos], dtype=np.float32),
+            np.array([epinfo['l'] for epinfo in epinfos], dtype=np.int32))
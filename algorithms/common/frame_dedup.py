@@ -0,0 +1,89 @@
+"""
+Deduplicated frame stack observations for rollout batches
+
+Consecutive frame-stacked observations share all but their newest frame, and
+new_obs[t] is obs[t+1] within an episode, so a batch stores every frame up to
+2*K times. The worker side encoding keeps only the newest frame of each obs,
+plus the older frames on the rows where the stack does not continue from the
+previous row (batch start, episode starts) and the full new_obs on the rows
+where it is not the next obs. Continuity is checked on the data itself, so
+decoding is exact whatever wrappers or episode boundaries produced the batch.
+
+Every encoded column has one entry per row, so encoded batches can still be
+concatenated with SampleBatch.concat_samples before decoding.
+"""
+import numpy as np
+
+FRAMES = "obs_frames"
+HEAD_FRAMES = "obs_head_frames"
+NEXT_OBS = "new_obs_stacks"
+
+
+def _continues(prev, nxt, frame_channels):
+    """ Rows t >= 1 where the older frames of nxt[t] are the newer frames of prev[t-1] """
+    same = prev[:-1, ..., frame_channels:] == nxt[1:, ..., :-frame_channels]
+    return same.reshape(len(same), -1).all(axis=1)
+
+
+def encode_frame_stacks(samples, frame_channels=3):
+    """ Worker side, call from on_sample_end. Encodes the batch in place """
+    if FRAMES in samples.data:
+        return samples
+    obs, new_obs = samples["obs"], samples["new_obs"]
+    count, num_stack = len(obs), obs.shape[-1] // frame_channels
+    if count == 0 or num_stack < 2:
+        return samples
+
+    has_head = np.ones(count, dtype=bool)
+    has_head[1:] = ~_continues(obs, obs, frame_channels)
+    heads = np.empty(count, dtype=object)
+    for i in np.flatnonzero(has_head):
+        heads[i] = obs[i, ..., :-frame_channels].copy()
+
+    is_next = np.zeros(count, dtype=bool)
+    is_next[:-1] = (new_obs[:-1] == obs[1:]).reshape(count - 1, -1).all(axis=1)
+    next_obs = np.empty(count, dtype=object)
+    for i in np.flatnonzero(~is_next):
+        next_obs[i] = new_obs[i].copy()
+
+    samples.data[FRAMES] = np.ascontiguousarray(obs[..., -frame_channels:])
+    samples.data[HEAD_FRAMES] = heads
+    samples.data[NEXT_OBS] = next_obs
+    del samples.data["obs"], samples.data["new_obs"]
+    return samples
+
+
+def decode_frame_stacks(samples):
+    """ Learner side, rebuilds obs and new_obs in place, no-op on plain batches """
+    if FRAMES not in samples.data:
+        return samples
+    frames, heads, next_obs = samples[FRAMES], samples[HEAD_FRAMES], samples[NEXT_OBS]
+    count, fc = len(frames), frames.shape[-1]
+    head_rows = np.array([h is not None for h in heads])
+    head_frames = np.stack(heads[head_rows])
+    num_stack = head_frames.shape[-1] // fc + 1
+    head_frames = head_frames.reshape(*head_frames.shape[:-1], num_stack - 1, fc)
+
+    rows = np.arange(count)
+    # Last row at or before each row that carries its own older frames
+    last_head = np.maximum.accumulate(np.where(head_rows, rows, 0))
+    head_id = np.cumsum(head_rows) - 1
+
+    obs = np.empty((*frames.shape[:-1], num_stack * fc), dtype=frames.dtype)
+    for k in range(num_stack - 1):
+        src = rows - (num_stack - 1 - k)
+        from_frames = src >= last_head
+        obs[from_frames, ..., k*fc:(k+1)*fc] = frames[src[from_frames]]
+        from_head = ~from_frames
+        j = k + rows[from_head] - last_head[from_head]
+        obs[from_head, ..., k*fc:(k+1)*fc] = head_frames[head_id[from_head], :, :, j]
+    obs[..., -fc:] = frames
+
+    new_obs = np.empty_like(obs)
+    new_obs[:-1] = obs[1:]
+    for i in np.flatnonzero([n is not None for n in next_obs]):
+        new_obs[i] = next_obs[i]
+
+    samples.data["obs"], samples.data["new_obs"] = obs, new_obs
+    del samples.data[FRAMES], samples.data[HEAD_FRAMES], samples.data[NEXT_OBS]
+    return samples
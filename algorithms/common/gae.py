@@ -0,0 +1,127 @@
+"""
+Shared advantage / return engine for the custom policies.
+
+All functions take time-major arrays, i.e. (nsteps, nenvs) for a rollout
+and (nsegs, nsteps, nenvs) for a replay buffer, same as `unroll` produces.
+The scan over time is the only sequential part, everything else is done
+with whole-array ops. Two backends are available:
+
+- "numpy": reverse scan on the host (numba compiled if numba is installed)
+- "torch": TorchScript reverse scan on the given device
+"""
+import numpy as np
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _reverse_scan_numpy(deltas, discounts):
+    advs = np.empty_like(deltas)
+    advs[-1] = deltas[-1]
+    for t in range(len(deltas) - 2, -1, -1):
+        np.multiply(discounts[t], advs[t+1], out=advs[t])
+        advs[t] += deltas[t]
+    return advs
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _reverse_scan_numba(deltas, discounts):
+        nsteps, n = deltas.shape
+        advs = np.empty_like(deltas)
+        for i in range(n):
+            lastgaelam = 0.
+            for t in range(nsteps - 1, -1, -1):
+                lastgaelam = deltas[t, i] + discounts[t, i] * lastgaelam
+                advs[t, i] = lastgaelam
+        return advs
+
+def reverse_scan_numpy(deltas, discounts):
+    """ advs[t] = deltas[t] + discounts[t] * advs[t+1], scanned over axis 0 """
+    if numba is None:
+        return _reverse_scan_numpy(deltas, discounts)
+    s = deltas.shape
+    flat = lambda arr: np.ascontiguousarray(arr.reshape(s[0], -1))
+    return _reverse_scan_numba(flat(deltas), flat(discounts)).reshape(s)
+
+
+@torch.jit.script
+def reverse_scan_torch(deltas, discounts):
+    """ advs[t] = deltas[t] + discounts[t] * advs[t+1], scanned over dim 0 """
+    nsteps = deltas.shape[0]
+    advs = torch.empty_like(deltas)
+    lastgaelam = torch.zeros_like(deltas[0])
+    for i in range(nsteps):
+        t = nsteps - 1 - i
+        lastgaelam = deltas[t] + discounts[t] * lastgaelam
+        advs[t] = lastgaelam
+    return advs
+
+
+def _gae_numpy(mb_values, mb_dones, mb_rewards, last_values, gamma, lam, use_float64):
+    out_dtype = mb_values.dtype
+    dtype = np.float64 if use_float64 else out_dtype
+    values = mb_values.astype(dtype, copy=False)
+    next_values = np.concatenate([values[1:], np.asarray(last_values, dtype=dtype)[None]])
+    nextnonterminal = 1.0 - mb_dones.astype(dtype)
+    deltas = mb_rewards.astype(dtype, copy=False) + gamma * next_values * nextnonterminal - values
+    mb_advs = reverse_scan_numpy(deltas, (gamma * lam) * nextnonterminal)
+    mb_returns = mb_advs + values
+    return mb_returns.astype(out_dtype, copy=False), mb_advs.astype(out_dtype, copy=False)
+
+
+def _gae_torch(mb_values, mb_dones, mb_rewards, last_values, gamma, lam, use_float64, device):
+    ret_numpy = isinstance(mb_values, np.ndarray)
+    dtype = torch.float64 if use_float64 else torch.float32
+    as_tensor = lambda arr: torch.as_tensor(arr, device=device).to(dtype)
+    values, dones, rewards = as_tensor(mb_values), as_tensor(mb_dones), as_tensor(mb_rewards)
+    next_values = torch.cat([values[1:], as_tensor(last_values)[None]])
+    nextnonterminal = 1.0 - dones
+    deltas = rewards + gamma * next_values * nextnonterminal - values
+    mb_advs = reverse_scan_torch(deltas, (gamma * lam) * nextnonterminal)
+    mb_returns = mb_advs + values
+    if ret_numpy:
+        out_dtype = mb_values.dtype
+        return mb_returns.cpu().numpy().astype(out_dtype), mb_advs.cpu().numpy().astype(out_dtype)
+    return mb_returns.float(), mb_advs.float()
+
+
+def calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam,
+                  backend="numpy", device=None, use_float64=False):
+    """
+    GAE(lambda) returns and advantages for one rollout
+    args:
+    mb_values, mb_dones, mb_rewards: shape (nsteps, nenvs)
+    last_values: bootstrap values for the step after the rollout, shape (nenvs,)
+    backend: "numpy" or "torch", torch runs on `device` and returns tensors
+             unless numpy arrays were passed in
+    use_float64: accumulate in float64, outputs keep the dtype of the values
+    """
+    if backend == "torch":
+        return _gae_torch(mb_values, mb_dones, mb_rewards, last_values, gamma, lam, use_float64, device)
+    elif backend == "numpy":
+        return _gae_numpy(mb_values, mb_dones, mb_rewards, last_values, gamma, lam, use_float64)
+    raise ValueError("Unknown gae backend {}".format(backend))
+
+
+def calculate_gae_buffer(values_buffer, dones_buffer, rewards_buffer, last_values, gamma, lam,
+                         backend="numpy", device=None, use_float64=False):
+    """
+    GAE returns for a replay buffer of consecutive rollouts, shape (nsegs, nsteps, nenvs)
+    Each segment bootstraps from the first value of the next one, and the last
+    segment from `last_values`, so all segments are scanned in one pass
+    """
+    if torch.is_tensor(values_buffer):
+        bootstrap = torch.cat([values_buffer[1:, 0], torch.as_tensor(last_values, device=values_buffer.device)[None]])
+    else:
+        bootstrap = np.concatenate([values_buffer[1:, 0], np.asarray(last_values)[None]])
+    swap = lambda arr: arr.transpose(0, 1) if torch.is_tensor(arr) else arr.swapaxes(0, 1)
+    new_returns, _ = calculate_gae(swap(values_buffer), swap(dones_buffer), swap(rewards_buffer),
+                                   bootstrap, gamma, lam, backend, device, use_float64)
+    if torch.is_tensor(new_returns):
+        return swap(new_returns).contiguous()
+    return np.ascontiguousarray(swap(new_returns))
@@ -0,0 +1,30 @@
+"""
+Losses that train different parameter groups, combined into one backward pass
+
+A head trained by its own loss on the detached latent (the PPO value head),
+while the trunk still gets the gradient of the value loss through the head,
+used to need a backward of the main loss, the head's gradients cloned and
+zeroed, a second backward of the head loss and the clones added back.
+
+route_head runs a linear head twice on the latent, once with its weights
+detached (the gradient only reaches the trunk) and once on the detached
+latent (the gradient only reaches the head). Losses on the two outputs can
+be summed, and a single backward gives every parameter group the gradient
+it got from its own loss.
+
+See benchmarks/fused_backward_check.py for the gradient comparison.
+"""
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+
+
+def route_head(head, latent):
+    """
+    Returns (trunk_out, head_out), both head(latent) for an nn.Linear head:
+    trunk_out's gradient only reaches latent, head_out's only the head's parameters
+    """
+    bias = head.bias.detach() if head.bias is not None else None
+    trunk_out = nn.functional.linear(latent, head.weight.detach(), bias)
+    head_out = head(latent.detach())
+    return trunk_out, head_out
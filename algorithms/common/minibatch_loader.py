@@ -0,0 +1,112 @@
+"""
+Minibatch loader for learn_on_batch
+
+Replaces `to_tensor(arr[mbinds])` for every array of every minibatch, which
+does a numpy fancy-index copy, then a pageable host to device copy.
+"""
+import numpy as np
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+
+
+class MinibatchLoader:
+    """
+    Modes (only matter on cuda, on cpu the host path below is always used):
+    "device": the whole batch is uploaded once per set_batch, minibatches
+              are gathered with index_select on the device
+    "pinned": minibatches are gathered on the host straight into two pinned
+              buffers and copied on a side stream, the next minibatch is
+              prefetched while the current one is trained on
+    On cpu, minibatches are gathered with index_select into reused buffers,
+    so there is no new allocation per minibatch.
+    """
+    def __init__(self, device, mode="pinned"):
+        assert mode in ("device", "pinned"), "Unknown minibatch loader mode {}".format(mode)
+        self.device = device
+        self.use_cuda = device.type == "cuda"
+        self.mode = mode if self.use_cuda else "host"
+        self.copy_stream = torch.cuda.Stream() if self.use_cuda and self.mode == "pinned" else None
+        self._sources = []
+        self._buffers = None
+
+    def set_batch(self, *arrays):
+        """
+        Set the numpy arrays that minibatches are taken from, all indexed on axis 0
+        An array can be None if it is only filled in later with update_array
+        """
+        self._sources = [None] * len(arrays)
+        for i, arr in enumerate(arrays):
+            if arr is not None:
+                self.update_array(i, arr)
+
+    def update_array(self, i, arr):
+        """ Replace one of the arrays of the current batch, e.g. after renormalizing """
+        src = torch.from_numpy(np.ascontiguousarray(arr))
+        if self.mode == "device":
+            src = src.to(self.device)
+        self._sources[i] = src
+
+    def release(self):
+        self._sources = []
+
+    def _get_buffers(self, batch_size):
+        nslots = 2 if self.mode == "pinned" else 1
+        shapes = [(s.dtype, s.shape[1:]) for s in self._sources]
+        if self._buffers is None or self._buffers[0] != (batch_size, shapes):
+            slots = [[torch.empty((batch_size, *shape), dtype=dtype, pin_memory=self.use_cuda)
+                      for dtype, shape in shapes] for _ in range(nslots)]
+            self._buffers = ((batch_size, shapes), slots, [None] * nslots)
+        return self._buffers[1], self._buffers[2]
+
+    def _gather_host(self, slot, idx, batch_size):
+        slots, copy_done = self._get_buffers(batch_size)
+        if copy_done[slot] is not None:
+            # Pinned buffer may still be read by an earlier async copy
+            copy_done[slot].synchronize()
+        return [torch.index_select(src, 0, idx, out=buf[:len(idx)])
+                for src, buf in zip(self._sources, slots[slot])]
+
+    def _fetch(self, slot, inds, batch_size):
+        host = self._gather_host(slot, torch.from_numpy(inds), batch_size)
+        with torch.cuda.stream(self.copy_stream):
+            dev = [t.to(self.device, non_blocking=True) for t in host]
+            event = torch.cuda.Event()
+            event.record(self.copy_stream)
+        self._buffers[2][slot] = event
+        return dev, event
+
+    def _ready(self, fetched):
+        dev, event = fetched
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            for t in dev:
+                t.record_stream(stream)
+        return dev
+
+    def minibatches(self, inds, batch_size):
+        """
+        Yields lists of tensors on the policy device, one per array in set_batch,
+        for consecutive slices of `inds` of size `batch_size`
+        Tensors of a minibatch are only valid until the next one is requested
+        """
+        if self.mode == "device":
+            inds_dev = torch.from_numpy(inds).to(self.device)
+            for start in range(0, len(inds), batch_size):
+                idx = inds_dev[start:start + batch_size]
+                yield [src.index_select(0, idx) for src in self._sources]
+            return
+
+        chunks = [inds[start:start + batch_size] for start in range(0, len(inds), batch_size)]
+        if self.mode == "host":
+            for chunk in chunks:
+                yield self._gather_host(0, torch.from_numpy(chunk), batch_size)
+            return
+
+        pending = self._fetch(0, chunks[0], batch_size)
+        for k in range(len(chunks)):
+            current = pending
+            if k + 1 < len(chunks):
+                pending = self._fetch((k + 1) % 2, chunks[k + 1], batch_size)
+            yield self._ready(current)
@@ -0,0 +1,74 @@
+"""
+Mixed precision for the policy phase, pi_phase_mixed_precision in the config
+
+    False   fp32
+    "fp16"  fp16 autocast, the loss is scaled with the policy's GradScaler (True is "fp16")
+    "bf16"  bf16 autocast, bf16 has the exponent range of fp32 so nothing is scaled,
+            needs torch.autocast (torch >= 1.10)
+
+The pi and value losses go through a single backward, and gradients are
+unscaled before clipping so grad_clip is a norm of the true gradients. On
+cpu, where autocast only supports bf16, "fp16" falls back to fp32.
+"""
+from contextlib import contextmanager
+
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+
+AMP_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def amp_dtype(setting):
+    """ The autocast dtype of a config setting, None for fp32 """
+    if setting is True:
+        setting = "fp16"
+    if not setting:
+        return None
+    assert setting in AMP_DTYPES, "Unknown mixed precision {}, use False, \"fp16\" or \"bf16\"".format(setting)
+    assert setting != "bf16" or hasattr(torch, "autocast"), \
+        "bf16 mixed precision needs torch.autocast (torch >= 1.10), use False or \"fp16\""
+    return AMP_DTYPES[setting]
+
+
+@contextmanager
+def _fp32():
+    yield
+
+
+class MixedPrecision:
+    def __init__(self, device, setting, scaler):
+        self.device = device
+        self.dtype = amp_dtype(setting)
+        self.enabled = self.dtype is not None and (device.type == "cuda" or self.dtype == torch.bfloat16)
+        self.scaler = scaler if self.enabled and self.dtype == torch.float16 else None
+
+    def autocast(self):
+        if not self.enabled:
+            return _fp32()
+        if self.dtype == torch.float16:
+            return torch.cuda.amp.autocast(enabled=True)
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizers, max_grad_norm=None):
+        """ Clips the gradients of all the optimizers' parameters together to max_grad_norm, then steps them """
+        if self.scaler is not None:
+            for optimizer in optimizers:
+                self.scaler.unscale_(optimizer)
+        if max_grad_norm is not None:
+            params = [p for optimizer in optimizers for group in optimizer.param_groups for p in group['params']]
+            nn.utils.clip_grad_norm_(params, max_grad_norm)
+        for optimizer in optimizers:
+            if self.scaler is not None:
+                # Skipped if the unscaled gradients have infs or nans
+                self.scaler.step(optimizer)
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
+        if self.scaler is not None:
+            self.scaler.update()
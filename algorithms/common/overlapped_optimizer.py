@@ -0,0 +1,136 @@
+"""
+Policy optimizer that overlaps sampling on the rollout workers with learning
+on the driver.
+
+Each step takes the batch that is already being sampled, asks the workers for
+the next one, and only then runs learn_on_batch, so the workers sample the
+next batch with the weights from before this update. The workers get fresh
+weights whenever the next batch would otherwise be learned on more than
+`staleness_bound` updates after its weights (0 is the same schedule as
+SyncSamplesOptimizer). The policies need nothing new, their ratios already
+use the sampled action_logp; the staleness of every batch is reported.
+
+Reported in the result info: sampler utilization (time the workers spend in
+sample() over wall time) and learner utilization (time in learn_on_batch
+over wall time).
+"""
+import logging
+import math
+import time
+
+import ray
+from ray.rllib.evaluation.metrics import get_learner_stats
+from ray.rllib.optimizers.policy_optimizer import PolicyOptimizer
+from ray.rllib.policy.sample_batch import SampleBatch
+from ray.rllib.utils.timer import TimerStat
+
+from .weight_sync import broadcast_weights
+
+logger = logging.getLogger(__name__)
+
+
+def _timed_sample(worker):
+    start = time.perf_counter()
+    batch = worker.sample()
+    return batch, time.perf_counter() - start
+
+
+class OverlappedSamplesOptimizer(PolicyOptimizer):
+    def __init__(self, workers, train_batch_size=1, samples_per_call=1, staleness_bound=1):
+        PolicyOptimizer.__init__(self, workers)
+        assert staleness_bound >= 0, "staleness_bound must be non-negative"
+        self.train_batch_size = train_batch_size
+        self.staleness_bound = staleness_bound
+        num_workers = max(1, len(workers.remote_workers()))
+        self.calls_per_worker = max(1, math.ceil(train_batch_size / (num_workers * samples_per_call)))
+        self.update_weights_timer = TimerStat()
+        self.sample_wait_timer = TimerStat()
+        self.learn_timer = TimerStat()
+        self.learner_stats = {}
+
+        # Number of updates done by the learner, and the one the workers' weights are from
+        self.weights_version = 0
+        self.workers_version = -1
+        self.sent_weight_versions = {}
+        self.pending = []  # (futures, weights version they are sampled with)
+        self.last_staleness = 0
+        self.max_staleness = 0
+        self.sample_busy_time = 0.
+        self.learn_busy_time = 0.
+        self.start_time = None
+
+    def _sync_weights(self):
+        with self.update_weights_timer:
+            broadcast_weights(self.workers, self.sent_weight_versions)
+        self.workers_version = self.weights_version
+
+    def _launch_samples(self):
+        """ Queue the next batch on the workers, behind whatever they are running """
+        futures = [e.apply.remote(_timed_sample)
+                   for e in self.workers.remote_workers() for _ in range(self.calls_per_worker)]
+        self.pending.append((futures, self.workers_version))
+
+    def _collect(self, futures):
+        with self.sample_wait_timer:
+            results = ray.get(futures)
+        # Workers sample in parallel, so their busy time is the average over workers
+        self.sample_busy_time += sum(t for _, t in results) / len(self.workers.remote_workers())
+        return SampleBatch.concat_samples([batch for batch, _ in results])
+
+    def _sample_local(self):
+        samples = []
+        while sum(s.count for s in samples) < self.train_batch_size:
+            batch, sample_time = _timed_sample(self.workers.local_worker())
+            self.sample_busy_time += sample_time
+            samples.append(batch)
+        return SampleBatch.concat_samples(samples)
+
+    def step(self):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+
+        if not self.workers.remote_workers():
+            # Nothing to overlap with, same as SyncSamplesOptimizer
+            samples, batch_version = self._sample_local(), self.weights_version
+        else:
+            if not self.pending:
+                self._sync_weights()
+                self._launch_samples()
+            futures, batch_version = self.pending.pop(0)
+            samples = self._collect(futures)
+            if self.staleness_bound > 0:
+                # The next batch is learned on after this update, at weights_version + 1
+                if self.weights_version + 1 - self.workers_version > self.staleness_bound:
+                    self._sync_weights()
+                self._launch_samples()
+
+        self.last_staleness = self.weights_version - batch_version
+        self.max_staleness = max(self.max_staleness, self.last_staleness)
+        self.num_steps_sampled += samples.count
+
+        start = time.perf_counter()
+        with self.learn_timer:
+            fetches = self.workers.local_worker().learn_on_batch(samples)
+        self.learn_busy_time += time.perf_counter() - start
+        self.weights_version += 1
+        self.learner_stats = get_learner_stats(fetches)
+        self.num_steps_trained += samples.count
+        return self.learner_stats
+
+    def stats(self):
+        wall_time = time.perf_counter() - self.start_time if self.start_time else 0.
+        wall_time = max(wall_time, 1e-8)
+        return dict(
+            PolicyOptimizer.stats(self), **{
+                "update_weights_time_ms": round(1000 * self.update_weights_timer.mean, 3),
+                "sample_wait_time_ms": round(1000 * self.sample_wait_timer.mean, 3),
+                "learn_time_ms": round(1000 * self.learn_timer.mean, 3),
+                "sample_staleness": self.last_staleness,
+                "max_sample_staleness": self.max_staleness,
+                "sampler_utilization": min(1., self.sample_busy_time / wall_time),
+                "learner_utilization": min(1., self.learn_busy_time / wall_time),
+                "learner": self.learner_stats,
+            })
+
+    def stop(self):
+        self.pending = []
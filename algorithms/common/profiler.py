@@ -0,0 +1,128 @@
+"""
+Per-phase timing of the learner's hot path
+
+    with self.profiler.phase("gae"):
+        ...
+    for slices in self.profiler.iterate("minibatch_load", loader.minibatches(...)):
+        ...
+
+On cuda a phase is timed with a pair of CUDA events, so the time is the
+GPU time of the work queued in the phase and nothing is synchronized until
+collect(). On cpu it is wall clock time. Phases can be nested, each one is
+reported on its own.
+
+collect() is called once per training iteration (CustomCallbacks.on_train_result)
+and returns, for every phase since the last call, the total time in ms and
+the number of calls, plus the counters (e.g. learner samples) per second of
+the "learn_on_batch" phase. With trace_path set, every phase is also written
+as a complete event of a Chrome trace (chrome://tracing, Perfetto), appended
+as it is collected so a run that dies still leaves a readable trace.
+
+Disabled, phase() and iterate() cost one attribute check.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class PhaseProfiler:
+    def __init__(self, device, enabled=False, trace_path=None):
+        self.enabled = enabled
+        self.use_cuda_events = enabled and device.type == "cuda"
+        self.trace_path = trace_path if enabled else None
+        self._pending = []  # (name, wall start, wall end, cuda start, cuda end)
+        self._counters = defaultdict(float)
+        self._trace_file = None
+        self._pid = os.getpid()
+        self._tid = threading.get_ident()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        cuda_start = cuda_end = None
+        if self.use_cuda_events:
+            cuda_start = torch.cuda.Event(enable_timing=True)
+            cuda_end = torch.cuda.Event(enable_timing=True)
+            cuda_start.record()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.use_cuda_events:
+                cuda_end.record()
+            self._pending.append((name, start, time.perf_counter(), cuda_start, cuda_end))
+
+    def iterate(self, name, iterable):
+        """ Yields from iterable, timing the work of producing each item as the phase `name` """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self._phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n):
+        """ Adds to a counter reported per second of learn_on_batch, e.g. learner samples """
+        if self.enabled:
+            self._counters[name] += n
+
+    def collect(self):
+        """ Metrics since the last call, {} when disabled """
+        if not self.enabled:
+            return {}
+        if self.use_cuda_events and self._pending:
+            torch.cuda.synchronize()
+        phase_ms, phase_calls = defaultdict(float), defaultdict(int)
+        events = []
+        for name, start, end, cuda_start, cuda_end in self._pending:
+            duration_ms = cuda_start.elapsed_time(cuda_end) if cuda_start is not None else 1000 * (end - start)
+            phase_ms[name] += duration_ms
+            phase_calls[name] += 1
+            events.append({"name": name, "ph": "X", "pid": self._pid, "tid": self._tid,
+                           "ts": 1e6 * start, "dur": 1000 * duration_ms})
+        self._pending = []
+        if self.trace_path:
+            self._write_trace(events)
+
+        metrics = {"phase_ms": dict(phase_ms), "phase_calls": dict(phase_calls)}
+        learn_s = phase_ms.get("learn_on_batch", 0.) / 1000
+        if learn_s > 0:
+            metrics["per_learn_second"] = {name: n / learn_s for name, n in self._counters.items()}
+        self._counters = defaultdict(float)
+        return metrics
+
+    def _write_trace(self, events):
+        if self._trace_file is None:
+            # The JSON array format, the closing ] is optional
+            self._trace_file = open(self.trace_path, "w")
+            self._trace_file.write("[\n")
+        for event in events:
+            self._trace_file.write(json.dumps(event) + ",\n")
+        self._trace_file.flush()
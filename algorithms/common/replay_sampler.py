@@ -0,0 +1,144 @@
+"""
+Streaming minibatch sampler for the aux phase replay, aux_sampler: "streaming"
+
+Replaces RetuneSelector.make_minibatches, which builds a list of
+itertools.product tuples, or gathers `flatten012(arr)[mbinds]` at random
+over the whole replay, for every minibatch.
+
+The shuffled order of an epoch is built at once with numpy, with the same
+sampling units as make_minibatches: whole (segment, env) trajectories, or
+single observations with flattened_buffer (or blocks of aux_sampler_block_size
+consecutive observations, the same step of neighbouring envs, which are
+contiguous in the replay). Rows of a minibatch are gathered in ascending
+replay order, so reads stream through memory (and memmap pages) instead of
+jumping around; the order of rows in a minibatch doesn't matter to the loss.
+
+The next minibatch is gathered by a background thread while the current one
+is trained on, into one of two reused (pinned on cuda) buffers. With
+aux_device_cache_segments, the first segments of the replay are uploaded once
+per aux phase and their rows are gathered on the device in every epoch.
+The returns and pi targets are uploaded once per aux phase.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from ray.rllib.utils import try_import_torch
+
+torch, nn = try_import_torch()
+
+
+class ReplaySampler:
+    def __init__(self, device, replay_shape, flat_buffer=False, block_size=1, device_cache_segments=0):
+        self.device = device
+        self.use_cuda = device.type == "cuda"
+        self.replay_shape = replay_shape
+        self.flat_buffer = flat_buffer
+        self.block_size = block_size
+        # Nothing to save by caching on cpu, the replay already is there
+        self.device_cache_segments = min(device_cache_segments, replay_shape[0]) if self.use_cuda else 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="replay_sampler")
+        self._buffers = None
+        self._copy_done = [None, None]
+        self._flat_obs = self._targets = self._cache = None
+
+    def set_replay(self, replay, returns_buffer, presleep_pi):
+        """ Start of an aux phase, replay (n_pi, nsteps, nenvs, *ob_shape) and its targets """
+        ob_shape = replay.shape[3:]
+        flat = replay.reshape(-1, *ob_shape)
+        # Plain arrays (and memmaps) are gathered with index_select, which runs without the GIL
+        self._flat_obs = torch.from_numpy(flat) if isinstance(flat, np.ndarray) else flat
+        self._targets = [torch.from_numpy(np.ascontiguousarray(arr.reshape(len(flat), *arr.shape[3:]))).to(self.device)
+                         for arr in (returns_buffer, presleep_pi)]
+        self._cached_rows = 0
+        if self.device_cache_segments > 0:
+            seg_rows = int(np.prod(self.replay_shape[1:]))
+            self._cache = torch.empty((self.device_cache_segments * seg_rows, *ob_shape), dtype=torch.uint8,
+                                      device=self.device)
+            for seg in range(self.device_cache_segments):
+                obs = torch.from_numpy(np.ascontiguousarray(replay[seg])).reshape(seg_rows, *ob_shape)
+                self._cache[seg * seg_rows:(seg + 1) * seg_rows] = obs.to(self.device)
+            self._cached_rows = len(self._cache)
+
+    def release(self):
+        """ End of an aux phase """
+        self._flat_obs = self._targets = self._cache = None
+
+    def epoch_rows(self, num_rollouts, rng, shard=None):
+        """
+        Sorted flat replay rows of each minibatch of an epoch, minibatches of num_rollouts
+        trajectories (or as many observations), shard=(rank, num_learners) keeps that learner's share
+        """
+        n_pi, nsteps, nenvs = self.replay_shape
+        if not self.flat_buffer:
+            units, unit_rows = rng.permutation(n_pi * nenvs), nsteps
+            per_minibatch = num_rollouts
+        else:
+            nrows = n_pi * nsteps * nenvs
+            nblocks = -(-nrows // self.block_size)
+            units, unit_rows = rng.permutation(nblocks), self.block_size
+            per_minibatch = max(1, num_rollouts * nsteps // self.block_size)
+        for start in range(0, len(units), per_minibatch):
+            chunk = units[start:start + per_minibatch]
+            if not self.flat_buffer:
+                seg, env = chunk // nenvs, chunk % nenvs
+                rows = ((seg[:, None] * nsteps + np.arange(nsteps)[None]) * nenvs + env[:, None]).reshape(-1)
+            else:
+                rows = (chunk[:, None] * unit_rows + np.arange(unit_rows)[None]).reshape(-1)
+                rows = rows[rows < nrows]
+            if shard is not None:
+                rank, num_learners = shard
+                rows = rows[len(rows) * rank // num_learners:len(rows) * (rank + 1) // num_learners]
+            yield np.sort(rows)
+
+    def _ensure_buffers(self, nrows):
+        """ On the calling thread, before any gather of the epoch """
+        ob_shape = tuple(self._flat_obs.shape[1:])
+        if self._buffers is None or self._buffers[0].shape[0] < nrows or tuple(self._buffers[0].shape[1:]) != ob_shape:
+            self._buffers = [torch.empty((nrows, *ob_shape), dtype=torch.uint8, pin_memory=self.use_cuda)
+                             for _ in range(2)]
+            self._copy_done = [None, None]
+
+    def _gather_host(self, slot, rows):
+        """ Runs on the prefetch thread """
+        if self._copy_done[slot] is not None:
+            # The buffer may still be read by the copy of an earlier minibatch
+            self._copy_done[slot].synchronize()
+        buf = self._buffers[slot][:len(rows)]
+        if torch.is_tensor(self._flat_obs):
+            torch.index_select(self._flat_obs, 0, torch.from_numpy(rows), out=buf)
+        else:
+            buf.numpy()[...] = self._flat_obs[rows]
+        return buf
+
+    def _submit(self, k, rows):
+        host_rows = rows[np.searchsorted(rows, self._cached_rows):]
+        return self._executor.submit(self._gather_host, k % 2, host_rows)
+
+    def _assemble(self, k, rows, pending):
+        split = np.searchsorted(rows, self._cached_rows)
+        host = pending.result()
+        if self.use_cuda:
+            obs = host.to(self.device, non_blocking=True)
+            self._copy_done[k % 2] = torch.cuda.Event()
+            self._copy_done[k % 2].record()
+        else:
+            obs = host
+        rows_dev = torch.from_numpy(rows).to(self.device)
+        if split > 0:
+            obs = torch.cat([self._cache.index_select(0, rows_dev[:split]), obs])
+        return [obs] + [target.index_select(0, rows_dev) for target in self._targets]
+
+    def minibatches(self, num_rollouts, rng, shard=None):
+        """
+        Yields [obs, target_vf, target_pi] tensors on the device for each minibatch of an epoch
+        Tensors of a minibatch are only valid until the next one is requested
+        """
+        epoch = list(self.epoch_rows(num_rollouts, rng, shard))
+        self._ensure_buffers(max(len(rows) for rows in epoch))
+        pending = self._submit(0, epoch[0])
+        for k, rows in enumerate(epoch):
+            current = pending
+            minibatch = self._assemble(k, rows, current)
+            if k + 1 < len(epoch):
+                pending = self._submit(k + 1, epoch[k + 1])
+            yield minibatch
@@ -0,0 +1,149 @@
+"""
+Storage backends for the aux phase observation replay of RetuneSelector
+
+Every backend is indexed like the (n_pi, nsteps, nenvs, *ob_shape) numpy
+array it replaces, for the access patterns RetuneSelector and aux_train use:
+    replay[seg] = obs_batch
+    replay[seg_inds, :, env_inds]
+    replay.reshape(-1, *ob_shape)[flat_inds or slice]
+
+- "memory": plain numpy array in RAM (previous behaviour)
+- "memmap": numpy.memmap in a file under `directory`, paged by the OS
+- "newest_frame": keeps only the newest frame of each frame-stacked obs and
+  rebuilds the stacks on read, "newest_frame_memmap" is the same on a memmap
+"""
+import os
+import tempfile
+
+import numpy as np
+
+STORAGE_TYPES = ("memory", "memmap", "newest_frame", "newest_frame_memmap")
+
+
+def _memmap(shape, dtype, directory=None):
+    fd, path = tempfile.mkstemp(prefix="replay_", suffix=".mmap", dir=directory)
+    os.close(fd)
+    arr = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+    # The mapping stays valid after unlinking, and the file can't leak on crashes
+    os.unlink(path)
+    return arr
+
+
+def make_replay_storage(storage, replay_shape, ob_space, dones_replay, directory=None, frame_channels=3,
+                        allocate=None):
+    """
+    allocate(name, shape, dtype), if given, places the arrays instead of
+    memory or memmap, e.g. SharedArrays.allocate of common/data_parallel.py
+    """
+    assert storage in STORAGE_TYPES, "Unknown replay storage {}".format(storage)
+    shape = (*replay_shape, *ob_space.shape)
+    if allocate is not None:
+        if storage in ("memory", "memmap"):
+            return allocate("exp_replay", shape, np.uint8)
+        return NewestFrameReplay(replay_shape, ob_space.shape, dones_replay,
+                                 lambda name, shape: allocate(name, shape, np.uint8), frame_channels)
+    if storage == "memory":
+        return np.empty(shape, dtype=np.uint8)
+    elif storage == "memmap":
+        return _memmap(shape, np.uint8, directory)
+    allocate = (lambda name, shape: _memmap(shape, np.uint8, directory)) if storage == "newest_frame_memmap" \
+               else (lambda name, shape: np.empty(shape, dtype=np.uint8))
+    return NewestFrameReplay(replay_shape, ob_space.shape, dones_replay, allocate, frame_channels)
+
+
+class NewestFrameReplay:
+    """
+    Stores the newest `frame_channels` channels of each observation plus, per segment
+    and env, the older frames of the first observation of the segment.
+
+    On read, frame k of the stack at step t is the newest frame of step t - (K-1-k),
+    clamped to the first step of the episode if the env was reset in between
+    (the frame stack wrappers refill the stack with the first frame on reset),
+    and taken from the stored older frames if it falls before the segment.
+    `dones_replay` must hold the dones of the stored segments by the time they are read.
+    """
+    def __init__(self, replay_shape, ob_shape, dones_replay, allocate, frame_channels=3):
+        h, w, c = ob_shape
+        assert c % frame_channels == 0, "Observation channels must be a stack of frames"
+        self.shape = (*replay_shape, *ob_shape)
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = len(self.shape)
+        self.replay_shape = replay_shape
+        self.frame_channels = frame_channels
+        self.num_stack = c // frame_channels
+        n_pi, nsteps, nenvs = replay_shape
+        self.frames = allocate("replay_frames", (*replay_shape, h, w, frame_channels))
+        self.head = allocate("replay_head", (n_pi, nenvs, self.num_stack - 1, h, w, frame_channels))
+        self.dones_replay = dones_replay
+        self._last_reset_cache = None
+
+    def __setitem__(self, seg, obs_batch):
+        assert isinstance(seg, (int, np.integer)), "Only whole segments can be written"
+        fc = self.frame_channels
+        # Dones of the segment are written after this, so only drop the cache here
+        self._last_reset_cache = None
+        self.frames[seg] = obs_batch[..., -fc:]
+        for k in range(self.num_stack - 1):
+            self.head[seg, :, k] = obs_batch[0, ..., k*fc:(k+1)*fc]
+
+    def refresh(self):
+        """ The dones may have been written by another process """
+        self._last_reset_cache = None
+
+    def _last_reset(self):
+        """ Index of the last reset at or before each step, -1 if none in the segment """
+        if self._last_reset_cache is None:
+            dones = self.dones_replay[:, :-1]
+            steps = np.arange(1, self.replay_shape[1])[None, :, None]
+            reset_at = np.where(dones, steps, -1)
+            first = np.full((self.replay_shape[0], 1, self.replay_shape[2]), -1)
+            reset_at = np.concatenate([first, reset_at], axis=1)
+            self._last_reset_cache = np.maximum.accumulate(reset_at, axis=1)
+        return self._last_reset_cache
+
+    def gather(self, seg, step, env):
+        """ Stacked observations for broadcastable integer index arrays """
+        seg, step, env = np.broadcast_arrays(np.asarray(seg), np.asarray(step), np.asarray(env))
+        last_reset = self._last_reset()[seg, step, env]
+        fc, K = self.frame_channels, self.num_stack
+        out = np.empty((*seg.shape, *self.shape[3:]), dtype=self.dtype)
+        for k in range(K):
+            j = step - (K - 1 - k)
+            j = np.where(last_reset >= 0, np.maximum(j, last_reset), j)
+            dst = out[..., k*fc:(k+1)*fc]
+            dst[...] = self.frames[seg, np.maximum(j, 0), env]
+            from_head = j < 0
+            if from_head.any():
+                dst[from_head] = self.head[seg[from_head], env[from_head], K - 1 + j[from_head]]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            _, nsteps, nenvs = self.replay_shape
+            return self.gather(key, np.arange(nsteps)[:, None], np.arange(nenvs)[None])
+        seg, steps, env = key
+        assert steps == slice(None), "Only replay[seg_inds, :, env_inds] is supported"
+        nsteps = self.replay_shape[1]
+        seg, env = np.asarray(seg)[:, None], np.asarray(env)[:, None]
+        return self.gather(seg, np.arange(nsteps)[None], env)
+
+    def reshape(self, *shape):
+        assert shape[0] == -1 and tuple(shape[1:]) == self.shape[3:], "Only flattening the replay dims is supported"
+        return _FlatReplayView(self)
+
+
+class _FlatReplayView:
+    """ replay.reshape(-1, *ob_shape), indexed with flat indices or slices """
+    def __init__(self, replay):
+        self.replay = replay
+        self.shape = (int(np.prod(replay.replay_shape)), *replay.shape[3:])
+        self.dtype = replay.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, inds):
+        if isinstance(inds, slice):
+            inds = np.arange(*inds.indices(self.shape[0]))
+        seg, step, env = np.unravel_index(np.asarray(inds), self.replay.replay_shape)
+        return self.replay.gather(seg, step, env)
@@ -0,0 +1,163 @@
+"""
+Reward normalization by a running estimate of the discounted return std
+
+RewardNormalizer.normalize works on one step of rewards at a time, as before.
+RewardNormalizer.normalize_block takes a whole time-major (nsteps, nenvs)
+block and gives the same rewards and statistics as calling normalize once
+per step: the discounted returns come from one forward scan, and the running
+moments after every step from prefix sums of the per-step moments. Backends
+are "numpy" and "torch" (on the given device), like the GAE engine.
+
+https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+"""
+import numpy as np
+from ray.rllib.utils import try_import_torch
+
+from .gae import reverse_scan_numpy, reverse_scan_torch
+
+torch, nn = try_import_torch()
+
+
+class RewardNormalizer(object):
+    def __init__(self, gamma=0.99, cliprew=10.0, epsilon=1e-8):
+        self.epsilon = epsilon
+        self.gamma = gamma
+        self.ret_rms = RunningMeanStd(shape=())
+        self.cliprew = cliprew
+        self.ret = 0. # size updates after first pass
+
+    def normalize(self, rews, news, reset_returns=True):
+        self.ret = self.ret * self.gamma + rews
+        self.ret_rms.update(self.ret)
+        rews = np.clip(rews / np.sqrt(self.ret_rms.var + self.epsilon), -self.cliprew, self.cliprew)
+        if reset_returns:
+            self.ret[np.array(news, dtype=bool)] = 0. ## Values should be True of False to set positional index
+        return rews
+
+    def normalize_block(self, rews, news, reset_returns=True, backend="numpy", device=None, with_returns=False):
+        """
+        Same as normalize(rews[t], news[t], reset_returns) for t in range(nsteps),
+        news[t] are the dones that reset the return after step t.
+        with_returns also returns the discounted returns the statistics were updated with
+        """
+        if backend == "numpy":
+            rews, returns = self._normalize_block_numpy(rews, news, reset_returns)
+        elif backend == "torch":
+            rews, returns = self._normalize_block_torch(rews, news, reset_returns, device)
+        else:
+            raise ValueError("Unknown reward normalization backend {}".format(backend))
+        return (rews, returns) if with_returns else rews
+
+    def merge(self, other):
+        """ Combine the return statistics of another normalizer, e.g. from a rollout worker """
+        self.ret_rms.merge(other.ret_rms)
+        return self
+
+    def _normalize_block_numpy(self, rews, news, reset_returns):
+        keep = 1. - np.asarray(news, dtype=rews.dtype) if reset_returns else np.ones_like(rews)
+        ret0 = np.broadcast_to(np.asarray(self.ret, dtype=rews.dtype), rews.shape[1:])
+        # Forward scan ret[t] = gamma * keep[t-1] * ret[t-1] + rews[t] as a reverse scan
+        inputs = rews.copy()
+        inputs[0] += self.gamma * ret0
+        discounts = np.zeros_like(rews)
+        discounts[1:] = self.gamma * keep[:-1]
+        returns = reverse_scan_numpy(inputs[::-1], discounts[::-1])[::-1]
+
+        means, variances, counts = prefix_moments(returns.mean(axis=1, dtype=np.float64),
+                                                  returns.var(axis=1, dtype=np.float64), returns.shape[1],
+                                                  self.ret_rms.mean, self.ret_rms.var, self.ret_rms.count)
+        self.ret_rms.mean, self.ret_rms.var, self.ret_rms.count = means[-1], variances[-1], counts[-1]
+        self.ret = returns[-1] * keep[-1]
+        scale = np.sqrt(variances + self.epsilon).reshape(-1, *([1] * (rews.ndim - 1)))
+        return np.clip(rews / scale, -self.cliprew, self.cliprew).astype(rews.dtype, copy=False), returns
+
+    def _normalize_block_torch(self, rews, news, reset_returns, device):
+        ret_numpy = isinstance(rews, np.ndarray)
+        out_dtype = rews.dtype
+        rews_t = torch.as_tensor(rews, device=device).float()
+        keep = 1. - torch.as_tensor(news, device=device).float() if reset_returns else torch.ones_like(rews_t)
+        ret0 = torch.as_tensor(np.asarray(self.ret, dtype=np.float32), device=device)
+        inputs = rews_t.clone()
+        inputs[0] += self.gamma * ret0
+        discounts = torch.zeros_like(rews_t)
+        discounts[1:] = self.gamma * keep[:-1]
+        returns = reverse_scan_torch(inputs.flip(0), discounts.flip(0)).flip(0)
+
+        returns64 = returns.double()
+        batch_means = returns64.mean(dim=1)
+        batch_vars = (returns64 - batch_means[:, None]).pow(2).mean(dim=1)
+        means, variances, counts = prefix_moments(batch_means, batch_vars, returns.shape[1],
+                                                  self.ret_rms.mean, self.ret_rms.var, self.ret_rms.count)
+        self.ret_rms.mean = np.float64(means[-1].item())
+        self.ret_rms.var = np.float64(variances[-1].item())
+        self.ret_rms.count = float(counts[-1].item())
+        self.ret = (returns[-1] * keep[-1]).cpu().numpy()
+        scale = (variances + self.epsilon).sqrt().float().reshape(-1, *([1] * (rews_t.dim() - 1)))
+        normalized = (rews_t / scale).clamp(-self.cliprew, self.cliprew)
+        if ret_numpy:
+            return normalized.cpu().numpy().astype(out_dtype, copy=False), returns.cpu().numpy()
+        return normalized.to(out_dtype), returns
+
+
+class RunningMeanStd(object):
+    def __init__(self, epsilon=1e-4, shape=()):
+        self.mean = np.zeros(shape, 'float64')
+        self.var = np.ones(shape, 'float64')
+        self.count = epsilon
+
+    def update(self, x):
+        batch_mean = np.mean(x, axis=0)
+        batch_var = np.var(x, axis=0)
+        batch_count = x.shape[0]
+        self.update_from_moments(batch_mean, batch_var, batch_count)
+
+    def update_from_moments(self, batch_mean, batch_var, batch_count):
+        self.mean, self.var, self.count = update_mean_var_count_from_moments(
+            self.mean, self.var, self.count, batch_mean, batch_var, batch_count)
+
+    def merge(self, other):
+        """ Combine the moments of another RunningMeanStd, e.g. from another worker """
+        self.update_from_moments(other.mean, other.var, other.count)
+        return self
+
+    @classmethod
+    def combine(cls, rms_list):
+        combined = cls(epsilon=0., shape=np.shape(rms_list[0].mean))
+        combined.mean, combined.var, combined.count = rms_list[0].mean, rms_list[0].var, rms_list[0].count
+        for rms in rms_list[1:]:
+            combined.merge(rms)
+        return combined
+
+
+def update_mean_var_count_from_moments(mean, var, count, batch_mean, batch_var, batch_count):
+    delta = batch_mean - mean
+    tot_count = count + batch_count
+
+    new_mean = mean + delta * batch_count / tot_count
+    m_a = var * count
+    m_b = batch_var * batch_count
+    M2 = m_a + m_b + np.square(delta) * count * batch_count / tot_count
+    new_var = M2 / tot_count
+    new_count = tot_count
+
+    return new_mean, new_var, new_count
+
+
+def prefix_moments(batch_means, batch_vars, batch_count, mean, var, count):
+    """
+    Mean, var and count after merging each of the (nsteps,) equally sized batch
+    moments in turn into (mean, var, count), works on numpy arrays or tensors
+    """
+    lib = torch if torch is not None and isinstance(batch_means, torch.Tensor) else np
+    nsteps = batch_means.shape[0]
+    steps = lib.arange(1, nsteps + 1)
+    if lib is torch:
+        steps = steps.to(batch_means)
+        mean, var = float(mean), float(var)
+    counts = count + batch_count * steps
+    means = (count * mean + batch_count * lib.cumsum(batch_means, 0)) / counts
+    # Within-batch squares plus the spread of every merged mean around each prefix mean
+    within = count * var + batch_count * lib.cumsum(batch_vars, 0)
+    between = batch_count * lib.tril((batch_means[None, :] - means[:, None]) ** 2).sum(1)
+    between = between + count * (mean - means) ** 2
+    return means, (within + between) / counts, counts
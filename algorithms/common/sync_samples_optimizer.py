@@ -0,0 +1,48 @@
+"""
+SyncSamplesOptimizer that broadcasts the weights with broadcast_weights
+(common/weight_sync.py), so the workers aren't sent the weights again on the
+steps where they didn't change, e.g. when the best weights are kept and
+training is skipped. Sampling and learning are the same as in RLlib's.
+"""
+from ray.rllib.optimizers import SyncSamplesOptimizer
+from ray.rllib.policy.sample_batch import SampleBatch, DEFAULT_POLICY_ID
+from ray.rllib.utils.annotations import override
+from ray.rllib.utils.memory import ray_get_and_free
+from ray.rllib.utils.sgd import do_minibatch_sgd
+
+from .weight_sync import broadcast_weights
+
+
+class SkipUnchangedSyncSamplesOptimizer(SyncSamplesOptimizer):
+    def __init__(self, workers, **kwargs):
+        SyncSamplesOptimizer.__init__(self, workers, **kwargs)
+        self.sent_weight_versions = {}
+
+    @override(SyncSamplesOptimizer)
+    def step(self):
+        with self.update_weights_timer:
+            if self.workers.remote_workers():
+                broadcast_weights(self.workers, self.sent_weight_versions)
+
+        with self.sample_timer:
+            samples = []
+            while sum(s.count for s in samples) < self.train_batch_size:
+                if self.workers.remote_workers():
+                    samples.extend(ray_get_and_free([e.sample.remote() for e in self.workers.remote_workers()]))
+                else:
+                    samples.append(self.workers.local_worker().sample())
+            samples = SampleBatch.concat_samples(samples)
+            self.sample_timer.push_units_processed(samples.count)
+
+        with self.grad_timer:
+            fetches = do_minibatch_sgd(samples, self.policies, self.workers.local_worker(), self.num_sgd_iter,
+                                       self.sgd_minibatch_size, self.standardize_fields)
+        self.grad_timer.push_units_processed(samples.count)
+
+        if len(fetches) == 1 and DEFAULT_POLICY_ID in fetches:
+            self.learner_stats = fetches[DEFAULT_POLICY_ID]
+        else:
+            self.learner_stats = fetches
+        self.num_steps_sampled += samples.count
+        self.num_steps_trained += samples.count
+        return self.learner_stats
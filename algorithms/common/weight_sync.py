@@ -0,0 +1,89 @@
+"""
+Weight sync channel from the learner to the rollout workers
+
+Policy.get_weights is what the policy optimizers broadcast to the workers
+every step (put in the object store once and shared by all workers). The
+channel makes that payload as small as possible:
+- only the parameters the workers need for acting (aux_vf is dropped)
+- optionally in float16 or bfloat16, restored to float32 on the worker
+
+get_weights always returns the whole payload, whoever asks for it. Skipping
+the broadcast when nothing changed since the last one, e.g. on the steps
+where the best weights are kept and training is skipped, is up to the
+optimizer doing the broadcast (broadcast_weights), which knows which version
+its workers have.
+
+Checkpoints don't go through the channel, they use the full state dict.
+"""
+import numpy as np
+import ray
+
+WEIGHT_DTYPES = ("float32", "float16", "bfloat16")
+
+
+def to_bfloat16(arr):
+    """ float32 array to bfloat16 bits in a uint16 array, rounding to nearest even """
+    bits = np.ascontiguousarray(arr, dtype=np.float32).view(np.uint32)
+    rounding = np.uint32(0x7FFF) + ((bits >> np.uint32(16)) & np.uint32(1))
+    return ((bits + rounding) >> np.uint32(16)).astype(np.uint16)
+
+
+def from_bfloat16(bits):
+    return (bits.astype(np.uint32) << np.uint32(16)).view(np.float32)
+
+
+class WeightSyncChannel:
+    def __init__(self, dtype="float32", exclude_prefixes=("aux_vf.",)):
+        assert dtype in WEIGHT_DTYPES, "Unknown weight sync dtype {}".format(dtype)
+        self.dtype = dtype
+        self.exclude_prefixes = tuple(exclude_prefixes)
+        self.version = 0
+
+    def mark_changed(self):
+        self.version += 1
+
+    def _encode(self, arr):
+        if arr.dtype != np.float32 or self.dtype == "float32":
+            return arr
+        elif self.dtype == "float16":
+            return arr.astype(np.float16)
+        return to_bfloat16(arr)
+
+    def _decode(self, arr):
+        if self.dtype == "float16" and arr.dtype == np.float16:
+            return arr.astype(np.float32)
+        elif self.dtype == "bfloat16" and arr.dtype == np.uint16:
+            return from_bfloat16(arr)
+        return arr
+
+    def payload(self, state_dict):
+        """ Learner side, what get_weights returns """
+        weights = {k: self._encode(v.cpu().detach().numpy()) for k, v in state_dict.items()
+                   if not k.startswith(self.exclude_prefixes)}
+        return {"version": self.version, "dtype": self.dtype, "acting_weights": weights}
+
+    def unpack(self, payload):
+        """ Worker side, the state dict subset to load """
+        self.version = payload["version"]
+        return {k: self._decode(v) for k, v in payload["acting_weights"].items()}
+
+
+def broadcast_weights(workers, sent_versions):
+    """
+    Optimizer side, sends the local worker's weights to the remote workers in one object.
+    Policies with a weight_sync channel are left out when their version is the one
+    in sent_versions (policy id to version, updated), nothing is sent if all are
+    """
+    weights = {}
+    for policy_id, policy in workers.local_worker().policy_map.items():
+        channel = getattr(policy, "weight_sync", None)
+        if channel is not None:
+            if sent_versions.get(policy_id) == channel.version:
+                continue
+            sent_versions[policy_id] = channel.version
+        weights[policy_id] = policy.get_weights()
+    if not weights:
+        return
+    weights = ray.put(weights)
+    for e in workers.remote_workers():
+        e.set_weights.remote(weights)
@@ -0,0 +1,104 @@
+"""
+Worker side postprocessing of rollout fragments
+
+With worker_side_postprocessing on, every rollout worker finishes its own
+trajectories in postprocess_trajectory: reward normalization, the bootstrap
+value of the last new_obs and GAE. The learner then only reads the columns
+below instead of running the serial preprocessing for the whole batch.
+
+Reward normalization follows the learner's convention: the discounted
+return of an env slot runs on across episodes, and with reset_returns it is
+reset one step late, after the step following a done (the learner passes the
+dones shifted by one step as `news`). The return and the last done are kept
+in episode.user_data across the fragments of an episode, and handed from an
+episode that ends to the next one of the same env slot by start_episode,
+called from the on_episode_start hook of callbacks.CustomCallbacks. RLlib
+postprocesses an ending episode and starts the next one of its env slot
+before it moves on to another env slot, so the last episode that ended on
+the worker is the one to carry on from.
+
+Rewards are normalized with the learner's return statistics. The learner
+merges the shipped discounted returns into its statistics and pushes them,
+with the current gamma, back to the workers after every optimizer step
+(sync_worker_postprocessing).
+"""
+import copy
+
+import numpy as np
+
+from .gae import calculate_gae
+from .reward_norm import RewardNormalizer
+
+NORMALIZED_REWARDS = "normalized_rewards"
+DISCOUNTED_RETURNS = "discounted_returns"
+BOOTSTRAP_VALUE = "bootstrap_value"
+VALUE_TARGETS = "value_targets"
+
+# (discounted return, last done) of the env slot, in episode.user_data
+_RETURN_CARRY = "return_carry"
+
+
+class WorkerPostprocessor:
+    def __init__(self, gamma, lam, standardize_rewards, reset_returns, scale_reward, cliprew):
+        self.gamma = gamma
+        self.lam = lam
+        self.standardize_rewards = standardize_rewards
+        self.reset_returns = reset_returns
+        self.scale_reward = scale_reward
+        self.rewnorm = RewardNormalizer(cliprew=cliprew)
+        # Carry of the last episode that ended, until the next episode starts
+        self._ended_carry = None
+
+    def get_state(self):
+        return {"gamma": self.gamma, "ret_rms": self.rewnorm.ret_rms}
+
+    def set_state(self, state):
+        self.gamma = state["gamma"]
+        # The local worker's policy may share the learner's statistics object
+        self.rewnorm.ret_rms = copy.deepcopy(state["ret_rms"])
+
+    def start_episode(self, episode):
+        """ on_episode_start hook, the episode carries on from the last one that ended in its env slot """
+        carry, self._ended_carry = self._ended_carry, None
+        episode.user_data[_RETURN_CARRY] = carry if carry is not None else (0., False)
+
+    def __call__(self, sample_batch, episode, value_fn):
+        """ value_fn maps a batch of observations to a numpy array of values """
+        rewards = sample_batch['rewards'].astype(np.float32)
+        dones = sample_batch['dones']
+        if self.standardize_rewards:
+            user_data = episode.user_data if episode is not None else {}
+            self.rewnorm.ret, last_done = user_data.get(_RETURN_CARRY, (0., False))
+            news = np.concatenate([[last_done], dones[:-1]])
+            rewards, returns = self.rewnorm.normalize_block(rewards[:, None], news[:, None], self.reset_returns,
+                                                            with_returns=True)
+            user_data[_RETURN_CARRY] = (float(self.rewnorm.ret[0]), bool(dones[-1]))
+            if dones[-1]:
+                self._ended_carry = user_data[_RETURN_CARRY]
+            rewards = rewards[:, 0]
+            sample_batch[DISCOUNTED_RETURNS] = returns[:, 0]
+        if self.scale_reward != 1.0:
+            rewards *= self.scale_reward
+
+        bootstrap_value = np.zeros_like(rewards)
+        if not dones[-1]:
+            bootstrap_value[-1] = value_fn(sample_batch['new_obs'][-1:])[0]
+        values = sample_batch['values'].astype(np.float32)
+        value_targets, _ = calculate_gae(values[:, None], dones[:, None], rewards[:, None],
+                                         bootstrap_value[-1:], self.gamma, self.lam)
+        sample_batch[NORMALIZED_REWARDS] = rewards
+        sample_batch[BOOTSTRAP_VALUE] = bootstrap_value
+        sample_batch[VALUE_TARGETS] = value_targets[:, 0]
+        return sample_batch
+
+
+def sync_worker_postprocessing(trainer, fetches):
+    """ after_optimizer_step hook, pushes the learner's gamma and return statistics to all workers """
+    if not trainer.config['worker_side_postprocessing']:
+        return
+    state = trainer.get_policy().worker_postprocessor_state()
+    set_state = lambda policy, policy_id: policy.worker_postprocessor.set_state(state)
+    trainer.workers.local_worker().foreach_policy(set_state)
+    # Not waited on, so workers still sampling an overlapped batch don't block the learner
+    for worker in trainer.workers.remote_workers():
+        worker.foreach_policy.remote(set_state)
@@ -106,6 +106,11 @@ class CustomTorchPolicy(TorchPolicy):
         self.make_distr = dist_build(self.action_space)
         self.retunes_completed = 0
         self.amp_scaler = GradScaler()
+        self.augmenter = BatchAugmenter(self.device, num_choices=self.config['augment_randint_num'],
+                                        seed=self.config['augment_seed'])
+        eval_chunk_size = self.config['aux_eval_chunk_size'] or self.config['max_minibatch_size']
+        self.replay_evaluator = ChunkedEvaluator(self.model, self.device, eval_chunk_size,
+                                                 mixed_precision=self.config['aux_phase_mixed_precision'])
         
         self.update_lr()
         
@@ -140,10 +145,9 @@ class CustomTorchPolicy(TorchPolicy):
         ## Reward Normalization - No reward norm works well for many envs
         if self.config['standardize_rewards']:
             mb_origrewards = unroll(samples['rewards'], ts)
-            mb_rewards =  np.zeros_like(mb_origrewards)
-            mb_rewards[0] = self.rewnorm.normalize(mb_origrewards[0], self.last_dones, self.config["reset_returns"])
-            for ii in range(1, nsteps):
-                mb_rewards[ii] = self.rewnorm.normalize(mb_origrewards[ii], mb_dones[ii-1], self.config["reset_returns"])
+            mb_news = np.concatenate([self.last_dones[None], mb_dones[:-1]])
+            mb_rewards = self.rewnorm.normalize_block(mb_origrewards, mb_news, self.config["reset_returns"],
+                                                      backend=self.config['gae_backend'], device=self.device)
             self.last_dones = mb_dones[-1]
         else:
             mb_rewards = unroll(samples['rewards'], ts)
@@ -167,18 +171,9 @@ class CustomTorchPolicy(TorchPolicy):
         
         ## GAE
         mb_values = unroll(values, ts)
-        mb_returns = np.zeros_like(mb_rewards)
-        mb_advs = np.zeros_like(mb_rewards)
-        lastgaelam = 0
-        for t in reversed(range(nsteps)):
-            if t == nsteps - 1:
-                nextvalues = last_values
-            else:
-                nextvalues = mb_values[t+1]
-            nextnonterminal = 1.0 - mb_dones[t]
-            delta = mb_rewards[t] + gamma * nextvalues * nextnonterminal - mb_values[t]
-            mb_advs[t] = lastgaelam = delta + gamma * lam * nextnonterminal * lastgaelam
-        mb_returns = mb_advs + mb_values
+        mb_returns, mb_advs = calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam,
+                                            backend=self.config['gae_backend'], device=self.device,
+                                            use_float64=self.config['gae_float64'])
         
         ## Data from config
         cliprange, vfcliprange = self.config['clip_param'], self.config['vf_clip_param']
@@ -292,12 +287,8 @@ class CustomTorchPolicy(TorchPolicy):
         nbatch_train = self.mem_limited_batch_size 
         retune_epochs = self.config['retune_epochs']
         replay_shape = self.retune_selector.vtarg_replay.shape
-        replay_pi = np.empty((*replay_shape, self.retune_selector.ac_space.n), dtype=np.float32)
-
-        for nnpi in range(self.retune_selector.n_pi):
-            for ne in range(self.retune_selector.nenvs):
-                _, replay_pi[nnpi, :, ne] = self.model.vf_pi(self.retune_selector.exp_replay[nnpi, :, ne], 
-                                                             ret_numpy=True, no_grad=True, to_torch=True)
+        _, replay_pi = self.replay_evaluator.evaluate(flatten012(self.retune_selector.exp_replay))
+        replay_pi = replay_pi.reshape(*replay_shape, -1)
         
         # Tune vf and pi heads to older predictions with (augmented?) observations
         num_accumulate = self.config['aux_num_accumulates']
@@ -313,15 +304,9 @@ class CustomTorchPolicy(TorchPolicy):
         self.retune_selector.retune_done()
  
     def tune_policy(self, obs, target_vf, target_pi, apply_grad, num_accumulate):
+        obs_in = self.to_tensor(obs)
         if self.config['augment_buffer']:
-            obs_aug = np.empty(obs.shape, obs.dtype)
-            aug_idx = np.random.randint(self.config['augment_randint_num'], size=len(obs))
-            obs_aug[aug_idx == 0] = pad_and_random_crop(obs[aug_idx == 0], 64, 10)
-            obs_aug[aug_idx == 1] = random_cutout_color(obs[aug_idx == 1], 10, 30)
-            obs_aug[aug_idx >= 2] = obs[aug_idx >= 2]
-            obs_in = self.to_tensor(obs_aug)
-        else:
-            obs_in = self.to_tensor(obs)
+            obs_in = self.augmenter(obs_in)
         
         if not self.config['aux_phase_mixed_precision']:
             loss, vf_loss = self._aux_calc_loss(obs_in, target_vf, target_pi, num_accumulate)
@@ -97,6 +97,13 @@ DEFAULT_CONFIG = with_common_config({
     "aux_phase_mixed_precision": False,
     "single_optimizer": False,
     "max_time": 7200, 
+    # GAE and reward normalization engine, "numpy" or "torch" (runs on the policy device)
+    "gae_backend": "numpy",
+    "gae_float64": False,
+    # Seed for the aux phase augmentations, None draws a random seed
+    "augment_seed": None,
+    # Chunk size for re-evaluating the aux replay, 0 uses max_minibatch_size
+    "aux_eval_chunk_size": 0,
     "pi_phase_mixed_precision": False,
     "aux_num_accumulates": 1,
     "l2_reg": 0.0,
@@ -8,6 +8,11 @@ import torch.distributions as td
 from functools import partial
 import itertools
 
+from ..common.augment import BatchAugmenter
+from ..common.batched_eval import ChunkedEvaluator
+from ..common.gae import calculate_gae
+from ..common.reward_norm import RewardNormalizer, RunningMeanStd, update_mean_var_count_from_moments
+
 def _make_categorical(x, ncat, shape):
     x = x.reshape((x.shape[0], shape, ncat))
     return td.Categorical(logits=x)
@@ -167,51 +172,3 @@ class RetuneSelector:
                               for arr in (self.exp_replay, self.vtarg_replay, presleep_pi)]
                     
                     yield mbatch
-   
-        
-class RewardNormalizer(object):
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
-    def __init__(self, gamma=0.99, cliprew=10.0, epsilon=1e-8):
-        self.epsilon = epsilon
-        self.gamma = gamma
-        self.ret_rms = RunningMeanStd(shape=())
-        self.cliprew = cliprew
-        self.ret = 0. # size updates after first pass
-        
-    def normalize(self, rews, news, resetrew):
-        self.ret = self.ret * self.gamma + rews
-        self.ret_rms.update(self.ret)
-        rews = np.clip(rews / np.sqrt(self.ret_rms.var + self.epsilon), -self.cliprew, self.cliprew)
-        if resetrew:
-            self.ret[np.array(news, dtype=bool)] = 0. ## Values should be True of False to set positional index
-        return rews
-    
-class RunningMeanStd(object):
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
-    def __init__(self, epsilon=1e-4, shape=()):
-        self.mean = np.zeros(shape, 'float64')
-        self.var = np.ones(shape, 'float64')
-        self.count = epsilon
-
-    def update(self, x):
-        batch_mean = np.mean(x, axis=0)
-        batch_var = np.var(x, axis=0)
-        batch_count = x.shape[0]
-        self.update_from_moments(batch_mean, batch_var, batch_count)
-
-    def update_from_moments(self, batch_mean, batch_var, batch_count):
-        self.mean, self.var, self.count = update_mean_var_count_from_moments(
-            self.mean, self.var, self.count, batch_mean, batch_var, batch_count)
-
-def update_mean_var_count_from_moments(mean, var, count, batch_mean, batch_var, batch_count):
-    delta = batch_mean - mean
-    tot_count = count + batch_count
-
-    new_mean = mean + delta * batch_count / tot_count
-    m_a = var * count
-    m_b = batch_var * batch_count
-    M2 = m_a + m_b + np.square(delta) * count * batch_count / tot_count
-    new_var = M2 / tot_count
-    new_count = tot_count
-
-    return new_mean, new_var, new_count
\ No newline at end of file
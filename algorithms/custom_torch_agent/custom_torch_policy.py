@@ -123,12 +123,9 @@ class CustomTorchPolicy(TorchPolicy):
         ## Reward Normalization - No reward norm works well for many envs
         if self.config['standardize_rewards']:
             mb_origrewards = unroll(samples['rewards'], ts)
-            mb_rewards =  np.zeros_like(mb_origrewards)
-            mb_rewards[0] = self.rewnorm.normalize(mb_origrewards[0], self.last_dones, 
-                                                   self.config["return_reset"])
-            for ii in range(1, nsteps):
-                mb_rewards[ii] = self.rewnorm.normalize(mb_origrewards[ii], mb_dones[ii-1],
-                                                       self.config["return_reset"])
+            mb_news = np.concatenate([self.last_dones[None], mb_dones[:-1]])
+            mb_rewards = self.rewnorm.normalize_block(mb_origrewards, mb_news, self.config["return_reset"],
+                                                      backend=self.config['gae_backend'], device=self.device)
             self.last_dones = mb_dones[-1]
         else:
             mb_rewards = unroll(samples['rewards'], ts)
@@ -152,18 +149,9 @@ class CustomTorchPolicy(TorchPolicy):
         
         ## GAE
         mb_values = unroll(values, ts)
-        mb_returns = np.zeros_like(mb_rewards)
-        mb_advs = np.zeros_like(mb_rewards)
-        lastgaelam = 0
-        for t in reversed(range(nsteps)):
-            if t == nsteps - 1:
-                nextvalues = last_values
-            else:
-                nextvalues = mb_values[t+1]
-            nextnonterminal = 1.0 - mb_dones[t]
-            delta = mb_rewards[t] + gamma * nextvalues * nextnonterminal - mb_values[t]
-            mb_advs[t] = lastgaelam = delta + gamma * lam * nextnonterminal * lastgaelam
-        mb_returns = mb_advs + mb_values
+        mb_returns, mb_advs = calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam,
+                                            backend=self.config['gae_backend'], device=self.device,
+                                            use_float64=self.config['gae_float64'])
         
         ## Data from config
         cliprange, vfcliprange = self.config['clip_param'], self.config['vf_clip_param']
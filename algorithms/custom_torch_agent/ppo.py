@@ -90,6 +90,9 @@ DEFAULT_CONFIG = with_common_config({
     "return_reset": True,
     "aux_phase_mixed_precision": False,
     "max_time": 100000000,
+    # GAE and reward normalization engine, "numpy" or "torch" (runs on the policy device)
+    "gae_backend": "numpy",
+    "gae_float64": False,
 })
 # __sphinx_doc_end__
 # yapf: enable
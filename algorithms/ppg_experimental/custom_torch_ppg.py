@@ -36,6 +36,8 @@ class CustomTorchPolicy(TorchPolicy):
                         framework="torch",
                         device=self.device,
                      )
+        if self.config['channels_last']:
+            self.model.to(memory_format=torch.channels_last)
 
         TorchPolicy.__init__(
             self,
@@ -48,21 +50,34 @@ class CustomTorchPolicy(TorchPolicy):
         )
         
         self.framework = "torch"
+        self.profiler = PhaseProfiler(self.device, self.config['profile_phases'], self.config['profile_trace_path'])
+        self.weight_sync = WeightSyncChannel(self.config['weight_sync_dtype'])
+        self.loaded_model_weights = None
+        self.worker_postprocessor = WorkerPostprocessor(self.config['gamma'], self.config['lambda'],
+                                                        self.config['standardize_rewards'],
+                                                        self.config['reset_returns'], self.config['scale_reward'],
+                                                        cliprew=self.config['env_config']['return_max'])
 
         
-    def init_training(self):
-        """ Init once only for the policy - Surely there should be a bette way to do this """
+    def init_training(self, learners=None, shared_arrays=None):
+        """
+        Init once only for the policy - Surely there should be a bette way to do this
+        learners and shared_arrays are only passed on the data-parallel replicas, see common/data_parallel.py
+        """
         aux_params = set(self.model.aux_vf.parameters())
         value_params = set(self.model.value_fc.parameters())
-        network_params = set(self.model.parameters())
-        aux_optim_params = list(network_params - value_params)
-        ppo_optim_params = list(network_params - aux_params - value_params)
+        # Parameter lists in model order, so optimizer states and gradient all-reduces
+        # line up between processes (set order depends on the tensor ids)
+        network_params = list(self.model.parameters())
+        aux_optim_params = [p for p in network_params if p not in value_params]
+        ppo_optim_params = [p for p in aux_optim_params if p not in aux_params]
         if not self.config['single_optimizer']:
             self.optimizer = torch.optim.Adam(ppo_optim_params, lr=self.config['lr'])
         else:
             self.optimizer = torch.optim.Adam(network_params, lr=self.config['lr'])
         self.aux_optimizer = torch.optim.Adam(aux_optim_params, lr=self.config['aux_lr'])
-        self.value_optimizer = torch.optim.Adam(value_params, lr=self.config['value_lr'])
+        self.value_optimizer = torch.optim.Adam([p for p in network_params if p in value_params],
+                                                lr=self.config['value_lr'])
         self.max_reward = self.config['env_config']['return_max']
         self.rewnorm = RewardNormalizer(cliprew=self.max_reward) ## TODO: Might need to go to custom state
         self.reward_deque = deque(maxlen=100)
@@ -86,11 +101,36 @@ class CustomTorchPolicy(TorchPolicy):
             print("WARNING: MEMORY LIMITED BATCHING NOT SET PROPERLY")
             print("#################################################")
         replay_shape = (n_pi, nsteps, nenvs)
+        
+        ## Data-parallel learners, this policy is rank 0
+        self.num_learners = self.config['num_learners']
+        self.learners = learners
+        if self.num_learners > 1 and shared_arrays is None:
+            shared_arrays = SharedArrays(self.config['replay_storage_dir'])
+        allocate = shared_arrays.allocate if shared_arrays is not None else None
         self.retune_selector = RetuneSelector(nenvs, self.observation_space, self.action_space, replay_shape,
                                               skips = self.config['skips'], 
                                               n_pi = n_pi,
                                               num_retunes = self.config['num_retunes'],
-                                              flat_buffer = self.config['flattened_buffer'])
+                                              flat_buffer = self.config['flattened_buffer'],
+                                              storage = self.config['replay_storage'],
+                                              storage_dir = self.config['replay_storage_dir'],
+                                              allocate = allocate)
+        if allocate is not None:
+            assert self.nbatch % self.mem_limited_batch_size == 0 and \
+                   self.mem_limited_batch_size % self.num_learners == 0, \
+                   "Minibatches must split evenly between the {} learners".format(self.num_learners)
+            assert (n_pi * nenvs) % self.config['aux_mbsize'] == 0 and \
+                   self.config['aux_mbsize'] % self.num_learners == 0, \
+                   "Aux minibatches must split evenly between the {} learners".format(self.num_learners)
+            ob_shape = self.observation_space.shape
+            self.shared_batch = [allocate("batch_" + name, shape, dtype) for name, shape, dtype in (
+                ("obs", (self.nbatch, *ob_shape), np.uint8), ("returns", (self.nbatch,), np.float32),
+                ("actions", (self.nbatch,), np.int64), ("values", (self.nbatch,), np.float32),
+                ("logp_actions", (self.nbatch,), np.float32), ("advs", (self.nbatch,), np.float32))]
+            replay_size = int(np.prod(replay_shape))
+            self.shared_replay_vf = allocate("replay_vf", (replay_size,), np.float32)
+            self.shared_replay_pi = allocate("replay_pi", (replay_size, self.model.num_outputs), np.float32)
         self.save_success = 0
         self.target_timesteps = 8_000_000
         self.buffer_time = 20 # TODO: Could try to do a median or mean time step check instead
@@ -106,12 +146,44 @@ class CustomTorchPolicy(TorchPolicy):
         self.make_distr = dist_build(self.action_space)
         self.retunes_completed = 0
         self.amp_scaler = GradScaler()
+        self.pi_phase_precision = MixedPrecision(self.device, self.config['pi_phase_mixed_precision'], self.amp_scaler)
+        self.minibatch_loader = MinibatchLoader(self.device, mode=self.config['minibatch_loader'])
+        self.augmenter = BatchAugmenter(self.device, num_choices=self.config['augment_randint_num'],
+                                        seed=self.config['augment_seed'])
+        eval_chunk_size = self.config['aux_eval_chunk_size'] or self.config['max_minibatch_size']
+        assert self.config['aux_sampler'] in ("legacy", "streaming"), \
+               "Unknown aux sampler {}".format(self.config['aux_sampler'])
+        self.replay_sampler = None
+        if self.config['aux_sampler'] == "streaming":
+            self.replay_sampler = ReplaySampler(self.device, replay_shape, flat_buffer=self.config['flattened_buffer'],
+                                                block_size=self.config['aux_sampler_block_size'],
+                                                device_cache_segments=self.config['aux_device_cache_segments'])
+        self.replay_evaluator = ChunkedEvaluator(self.model, self.device, eval_chunk_size,
+                                                 mixed_precision=self.config['aux_phase_mixed_precision'])
         
         self.update_lr()
         
+        if self.num_learners > 1 and learners is None:
+            self.learners = DataParallelLearners(self, self.num_learners, self.config['learner_backend'],
+                                                 shared_arrays)
+            # Every learner has mapped the shared arrays
+            self.learners.barrier()
+            shared_arrays.unlink()
+        
     def to_tensor(self, arr):
         return torch.from_numpy(arr).to(self.device)
     
+    @override(TorchPolicy)
+    def postprocess_trajectory(self, sample_batch, other_agent_batches=None, episode=None):
+        sample_batch = add_episode_columns(sample_batch)
+        if self.config['worker_side_postprocessing']:
+            value_fn = lambda obs: self.model.vf_pi(obs, ret_numpy=True, no_grad=True, to_torch=True)[0]
+            sample_batch = self.worker_postprocessor(sample_batch, episode, value_fn)
+        return sample_batch
+    
+    def worker_postprocessor_state(self):
+        return {"gamma": self.gamma, "ret_rms": self.rewnorm.ret_rms}
+    
     @override(TorchPolicy)
     def extra_action_out(self, input_dict, state_batches, model, action_dist):
         return {'values': model._value.tolist()}
@@ -128,6 +200,13 @@ class CustomTorchPolicy(TorchPolicy):
             >>> ev.learn_on_batch(samples)
         Reference: https://github.com/ray-project/ray/blob/master/rllib/policy/policy.py#L279-L316
         """
+        with self.profiler.phase("learn_on_batch"):
+            return self._learn_on_batch(samples)
+    
+    def _learn_on_batch(self, samples):
+        with self.profiler.phase("decode_samples"):
+            samples = decode_frame_stacks(samples)
+        
         ## Config data values
         nbatch = self.nbatch
         nbatch_train = self.mem_limited_batch_size 
@@ -138,35 +217,49 @@ class CustomTorchPolicy(TorchPolicy):
         mb_dones = unroll(samples['dones'], ts)
         
         ## Reward Normalization - No reward norm works well for many envs
-        if self.config['standardize_rewards']:
+        if self.config['worker_side_postprocessing']:
+            # Normalized and scaled on the workers
+            mb_rewards = unroll(samples[NORMALIZED_REWARDS], ts)
+            if self.config['standardize_rewards']:
+                self.rewnorm.ret_rms.update(samples[DISCOUNTED_RETURNS])
+        elif self.config['standardize_rewards']:
             mb_origrewards = unroll(samples['rewards'], ts)
-            mb_rewards =  np.zeros_like(mb_origrewards)
-            mb_rewards[0] = self.rewnorm.normalize(mb_origrewards[0], self.last_dones, self.config["reset_returns"])
-            for ii in range(1, nsteps):
-                mb_rewards[ii] = self.rewnorm.normalize(mb_origrewards[ii], mb_dones[ii-1], self.config["reset_returns"])
+            mb_news = np.concatenate([self.last_dones[None], mb_dones[:-1]])
+            with self.profiler.phase("reward_normalization"):
+                mb_rewards = self.rewnorm.normalize_block(mb_origrewards, mb_news, self.config["reset_returns"],
+                                                          backend=self.config['gae_backend'], device=self.device)
             self.last_dones = mb_dones[-1]
         else:
             mb_rewards = unroll(samples['rewards'], ts)
        
         # Weird hack that helps in many envs (Yes keep it after reward normalization)
         rew_scale = self.config["scale_reward"]
-        if rew_scale != 1.0:
+        if rew_scale != 1.0 and not self.config['worker_side_postprocessing']:
             mb_rewards *= rew_scale
         
         should_skip_train_step = self.best_reward_model_select(samples)
         if should_skip_train_step:
             self.update_batch_time()
             return {} # Not doing last optimization step - This is intentional due to noisy gradients
+        self.weight_sync.mark_changed()
           
         obs = samples['obs']
 
         ## Value prediction
-        next_obs = unroll(samples['new_obs'], ts)[-1]
-        last_values, _ = self.model.vf_pi(next_obs, ret_numpy=True, no_grad=True, to_torch=True)
         values = samples['values']
-        
-        mb_values = unroll(values, ts)
-        mb_returns, mb_advs = calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam)
+        if self.config['worker_side_postprocessing']:
+            last_values = unroll(samples[BOOTSTRAP_VALUE], ts)[-1]
+            returns = samples[VALUE_TARGETS]
+        else:
+            next_obs = unroll(samples['new_obs'], ts)[-1]
+            with self.profiler.phase("bootstrap_value"):
+                last_values, _ = self.model.vf_pi(next_obs, ret_numpy=True, no_grad=True, to_torch=True)
+            mb_values = unroll(values, ts)
+            with self.profiler.phase("gae"):
+                mb_returns, mb_advs = calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam,
+                                                    backend=self.config['gae_backend'], device=self.device,
+                                                    use_float64=self.config['gae_float64'])
+            returns = roll(mb_returns)
         self.last_values = last_values
             
         ## Data from config
@@ -177,29 +270,28 @@ class CustomTorchPolicy(TorchPolicy):
         logp_actions = samples['action_logp'] ## np.isclose seems to be True always, otherwise compute again if needed
         noptepochs = self.config['num_sgd_iter']
         actions = samples['actions']
-        returns = roll(mb_returns)
         
         advs = returns - values
         normalized_advs = (advs - np.mean(advs)) / (np.std(advs) + 1e-8) 
         
         ## Train multiple epochs
-        optim_count = 0
-        inds = np.arange(nbatch)
-        for _ in range(noptepochs):
-            np.random.shuffle(inds)
-            for start in range(0, nbatch, nbatch_train):
-                end = start + nbatch_train
-                mbinds = inds[start:end]
-                slices = (self.to_tensor(arr[mbinds]) for arr in (obs, returns, actions, values, logp_actions, normalized_advs))
-                optim_count += 1
-                apply_grad = (optim_count % self.accumulate_train_batches) == 0
-                self._batch_train(apply_grad, self.accumulate_train_batches,
-                                  cliprange, vfcliprange, max_grad_norm, ent_coef, vf_coef, *slices)
+        epoch_inds = [np.random.permutation(nbatch) for _ in range(noptepochs)]
+        loss_args = (cliprange, vfcliprange, max_grad_norm, ent_coef, vf_coef)
+        batch = (obs, returns, actions, values, logp_actions, normalized_advs)
+        if self.learners is not None:
+            # The learners all read the batch from the shared arrays
+            with self.profiler.phase("shared_batch_write"):
+                for shared, arr in zip(self.shared_batch, batch):
+                    shared[...] = arr
+            batch = None
+        self._run_on_learners("_train_policy_phase", epoch_inds, loss_args, self._learning_rates(), batch)
+        self.profiler.count("learner_samples", nbatch * noptepochs)
                 
         ## Distill with aux head
         should_retune = self.retune_selector.update(unroll(obs, ts), mb_dones, mb_rewards)
         if should_retune:
-            self.aux_train()
+            with self.profiler.phase("aux_phase"):
+                self.aux_train()
         
         self.update_gamma(samples)
         self.update_lr()
@@ -208,6 +300,54 @@ class CustomTorchPolicy(TorchPolicy):
         self.update_batch_time()
         return {}
     
+    def _train_policy_phase(self, epoch_inds, loss_args, lrs, batch=None):
+        """ Policy phase epochs over the minibatches of epoch_inds, this learner's share of each """
+        self._sync_learners(lrs)
+        nbatch_train = self.mem_limited_batch_size
+        learner_batch_size = nbatch_train // self.num_learners
+        optim_count = 0
+        with self.profiler.phase("h2d_transfer"):
+            self.minibatch_loader.set_batch(*(self.shared_batch if batch is None else batch))
+        for inds in epoch_inds:
+            if self.learners is not None:
+                inds = self.learners.shard_minibatches(inds, nbatch_train)
+            for slices in self.profiler.iterate("h2d_transfer", self.minibatch_loader.minibatches(inds, learner_batch_size)):
+                optim_count += 1
+                apply_grad = (optim_count % self.accumulate_train_batches) == 0
+                self._batch_train(apply_grad, self.accumulate_train_batches, *loss_args, *slices)
+        self.minibatch_loader.release()
+        if self.learners is not None:
+            # Rank 0 overwrites the shared batch and replay after this
+            self.learners.barrier()
+    
+    def _run_on_learners(self, method, *args):
+        """ Runs a training phase on the replicas, if any, and on this policy """
+        if self.learners is not None and self.learners.rank == 0:
+            self.learners.send(method, *args)
+        return getattr(self, method)(*args)
+    
+    def _learning_rates(self):
+        return [[g['lr'] for g in optimizer.param_groups]
+                for optimizer in (self.optimizer, self.aux_optimizer, self.value_optimizer)]
+    
+    def _sync_learners(self, lrs):
+        """ Rank 0's weights (e.g. best weights loaded) and learning rates on every learner """
+        if self.learners is None:
+            return
+        with self.profiler.phase("learner_sync"):
+            self.learners.broadcast_parameters(self.model.parameters())
+        for optimizer, group_lrs in zip((self.optimizer, self.aux_optimizer, self.value_optimizer), lrs):
+            for g, lr in zip(optimizer.param_groups, group_lrs):
+                g['lr'] = lr
+    
+    def _allreduce_gradients(self, optimizers):
+        """ Averages the gradients of the optimizers' parameters over the learners """
+        if self.learners is None:
+            return
+        with self.profiler.phase("gradient_allreduce"):
+            self.learners.allreduce_gradients([p for optimizer in optimizers
+                                               for group in optimizer.param_groups for p in group['params']])
+    
     def update_batch_time(self):
         self.time_elapsed += time.time() - self.batch_end_time
         self.batch_end_time = time.time()
@@ -217,19 +357,20 @@ class CustomTorchPolicy(TorchPolicy):
                      ent_coef, vf_coef,
                      obs, returns, actions, values, logp_actions_old, advs):
         
-        loss, vf_loss = self._calc_pi_vf_loss(apply_grad, num_accumulate, 
-                                             cliprange, vfcliprange, max_grad_norm,
-                                             ent_coef, vf_coef,
-                                             obs, returns, actions, values, logp_actions_old, advs)
-
-        loss.backward()
-        vf_loss.backward()
+        with self.profiler.phase("forward_backward"):
+            with self.pi_phase_precision.autocast():
+                loss, vf_loss = self._calc_pi_vf_loss(apply_grad, num_accumulate, 
+                                                     cliprange, vfcliprange, max_grad_norm,
+                                                     ent_coef, vf_coef,
+                                                     obs, returns, actions, values, logp_actions_old, advs)
+            # The value head is on the detached latent, so one backward of the sum
+            # gives each optimizer the same gradients as two separate ones
+            self.pi_phase_precision.backward(loss + vf_loss)
         if apply_grad:
-            self.optimizer.step()
-            self.optimizer.zero_grad()
-            if not self.config['single_optimizer']:
-                self.value_optimizer.step()
-                self.value_optimizer.zero_grad()
+            with self.profiler.phase("optimizer_step"):
+                optimizers = [self.optimizer] if self.config['single_optimizer'] else [self.optimizer, self.value_optimizer]
+                self._allreduce_gradients(optimizers)
+                self.pi_phase_precision.step(optimizers, max_grad_norm)
 
     
     def _calc_pi_vf_loss(self, apply_grad, num_accumulate, 
@@ -256,75 +397,112 @@ class CustomTorchPolicy(TorchPolicy):
         return loss, vf_loss
     
     def aux_train(self):
-        nbatch_train = self.mem_limited_batch_size 
+        seed = np.random.randint(2**31)
+        self._run_on_learners("_aux_phase", seed, self.last_values, self.gamma, self._learning_rates())
+        self.retunes_completed += 1
+        self.retune_selector.retune_done()
+    
+    def _aux_phase(self, seed, last_values, gamma, lrs):
+        """ Aux phase epochs, this learner's share of each minibatch, shuffled the same on every learner by seed """
+        self._sync_learners(lrs)
+        # Replicas see the replay rank 0 wrote
+        self.retune_selector.refresh()
         retune_epochs = self.config['retune_epochs']
         replay_shape = self.retune_selector.replay_shape
-        replay_pi = np.empty((*replay_shape, self.retune_selector.ac_space.n), dtype=np.float32)
-        replay_vf = np.empty((*replay_shape,), dtype=np.float32)
-
-        for nnpi in range(self.retune_selector.n_pi):
-            for ne in range(self.retune_selector.nenvs):
-                replay_vf[nnpi, :, ne], replay_pi[nnpi, :, ne] = self.model.vf_pi(self.retune_selector.exp_replay[nnpi, :, ne], 
-                                                                         ret_numpy=True, no_grad=True, to_torch=True)
-        
-        gamma, lam = self.gamma, self.config['lambda']
-        new_returns = calculate_gae_buffer(replay_vf, 
-                                           self.retune_selector.dones_replay,
-                                           self.retune_selector.rewards_replay, 
-                                           self.last_values, gamma, lam)
+        with self.profiler.phase("aux_reevaluation"):
+            replay_vf, replay_pi = self._reevaluate_replay()
+        replay_vf = replay_vf.reshape(replay_shape)
+        replay_pi = replay_pi.reshape(*replay_shape, -1)
+        
+        lam = self.config['lambda']
+        with self.profiler.phase("gae"):
+            new_returns = calculate_gae_buffer(replay_vf, 
+                                               self.retune_selector.dones_replay,
+                                               self.retune_selector.rewards_replay, 
+                                               last_values, gamma, lam,
+                                               backend=self.config['gae_backend'], device=self.device,
+                                               use_float64=self.config['gae_float64'])
         
         # Tune vf and pi heads to older predictions with (augmented?) observations
         num_accumulate = self.config['aux_num_accumulates']
         num_rollouts = self.config['aux_mbsize']
+        rng = np.random.RandomState(seed)
+        shard = None if self.learners is None else (self.learners.rank, self.learners.world_size)
+        if self.replay_sampler is not None:
+            with self.profiler.phase("h2d_transfer"):
+                self.replay_sampler.set_replay(self.retune_selector.exp_replay, new_returns, replay_pi)
         for ep in range(retune_epochs):
             counter = 0
-            for slices in self.retune_selector.make_minibatches(replay_pi, new_returns, num_rollouts):
+            if self.replay_sampler is not None:
+                minibatches = self.replay_sampler.minibatches(num_rollouts, rng, shard)
+            else:
+                minibatches = self.retune_selector.make_minibatches(replay_pi, new_returns, num_rollouts,
+                                                                    rng=rng, shard=shard)
+            for slices in self.profiler.iterate("aux_minibatch_gather", minibatches):
                 counter += 1
                 apply_grad = (counter % num_accumulate) == 0
-                self.tune_policy(slices[0], self.to_tensor(slices[1]), self.to_tensor(slices[2]), 
-                                 apply_grad, num_accumulate)
-        self.retunes_completed += 1
-        self.retune_selector.retune_done()
+                if self.replay_sampler is None:
+                    with self.profiler.phase("h2d_transfer"):
+                        slices = [self.to_tensor(arr) for arr in slices]
+                obs, target_vf, target_pi = slices
+                self.tune_policy(obs, target_vf, target_pi, apply_grad, num_accumulate)
+                self.profiler.count("learner_samples", len(obs) * self.num_learners)
+        if self.replay_sampler is not None:
+            self.replay_sampler.release()
+        if self.learners is not None:
+            self.learners.barrier()
+    
+    def _reevaluate_replay(self):
+        """ vf and pi logits of the flattened replay, each learner evaluates its share into the shared arrays """
+        replay = flatten012(self.retune_selector.exp_replay)
+        if self.learners is None:
+            return self.replay_evaluator.evaluate(replay)
+        start, end = self.learners.shard_range(len(replay))
+        self.shared_replay_vf[start:end], self.shared_replay_pi[start:end] = \
+            self.replay_evaluator.evaluate(replay, start, end)
+        self.learners.barrier()
+        return self.shared_replay_vf, self.shared_replay_pi
  
-    def tune_policy(self, obs, target_vf, target_pi, apply_grad, num_accumulate):
+    def tune_policy(self, obs_in, target_vf, target_pi, apply_grad, num_accumulate):
         if self.config['augment_buffer']:
-            obs_aug = np.empty(obs.shape, obs.dtype)
-            aug_idx = np.random.randint(self.config['augment_randint_num'], size=len(obs))
-            obs_aug[aug_idx == 0] = pad_and_random_crop(obs[aug_idx == 0], 64, 10)
-            obs_aug[aug_idx == 1] = random_cutout_color(obs[aug_idx == 1], 10, 30)
-            obs_aug[aug_idx >= 2] = obs[aug_idx >= 2]
-            obs_in = self.to_tensor(obs_aug)
-        else:
-            obs_in = self.to_tensor(obs)
+            with self.profiler.phase("augmentation"):
+                obs_in = self.augmenter(obs_in)
         
+        optimizers = [self.optimizer] if self.config['single_optimizer'] else [self.aux_optimizer, self.value_optimizer]
         if not self.config['aux_phase_mixed_precision']:
-            loss, vf_loss = self._aux_calc_loss(obs_in, target_vf, target_pi, num_accumulate)
-            loss.backward()
-            vf_loss.backward()
+            with self.profiler.phase("aux_forward_backward"):
+                loss, vf_loss = self._aux_calc_loss(obs_in, target_vf, target_pi, num_accumulate)
+                loss.backward()
+                vf_loss.backward()
             
             if apply_grad:
-                if not self.config['single_optimizer']:
-                    self.aux_optimizer.step()
-                    self.value_optimizer.step()
-                else:
-                    self.optimizer.step()
+                self._allreduce_gradients(optimizers)
+                with self.profiler.phase("aux_optimizer_step"):
+                    if not self.config['single_optimizer']:
+                        self.aux_optimizer.step()
+                        self.value_optimizer.step()
+                    else:
+                        self.optimizer.step()
                 
             
         else:
-            with autocast():
-                loss, vf_loss = self._aux_calc_loss(obs_in, target_vf, target_pi, num_accumulate)
-            
-            self.amp_scaler.scale(loss).backward(retain_graph=True)
-            self.amp_scaler.scale(vf_loss).backward()
+            with self.profiler.phase("aux_forward_backward"):
+                with autocast():
+                    loss, vf_loss = self._aux_calc_loss(obs_in, target_vf, target_pi, num_accumulate)
+                
+                self.amp_scaler.scale(loss).backward(retain_graph=True)
+                self.amp_scaler.scale(vf_loss).backward()
             
             if apply_grad:
-                if not self.config['single_optimizer']:
-                    self.amp_scaler.step(self.aux_optimizer)
-                    self.amp_scaler.step(self.value_optimizer)
-                else:
-                    self.amp_scaler.step(self.optimizer)
+                self._allreduce_gradients(optimizers)
+                with self.profiler.phase("aux_optimizer_step"):
+                    if not self.config['single_optimizer']:
+                        self.amp_scaler.step(self.aux_optimizer)
+                        self.amp_scaler.step(self.value_optimizer)
+                    else:
+                        self.amp_scaler.step(self.optimizer)
 
-                self.amp_scaler.update()
+                    self.amp_scaler.update()
          
         if apply_grad:
             if not self.config['single_optimizer']:
@@ -354,12 +532,12 @@ class CustomTorchPolicy(TorchPolicy):
         self.timesteps_total += len(samples['dones'])
         
         ## Best reward model selection
-        eprews = [info['episode']['r'] for info in samples['infos'] if 'episode' in info]
+        eprews, _ = completed_episodes(samples)
         self.reward_deque.extend(eprews)
         mean_reward = safe_mean(eprews) if len(eprews) >= 100 else safe_mean(self.reward_deque)
         if self.best_reward < mean_reward:
             self.best_reward = mean_reward
-            self.best_weights = self.get_weights()["current_weights"]
+            self.best_weights = self.get_model_weights()
             self.best_rew_tsteps = self.timesteps_total
            
         if self.timesteps_total > self.target_timesteps or (self.time_elapsed + self.buffer_time) > self.max_time:
@@ -398,8 +576,8 @@ class CustomTorchPolicy(TorchPolicy):
     
     def update_gamma(self, samples):
         if self.config['adaptive_gamma']:
-            epinfobuf = [info['episode'] for info in samples['infos'] if 'episode' in info]
-            self.maxrewep_lenbuf.extend([epinfo['l'] for epinfo in epinfobuf if epinfo['r'] >= self.max_reward])
+            eprews, eplens = completed_episodes(samples)
+            self.maxrewep_lenbuf.extend(eplens[eprews >= self.max_reward])
             sorted_nth = lambda buf, n: np.nan if len(buf) < 100 else sorted(self.maxrewep_lenbuf.copy())[n]
             target_horizon = sorted_nth(self.maxrewep_lenbuf, 80)
             self.gamma = self.adaptive_discount_tuner.update(target_horizon)
@@ -439,20 +617,35 @@ class CustomTorchPolicy(TorchPolicy):
         self.last_dones = custom_state_vars["last_dones"]
         self.retunes_completed = custom_state_vars["retunes_completed"]
     
+    def get_model_weights(self):
+        return {k: v.cpu().detach().numpy() for k, v in self.model.state_dict().items()}
+    
     @override(TorchPolicy)
     def get_weights(self):
-        weights = {}
-        weights["current_weights"] = {
-            k: v.cpu().detach().numpy()
-            for k, v in self.model.state_dict().items()
-        }
-        return weights
+        """ Sync payload for the rollout workers, see common/weight_sync.py """
+        with self.profiler.phase("weight_sync"):
+            return self.weight_sync.payload(self.model.state_dict())
     
     @override(TorchPolicy)
     def set_weights(self, weights):
-        self.set_model_weights(weights["current_weights"])
+        if "current_weights" in weights:
+            self.set_model_weights(weights["current_weights"])
+            return
+        acting_weights = convert_to_torch_tensor(self.weight_sync.unpack(weights), device=self.device)
+        self.model.load_state_dict(acting_weights, strict=False)
+    
+    @override(TorchPolicy)
+    def get_state(self):
+        return {"current_weights": self.get_model_weights()}
+    
+    @override(TorchPolicy)
+    def set_state(self, state):
+        self.set_model_weights(state["current_weights"])
         
     def set_optimizer_state(self, optimizer_state, aux_optimizer_state, value_optimizer_state, amp_scaler_state):
+        if self.learners is not None and self.learners.rank == 0:
+            self.learners.send("set_optimizer_state", optimizer_state, aux_optimizer_state,
+                               value_optimizer_state, amp_scaler_state)
         optimizer_state = convert_to_torch_tensor(optimizer_state, device=self.device)
         self.optimizer.load_state_dict(optimizer_state)
         
@@ -466,5 +659,9 @@ class CustomTorchPolicy(TorchPolicy):
         self.amp_scaler.load_state_dict(amp_scaler_state)
         
     def set_model_weights(self, model_weights):
+        # Loading the same dict again (best weights on skipped steps) changes nothing
+        if model_weights is not self.loaded_model_weights:
+            self.weight_sync.mark_changed()
+        self.loaded_model_weights = model_weights
         model_weights = convert_to_torch_tensor(model_weights, device=self.device)
         self.model.load_state_dict(model_weights)
\ No newline at end of file
@@ -2,10 +2,13 @@ import logging
 import os
 import time
 
+import ray
 from ray.rllib.agents.trainer import Trainer, COMMON_CONFIG
-from ray.rllib.optimizers import SyncSamplesOptimizer
 from ray.rllib.utils import add_mixins
 from ray.rllib.utils.annotations import override, DeveloperAPI
+from ..common.checkpoint import CheckpointWriter, load_checkpoint, restore_worker, worker_state
+from ..common.overlapped_optimizer import OverlappedSamplesOptimizer
+from ..common.sync_samples_optimizer import SkipUnchangedSyncSamplesOptimizer
 import numpy as np
 from zlib import compress, decompress
 from sys import getsizeof
@@ -91,6 +94,8 @@ def build_trainer(name,
         _policy = default_policy
 
         def __init__(self, config=None, env=None, logger_creator=None):
+            self.checkpoint_writer = CheckpointWriter()
+            self._sync_checkpoint = False
             Trainer.__init__(self, config, env, logger_creator)
 
         def _init(self, config, env_creator):
@@ -131,12 +136,18 @@ def build_trainer(name,
                 self.train_exec_impl = execution_plan(self.workers, config)
             elif make_policy_optimizer:
                 self.optimizer = make_policy_optimizer(self.workers, config)
+            elif config.get("overlap_sampling", False):
+                self.optimizer = OverlappedSamplesOptimizer(
+                    self.workers,
+                    train_batch_size=config["train_batch_size"],
+                    samples_per_call=config["rollout_fragment_length"] * config["num_envs_per_worker"],
+                    staleness_bound=config["max_sample_staleness"])
             else:
                 optimizer_config = dict(
                     config["optimizer"],
                     **{"train_batch_size": config["train_batch_size"]})
-                self.optimizer = SyncSamplesOptimizer(self.workers,
-                                                      **optimizer_config)
+                self.optimizer = SkipUnchangedSyncSamplesOptimizer(self.workers,
+                                                                   **optimizer_config)
             if after_init:
                 after_init(self)
                 
@@ -191,39 +202,102 @@ def build_trainer(name,
             if before_evaluate_fn:
                 before_evaluate_fn(self)
 
-        def __getstate__(self):
-            state = Trainer.__getstate__(self)
-            state["trainer_state"] = self.state.copy()
+        def _training_state(self):
+            """ State only needed to resume training, see common/checkpoint.py """
+            training_state = {}
             policy = Trainer.get_policy(self)
             try:
-                state["custom_state_vars"] = policy.get_custom_state_vars()
-                state["optimizer_state"] = {k: v for k, v in policy.optimizer.state_dict().items()}
-                state["aux_optimizer_state"] = {k: v for k, v in policy.aux_optimizer.state_dict().items()}
-                state["value_optimizer_state"] = {k: v for k, v in policy.value_optimizer.state_dict().items()}
-                state["amp_scaler_state"] = {k: v for k, v in policy.amp_scaler.state_dict().items()}
+                training_state["custom_state_vars"] = policy.get_custom_state_vars()
+                training_state["optimizer_state"] = {k: v for k, v in policy.optimizer.state_dict().items()}
+                training_state["aux_optimizer_state"] = {k: v for k, v in policy.aux_optimizer.state_dict().items()}
+                training_state["value_optimizer_state"] = {k: v for k, v in policy.value_optimizer.state_dict().items()}
+                training_state["amp_scaler_state"] = {k: v for k, v in policy.amp_scaler.state_dict().items()}
             except:
                 print("################# WARNING: SAVING STATE VARS AND OPTIMIZER FAILED ################")
-            
+            return training_state
+
+        def __getstate__(self):
+            state = Trainer.__getstate__(self)
+            state["trainer_state"] = self.state.copy()
+            state.update(self._training_state())
+
             if self.train_exec_impl:
                 state["train_exec_impl"] = (
                     self.train_exec_impl.shared_metrics.get().save())
             return state
 
         def __setstate__(self, state):
+            if "weights" in state:
+                # Split checkpoint, the weights and filters go to the workers as they are
+                self._restore_workers(state)
             Trainer.__setstate__(self, state)
             policy = Trainer.get_policy(self)
             self.state = state["trainer_state"].copy()
-            try:
-                policy.set_optimizer_state(state["optimizer_state"], state["aux_optimizer_state"], 
-                                           state["value_optimizer_state"], state["amp_scaler_state"])
-                policy.set_custom_state_vars(state["custom_state_vars"])
-            except:
-                print("################# WARNING: LOADING STATE VARS AND OPTIMIZER FAILED ################")
-                            
+            # Not there when restoring for evaluation
+            if "custom_state_vars" in state:
+                try:
+                    policy.set_optimizer_state(state["optimizer_state"], state["aux_optimizer_state"], 
+                                               state["value_optimizer_state"], state["amp_scaler_state"])
+                    policy.set_custom_state_vars(state["custom_state_vars"])
+                except:
+                    print("################# WARNING: LOADING STATE VARS AND OPTIMIZER FAILED ################")
+
             if self.train_exec_impl:
                 self.train_exec_impl.shared_metrics.get().restore(
                     state["train_exec_impl"])
 
+        def _restore_workers(self, state):
+            restore_worker(self.workers.local_worker(), state)
+            if self.workers.remote_workers():
+                remote_state = ray.put(worker_state(state))
+                for worker in self.workers.remote_workers():
+                    worker.apply.remote(restore_worker, remote_state)
+
+        @override(Trainer)
+        def _save(self, checkpoint_dir):
+            if self.config["checkpoint_format"] != "split":
+                return Trainer._save(self, checkpoint_dir)
+            checkpoint_path = os.path.join(checkpoint_dir, "checkpoint-{}".format(self.iteration))
+            manifest = {
+                "filters": self.workers.local_worker().get_filters(),
+                "trainer_state": self.state.copy(),
+            }
+            if hasattr(self, "optimizer") and hasattr(self.optimizer, "save"):
+                manifest["optimizer"] = self.optimizer.save()
+            if self.train_exec_impl:
+                manifest["train_exec_impl"] = self.train_exec_impl.shared_metrics.get().save()
+            weights = Trainer.get_policy(self).get_state()["current_weights"]
+            self.checkpoint_writer.save(checkpoint_path, manifest, weights, self._training_state(),
+                                        sync=self._sync_checkpoint)
+            return checkpoint_path
+
+        @override(Trainer)
+        def _restore(self, checkpoint_path):
+            self.checkpoint_writer.wait()
+            self.__setstate__(load_checkpoint(checkpoint_path))
+
+        def restore_for_evaluation(self, checkpoint_path):
+            """ Restores the weights and filters only, skipping the training state """
+            self.checkpoint_writer.wait()
+            self.__setstate__(load_checkpoint(checkpoint_path, training_state=False))
+
+        @override(Trainer)
+        def save_to_object(self):
+            # Reads the checkpoint files back right after saving them
+            self._sync_checkpoint = True
+            try:
+                return Trainer.save_to_object(self)
+            finally:
+                self._sync_checkpoint = False
+
+        @override(Trainer)
+        def _stop(self):
+            self.checkpoint_writer.wait()
+            learners = getattr(Trainer.get_policy(self), "learners", None)
+            if learners is not None:
+                learners.close()
+            Trainer._stop(self)
+
     def with_updates(**overrides):
         """Build a copy of this trainer with the specified overrides.
 
@@ -4,6 +4,7 @@ from ray.rllib.agents import with_common_config
 from .custom_torch_ppg import CustomTorchPolicy
 # from ray.rllib.agents.trainer_template import build_trainer
 from .custom_trainer_template import build_trainer
+from ..common.worker_postprocessing import sync_worker_postprocessing
 
 logger = logging.getLogger(__name__)
 
@@ -97,8 +98,61 @@ DEFAULT_CONFIG = with_common_config({
     "aux_phase_mixed_precision": False,
     "single_optimizer": False,
     "max_time": 7200, 
+    # GAE and reward normalization engine, "numpy" or "torch" (runs on the policy device)
+    "gae_backend": "numpy",
+    "gae_float64": False,
+    # Seed for the aux phase augmentations, None draws a random seed
+    "augment_seed": None,
+    # "pinned" gathers minibatches into pinned buffers and prefetches them,
+    # "device" uploads the whole batch once (needs room for it on the gpu)
+    "minibatch_loader": "pinned",
+    # Ship frame-stacked observations as unique frames from the workers,
+    # needs the on_sample_end hook of callbacks.CustomCallbacks
+    "dedup_frame_stack": False,
+    # Normalize rewards, bootstrap and run GAE per fragment on the rollout workers
+    "worker_side_postprocessing": False,
+    # Sample the next batch while learning on the current one, with weights
+    # at most max_sample_staleness updates old
+    "overlap_sampling": False,
+    "max_sample_staleness": 1,
+    # Precision of the weights sent to the rollout workers: "float32",
+    # "float16" or "bfloat16"
+    "weight_sync_dtype": "float32",
+    # "split" writes the weights as a memory mappable file and the training
+    # state as a side file, in the background, see common/checkpoint.py
+    "checkpoint_format": "pickle",
+    # Time the phases of learn_on_batch (CUDA events on gpu), reported in the
+    # train results under "profile", and optionally as a Chrome trace file
+    "profile_phases": False,
+    "profile_trace_path": None,
+    # Chunk size for re-evaluating the aux replay, 0 uses max_minibatch_size
+    "aux_eval_chunk_size": 0,
+    # Aux replay storage: "memory", "memmap", "newest_frame" (rebuilds frame
+    # stacks from the newest frames on read) or "newest_frame_memmap"
+    "replay_storage": "memory",
+    # Directory for the memmap files, None uses the system temp dir
+    "replay_storage_dir": None,
+    # Policy phase precision: False, "fp16" (True) or "bf16", see common/mixed_precision.py
     "pi_phase_mixed_precision": False,
+    # Convert the model's conv weights to channels-last, the layout of the
+    # NHWC observations, for faster convs (mostly on tensor cores)
+    "channels_last": False,
     "aux_num_accumulates": 1,
+    # Aux phase minibatches: "legacy" (RetuneSelector.make_minibatches) or
+    # "streaming" (shuffled once per epoch, gathered in replay order by a
+    # prefetch thread), see common/replay_sampler.py
+    "aux_sampler": "legacy",
+    # Streaming sampler with flattened_buffer: consecutive observations (same
+    # step, neighbouring envs) shuffled together, 1 shuffles them one by one
+    "aux_sampler_block_size": 1,
+    # Streaming sampler: replay segments kept on the gpu for the whole aux phase
+    "aux_device_cache_segments": 0,
+    # Data-parallel learner processes, each trains on a share of every minibatch
+    # and gradients are all-reduced, see common/data_parallel.py. The batch and
+    # aux replay are shared files in replay_storage_dir (use a tmpfs like /dev/shm)
+    "num_learners": 1,
+    # torch.distributed backend of the learners, "gloo" (cpu or gpu) or "nccl"
+    "learner_backend": "gloo",
 })
 # __sphinx_doc_end__
 # yapf: enable
@@ -107,4 +161,5 @@ DEFAULT_CONFIG = with_common_config({
 PPGTrainer = build_trainer(
     name="PPGExperimentalAgent",
     default_config=DEFAULT_CONFIG,
-    default_policy=CustomTorchPolicy)
+    default_policy=CustomTorchPolicy,
+    after_optimizer_step=sync_worker_postprocessing)
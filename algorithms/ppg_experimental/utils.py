@@ -8,36 +8,21 @@ import torch.distributions as td
 from functools import partial
 import itertools
 
-def calculate_gae_buffer(values_buffer, dones_buffer, rewards_buffer, last_values, gamma, lam):
-    new_returns = np.empty_like(values_buffer)
-    lastgaelam = 0
-    nsegs, nsteps = values_buffer.shape[:2]
-    for s in reversed(range(nsegs)):
-        mb_values = values_buffer[s]
-        mb_rewards = rewards_buffer[s]
-        mb_dones = dones_buffer[s]
-        mb_returns, _ = calculate_gae(mb_values, mb_dones, mb_rewards, 
-                                      last_values, gamma, lam)
-        new_returns[s] = mb_returns
-        last_values = mb_values[0]
-    return new_returns
-
-        
-def calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam):
-    lastgaelam = 0
-    nsteps = mb_values.shape[0]
-    mb_advs = np.empty_like(mb_values)
-    for t in reversed(range(nsteps)):
-        if t == nsteps - 1:
-            nextvalues = last_values
-        else:
-            nextvalues = mb_values[t+1]
-        nextnonterminal = 1.0 - mb_dones[t]
-        delta = mb_rewards[t] + gamma * nextvalues * nextnonterminal - mb_values[t]
-        mb_advs[t] = lastgaelam = delta + gamma * lam * nextnonterminal * lastgaelam
-    mb_returns = mb_advs + mb_values
-    return mb_returns, mb_advs
-
+from ..common.augment import BatchAugmenter
+from ..common.batched_eval import ChunkedEvaluator
+from ..common.data_parallel import DataParallelLearners, SharedArrays
+from ..common.episode_stats import add_episode_columns, completed_episodes
+from ..common.frame_dedup import decode_frame_stacks
+from ..common.gae import calculate_gae, calculate_gae_buffer
+from ..common.minibatch_loader import MinibatchLoader
+from ..common.mixed_precision import MixedPrecision
+from ..common.profiler import PhaseProfiler
+from ..common.replay_sampler import ReplaySampler
+from ..common.replay_storage import make_replay_storage, NewestFrameReplay
+from ..common.reward_norm import RewardNormalizer, RunningMeanStd, update_mean_var_count_from_moments
+from ..common.weight_sync import WeightSyncChannel
+from ..common.worker_postprocessing import (WorkerPostprocessor, NORMALIZED_REWARDS, DISCOUNTED_RETURNS,
+                                           BOOTSTRAP_VALUE, VALUE_TARGETS)
 
 def _make_categorical(x, ncat, shape):
     x = x.reshape((x.shape[0], shape, ncat))
@@ -139,14 +124,18 @@ def flatten012(arr):
 
     
 class RetuneSelector:
-    def __init__(self, nenvs, ob_space, ac_space, replay_shape, skips = 0, n_pi = 32, num_retunes = 5, flat_buffer=False):
+    def __init__(self, nenvs, ob_space, ac_space, replay_shape, skips = 0, n_pi = 32, num_retunes = 5, flat_buffer=False,
+                 storage="memory", storage_dir=None, allocate=None):
+        """ allocate(name, shape, dtype) places the replay arrays, e.g. in SharedArrays for data-parallel learners """
         self.skips = skips
         self.n_pi = n_pi
         self.nenvs = nenvs
         
-        self.exp_replay = np.empty((*replay_shape, *ob_space.shape), dtype=np.uint8)
-        self.dones_replay = np.empty((*replay_shape,), dtype=np.bool)
-        self.rewards_replay = np.empty((*replay_shape,), dtype=np.float32)
+        arrays = allocate or (lambda name, shape, dtype: np.empty(shape, dtype=dtype))
+        self.dones_replay = arrays("dones_replay", replay_shape, np.bool)
+        self.rewards_replay = arrays("rewards_replay", replay_shape, np.float32)
+        self.exp_replay = make_replay_storage(storage, replay_shape, ob_space, self.dones_replay, directory=storage_dir,
+                                              allocate=allocate)
         
         self.replay_shape = replay_shape
         
@@ -179,13 +168,25 @@ class RetuneSelector:
         self.replay_index = 0
         
         
-    def make_minibatches(self, presleep_pi, returns_buffer, num_rollouts):
+    def refresh(self):
+        """ Drops what was derived from the replay, after another process wrote to it """
+        if isinstance(self.exp_replay, NewestFrameReplay):
+            self.exp_replay.refresh()
+        
+    def make_minibatches(self, presleep_pi, returns_buffer, num_rollouts, rng=np.random, shard=None):
+            """ shard=(rank, num_learners) yields only that learner's share of every minibatch """
+            def share(inds):
+                if shard is None:
+                    return inds
+                rank, num_learners = shard
+                return inds[len(inds) * rank // num_learners:len(inds) * (rank + 1) // num_learners]
+            
             if not self.flat_buffer:
                 env_segs = list(itertools.product(range(self.n_pi), range(self.nenvs)))
-                np.random.shuffle(env_segs)
+                rng.shuffle(env_segs)
                 env_segs = np.array(env_segs)
                 for idx in range(0, len(env_segs), num_rollouts):
-                    esinds = env_segs[idx:idx+num_rollouts]
+                    esinds = share(env_segs[idx:idx+num_rollouts])
                     mbatch = [flatten01(arr[esinds[:,0], : , esinds[:,1]]) 
                               for arr in (self.exp_replay, returns_buffer, presleep_pi)]
                     yield mbatch
@@ -193,60 +194,12 @@ class RetuneSelector:
                 nsteps = returns_buffer.shape[1]
                 buffsize = self.n_pi * nsteps * self.nenvs
                 inds = np.arange(buffsize)
-                np.random.shuffle(inds)
+                rng.shuffle(inds)
                 batchsize = num_rollouts * nsteps
                 for start in range(0, buffsize, batchsize):
                     end = start+batchsize
-                    mbinds = inds[start:end]
+                    mbinds = share(inds[start:end])
                     mbatch = [flatten012(arr)[mbinds] 
                               for arr in (self.exp_replay, returns_buffer, presleep_pi)]
                     
                     yield mbatch
-   
-        
-class RewardNormalizer(object):
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
-    def __init__(self, gamma=0.99, cliprew=10.0, epsilon=1e-8):
-        self.epsilon = epsilon
-        self.gamma = gamma
-        self.ret_rms = RunningMeanStd(shape=())
-        self.cliprew = cliprew
-        self.ret = 0. # size updates after first pass
-        
-    def normalize(self, rews, news, resetrew):
-        self.ret = self.ret * self.gamma + rews
-        self.ret_rms.update(self.ret)
-        rews = np.clip(rews / np.sqrt(self.ret_rms.var + self.epsilon), -self.cliprew, self.cliprew)
-        if resetrew:
-            self.ret[np.array(news, dtype=bool)] = 0. ## Values should be True of False to set positional index
-        return rews
-    
-class RunningMeanStd(object):
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
-    def __init__(self, epsilon=1e-4, shape=()):
-        self.mean = np.zeros(shape, 'float64')
-        self.var = np.ones(shape, 'float64')
-        self.count = epsilon
-
-    def update(self, x):
-        batch_mean = np.mean(x, axis=0)
-        batch_var = np.var(x, axis=0)
-        batch_count = x.shape[0]
-        self.update_from_moments(batch_mean, batch_var, batch_count)
-
-    def update_from_moments(self, batch_mean, batch_var, batch_count):
-        self.mean, self.var, self.count = update_mean_var_count_from_moments(
-            self.mean, self.var, self.count, batch_mean, batch_var, batch_count)
-
-def update_mean_var_count_from_moments(mean, var, count, batch_mean, batch_var, batch_count):
-    delta = batch_mean - mean
-    tot_count = count + batch_count
-
-    new_mean = mean + delta * batch_count / tot_count
-    m_a = var * count
-    m_b = batch_var * batch_count
-    M2 = m_a + m_b + np.square(delta) * count * batch_count / tot_count
-    new_var = M2 / tot_count
-    new_count = tot_count
-
-    return new_mean, new_var, new_count
\ No newline at end of file
@@ -35,6 +35,8 @@ class CustomTorchPolicy(TorchPolicy):
                         framework="torch",
                         device=self.device,
                      )
+        if self.config['channels_last']:
+            self.model.to(memory_format=torch.channels_last)
 
         TorchPolicy.__init__(
             self,
@@ -47,6 +49,12 @@ class CustomTorchPolicy(TorchPolicy):
         )
         
         self.framework = "torch"
+        self.weight_sync = WeightSyncChannel(self.config['weight_sync_dtype'])
+        self.loaded_model_weights = None
+        self.worker_postprocessor = WorkerPostprocessor(self.config['gamma'], self.config['lambda'],
+                                                        self.config['standardize_rewards'],
+                                                        self.config['return_reset'], self.config['scale_reward'],
+                                                        cliprew=self.config['env_config']['return_max'])
 
     
     def init_training(self):
@@ -89,10 +97,24 @@ class CustomTorchPolicy(TorchPolicy):
         self.save_success = 0
         self.retunes_completed = 0
         self.amp_scaler = GradScaler()
+        self.pi_phase_precision = MixedPrecision(self.device, self.config['pi_phase_mixed_precision'], self.amp_scaler)
+        self.minibatch_loader = MinibatchLoader(self.device, mode=self.config['minibatch_loader'])
+        self.augmenter = BatchAugmenter(self.device, num_choices=3, seed=self.config['augment_seed'])
         
     def to_tensor(self, arr):
         return torch.from_numpy(arr).to(self.device)
     
+    @override(TorchPolicy)
+    def postprocess_trajectory(self, sample_batch, other_agent_batches=None, episode=None):
+        sample_batch = add_episode_columns(sample_batch)
+        if self.config['worker_side_postprocessing']:
+            value_fn = lambda obs: self.model.vf_pi(obs, ret_numpy=True, no_grad=True, to_torch=True)[0]
+            sample_batch = self.worker_postprocessor(sample_batch, episode, value_fn)
+        return sample_batch
+    
+    def worker_postprocessor_state(self):
+        return {"gamma": self.gamma, "ret_rms": self.rewnorm.ret_rms}
+    
     @override(TorchPolicy)
     def extra_action_out(self, input_dict, state_batches, model, action_dist):
         return {'values': model._value.tolist()}
@@ -111,6 +133,8 @@ class CustomTorchPolicy(TorchPolicy):
         Reference: https://github.com/ray-project/ray/blob/master/rllib/policy/policy.py#L279-L316
         """
         
+        samples = decode_frame_stacks(samples)
+        
         ## Config data values
         nbatch = self.nbatch
         nbatch_train = self.mem_limited_batch_size 
@@ -121,49 +145,47 @@ class CustomTorchPolicy(TorchPolicy):
         mb_dones = unroll(samples['dones'], ts)
         
         ## Reward Normalization - No reward norm works well for many envs
-        if self.config['standardize_rewards']:
+        if self.config['worker_side_postprocessing']:
+            # Normalized and scaled on the workers
+            mb_rewards = unroll(samples[NORMALIZED_REWARDS], ts)
+            if self.config['standardize_rewards']:
+                self.rewnorm.ret_rms.update(samples[DISCOUNTED_RETURNS])
+        elif self.config['standardize_rewards']:
             mb_origrewards = unroll(samples['rewards'], ts)
-            mb_rewards =  np.zeros_like(mb_origrewards)
-            mb_rewards[0] = self.rewnorm.normalize(mb_origrewards[0], self.last_dones, 
-                                                   self.config["return_reset"])
-            for ii in range(1, nsteps):
-                mb_rewards[ii] = self.rewnorm.normalize(mb_origrewards[ii], mb_dones[ii-1],
-                                                       self.config["return_reset"])
+            mb_news = np.concatenate([self.last_dones[None], mb_dones[:-1]])
+            mb_rewards = self.rewnorm.normalize_block(mb_origrewards, mb_news, self.config["return_reset"],
+                                                      backend=self.config['gae_backend'], device=self.device)
             self.last_dones = mb_dones[-1]
         else:
             mb_rewards = unroll(samples['rewards'], ts)
         
         # Weird hack that helps in many envs (Yes keep it after reward normalization)
         rew_scale = self.config["scale_reward"]
-        if rew_scale != 1.0:
+        if rew_scale != 1.0 and not self.config['worker_side_postprocessing']:
             mb_rewards *= rew_scale
         
         should_skip_train_step = self.best_reward_model_select(samples)
         if should_skip_train_step:
             self.update_batch_time()
             return {} # Not doing last optimization step - This is intentional due to noisy gradients
+        self.weight_sync.mark_changed()
           
         obs = samples['obs']
 
-        ## Value prediction
-        next_obs = unroll(samples['new_obs'], ts)[-1]
-        last_values, _ = self.model.vf_pi(next_obs, ret_numpy=True, no_grad=True, to_torch=True)
         values = samples['values']
-        
-        ## GAE
-        mb_values = unroll(values, ts)
-        mb_returns = np.zeros_like(mb_rewards)
-        mb_advs = np.zeros_like(mb_rewards)
-        lastgaelam = 0
-        for t in reversed(range(nsteps)):
-            if t == nsteps - 1:
-                nextvalues = last_values
-            else:
-                nextvalues = mb_values[t+1]
-            nextnonterminal = 1.0 - mb_dones[t]
-            delta = mb_rewards[t] + gamma * nextvalues * nextnonterminal - mb_values[t]
-            mb_advs[t] = lastgaelam = delta + gamma * lam * nextnonterminal * lastgaelam
-        mb_returns = mb_advs + mb_values
+        if self.config['worker_side_postprocessing']:
+            returns = samples[VALUE_TARGETS]
+        else:
+            ## Value prediction
+            next_obs = unroll(samples['new_obs'], ts)[-1]
+            last_values, _ = self.model.vf_pi(next_obs, ret_numpy=True, no_grad=True, to_torch=True)
+            
+            ## GAE
+            mb_values = unroll(values, ts)
+            mb_returns, mb_advs = calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam,
+                                                backend=self.config['gae_backend'], device=self.device,
+                                                use_float64=self.config['gae_float64'])
+            returns = roll(mb_returns)
         
         ## Data from config
         cliprange, vfcliprange = self.config['clip_param'], self.config['vf_clip_param']
@@ -176,11 +198,12 @@ class CustomTorchPolicy(TorchPolicy):
         neglogpacs = -samples['action_logp'] ## np.isclose seems to be True always, otherwise compute again if needed
         noptepochs = self.config['num_sgd_iter']
         actions = samples['actions']
-        returns = roll(mb_returns)
         
         ## Train multiple epochs
         optim_count = 0
         inds = np.arange(nbatch)
+        # Advantages are renormalized every epoch and set on the loader below
+        self.minibatch_loader.set_batch(obs, returns, actions, values, neglogpacs, None)
         for _ in range(noptepochs):
             np.random.shuffle(inds)
             normalized_advs = returns - values
@@ -190,14 +213,13 @@ class CustomTorchPolicy(TorchPolicy):
                 mbinds = inds[start:end]
                 advs_batch = normalized_advs[mbinds].copy()
                 normalized_advs[mbinds] = (advs_batch - np.mean(advs_batch)) / (np.std(advs_batch) + 1e-8) 
-            for start in range(0, nbatch, nbatch_train):
-                end = start + nbatch_train
-                mbinds = inds[start:end]
-                slices = (self.to_tensor(arr[mbinds]) for arr in (obs, returns, actions, values, neglogpacs, normalized_advs))
+            self.minibatch_loader.update_array(5, normalized_advs)
+            for slices in self.minibatch_loader.minibatches(inds, nbatch_train):
                 optim_count += 1
                 apply_grad = (optim_count % self.accumulate_train_batches) == 0
                 self._batch_train(apply_grad, self.accumulate_train_batches,
                                   lrnow, cliprange, vfcliprange, max_grad_norm, ent_coef, vf_coef_now, *slices)
+        self.minibatch_loader.release()
         
         ## Distill with augmentation
         should_retune = self.retune_selector.update(obs, self.exp_replay)
@@ -224,47 +246,31 @@ class CustomTorchPolicy(TorchPolicy):
         
         for g in self.optimizer.param_groups:
             g['lr'] = lr
-        vpred, pi_logits = self.model.vf_pi(obs, ret_numpy=False, no_grad=False, to_torch=False)
-        neglogpac = neglogp_actions(pi_logits, actions)
-        entropy = torch.mean(pi_entropy(pi_logits))
+        with self.pi_phase_precision.autocast():
+            _, pi_logits = self.model.vf_pi(obs, ret_numpy=False, no_grad=False, to_torch=False)
+            # The value loss only trains the trunk, the value head is trained on the detached latent
+            vpred, det_value = route_head(self.model.value_fc, self.model._latent)
+            vpred, det_value = vpred.squeeze(1), det_value.squeeze(1)
+            neglogpac = neglogp_actions(pi_logits, actions)
+            entropy = torch.mean(pi_entropy(pi_logits))
 
-        vpredclipped = values + torch.clamp(vpred - values, -vfcliprange, vfcliprange)
-        vf_losses1 = torch.pow((vpred - returns), 2)
-        vf_losses2 = torch.pow((vpredclipped - returns), 2)
-        vf_loss = .5 * torch.mean(torch.max(vf_losses1, vf_losses2))
+            vpredclipped = values + torch.clamp(vpred - values, -vfcliprange, vfcliprange)
+            vf_losses1 = torch.pow((vpred - returns), 2)
+            vf_losses2 = torch.pow((vpredclipped - returns), 2)
+            vf_loss = .5 * torch.mean(torch.max(vf_losses1, vf_losses2))
 
-        ratio = torch.exp(neglogpac_old - neglogpac)
-        pg_losses1 = -advs * ratio
-        pg_losses2 = -advs * torch.clamp(ratio, 1-cliprange, 1+cliprange)
-        pg_loss = torch.mean(torch.max(pg_losses1, pg_losses2))
+            ratio = torch.exp(neglogpac_old - neglogpac)
+            pg_losses1 = -advs * ratio
+            pg_losses2 = -advs * torch.clamp(ratio, 1-cliprange, 1+cliprange)
+            pg_loss = torch.mean(torch.max(pg_losses1, pg_losses2))
 
-        loss = pg_loss - entropy * ent_coef + vf_loss * vf_coef
-        loss = loss / num_accumulate
-        
-        # Weird hack to remove vf_loss grad and only keep det_value_loss grad
-        if self.model.value_fc.weight.grad is not None:
-            self.value_fc_old_grads = [self.model.value_fc.weight.grad.clone(), self.model.value_fc.bias.grad.clone()]
-        else:
-            self.value_fc_old_grads = None
-        loss.backward()
-        
-        self.model.value_fc.zero_grad() 
-        
-        latent = self.model._detached_latent
-        det_value = self.model.value_fc(latent).squeeze(1)
-        det_value_loss = .5 * torch.pow((det_value - returns), 2).mean()
-        det_value_loss.backward()
-        
-        if self.value_fc_old_grads is not None:
-            self.model.value_fc.weight.grad += self.value_fc_old_grads[0]
-            self.model.value_fc.bias.grad += self.value_fc_old_grads[1]
+            loss = pg_loss - entropy * ent_coef + vf_loss * vf_coef
+            loss = loss / num_accumulate
+            det_value_loss = .5 * torch.pow((det_value - returns), 2).mean()
         
+        self.pi_phase_precision.backward(loss + det_value_loss)
         if apply_grad:
-            nn.utils.clip_grad_norm_(self.model.parameters(), max_grad_norm)
-            self.optimizer.step()
-            self.optimizer.zero_grad()
-            
-            self.model.value_fc.zero_grad() # Needed for value fc grad hack
+            self.pi_phase_precision.step([self.optimizer], max_grad_norm)
             
         
         
@@ -301,12 +307,7 @@ class CustomTorchPolicy(TorchPolicy):
         self.retune_selector.retune_done()
  
     def tune_policy(self, apply_grad, obs, target_vf, target_pi, retune_vf_loss_coeff):
-        obs_aug = np.empty(obs.shape, obs.dtype)
-        aug_idx = np.random.randint(3, size=len(obs))
-        obs_aug[aug_idx == 0] = pad_and_random_crop(obs[aug_idx == 0], 64, 10)
-        obs_aug[aug_idx == 1] = random_cutout_color(obs[aug_idx == 1], 10, 30)
-        obs_aug[aug_idx == 2] = obs[aug_idx == 2]
-        obs_aug = self.to_tensor(obs_aug)
+        obs_aug = self.augmenter(self.to_tensor(obs))
         with torch.no_grad():
             tpi_log_softmax = nn.functional.log_softmax(target_pi, dim=1)
             tpi_softmax = torch.exp(tpi_log_softmax)
@@ -340,12 +341,12 @@ class CustomTorchPolicy(TorchPolicy):
         self.timesteps_total += self.nbatch
         
         ## Best reward model selection
-        eprews = [info['episode']['r'] for info in samples['infos'] if 'episode' in info]
+        eprews, _ = completed_episodes(samples)
         self.reward_deque.extend(eprews)
         mean_reward = safe_mean(eprews) if len(eprews) >= 100 else safe_mean(self.reward_deque)
         if self.best_reward < mean_reward:
             self.best_reward = mean_reward
-            self.best_weights = self.get_weights()["current_weights"]
+            self.best_weights = self.get_model_weights()
             self.best_rew_tsteps = self.timesteps_total
            
         if self.timesteps_total > self.target_timesteps or (self.time_elapsed + self.buffer_time) > self.max_time:
@@ -375,8 +376,8 @@ class CustomTorchPolicy(TorchPolicy):
     
     def update_gamma(self, samples):
         if self.config['adaptive_gamma']:
-            epinfobuf = [info['episode'] for info in samples['infos'] if 'episode' in info]
-            self.maxrewep_lenbuf.extend([epinfo['l'] for epinfo in epinfobuf if epinfo['r'] >= self.max_reward])
+            eprews, eplens = completed_episodes(samples)
+            self.maxrewep_lenbuf.extend(eplens[eprews >= self.max_reward])
             sorted_nth = lambda buf, n: np.nan if len(buf) < 100 else sorted(self.maxrewep_lenbuf.copy())[n]
             target_horizon = sorted_nth(self.maxrewep_lenbuf, 80)
             self.gamma = self.adaptive_discount_tuner.update(target_horizon)
@@ -418,19 +419,29 @@ class CustomTorchPolicy(TorchPolicy):
         self.last_dones = custom_state_vars["last_dones"]
         self.retunes_completed = custom_state_vars["retunes_completed"]
     
+    def get_model_weights(self):
+        return {k: v.cpu().detach().numpy() for k, v in self.model.state_dict().items()}
+    
     @override(TorchPolicy)
     def get_weights(self):
-        weights = {}
-        weights["current_weights"] = {
-            k: v.cpu().detach().numpy()
-            for k, v in self.model.state_dict().items()
-        }
-        return weights
-        
+        """ Sync payload for the rollout workers, see common/weight_sync.py """
+        return self.weight_sync.payload(self.model.state_dict())
     
     @override(TorchPolicy)
     def set_weights(self, weights):
-        self.set_model_weights(weights["current_weights"])
+        if "current_weights" in weights:
+            self.set_model_weights(weights["current_weights"])
+            return
+        acting_weights = convert_to_torch_tensor(self.weight_sync.unpack(weights), device=self.device)
+        self.model.load_state_dict(acting_weights, strict=False)
+    
+    @override(TorchPolicy)
+    def get_state(self):
+        return {"current_weights": self.get_model_weights()}
+    
+    @override(TorchPolicy)
+    def set_state(self, state):
+        self.set_model_weights(state["current_weights"])
         
     def set_optimizer_state(self, optimizer_state, amp_scaler_state):
         optimizer_state = convert_to_torch_tensor(optimizer_state, device=self.device)
@@ -440,5 +451,9 @@ class CustomTorchPolicy(TorchPolicy):
         self.amp_scaler.load_state_dict(amp_scaler_state)
         
     def set_model_weights(self, model_weights):
+        # Loading the same dict again (best weights on skipped steps) changes nothing
+        if model_weights is not self.loaded_model_weights:
+            self.weight_sync.mark_changed()
+        self.loaded_model_weights = model_weights
         model_weights = convert_to_torch_tensor(model_weights, device=self.device)
         self.model.load_state_dict(model_weights)
\ No newline at end of file
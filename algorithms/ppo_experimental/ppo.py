@@ -4,6 +4,7 @@ from ray.rllib.agents import with_common_config
 from .custom_torch_policy import CustomTorchPolicy
 # from ray.rllib.agents.trainer_template import build_trainer
 from .custom_trainer_template import build_trainer
+from ..common.worker_postprocessing import sync_worker_postprocessing
 
 
 logger = logging.getLogger(__name__)
@@ -89,7 +90,35 @@ DEFAULT_CONFIG = with_common_config({
     "scale_reward": 1.0,
     "return_reset": True,
     "aux_phase_mixed_precision": False,
+    # Policy phase precision: False, "fp16" (True) or "bf16", see common/mixed_precision.py
+    "pi_phase_mixed_precision": False,
+    # Convert the model's conv weights to channels-last, the layout of the
+    # NHWC observations, for faster convs (mostly on tensor cores)
+    "channels_last": False,
     "max_time": 100000000,
+    # GAE and reward normalization engine, "numpy" or "torch" (runs on the policy device)
+    "gae_backend": "numpy",
+    "gae_float64": False,
+    # Seed for the aux phase augmentations, None draws a random seed
+    "augment_seed": None,
+    # "pinned" gathers minibatches into pinned buffers and prefetches them,
+    # "device" uploads the whole batch once (needs room for it on the gpu)
+    "minibatch_loader": "pinned",
+    # Ship frame-stacked observations as unique frames from the workers,
+    # needs the on_sample_end hook of callbacks.CustomCallbacks
+    "dedup_frame_stack": False,
+    # Normalize rewards, bootstrap and run GAE per fragment on the rollout workers
+    "worker_side_postprocessing": False,
+    # Sample the next batch while learning on the current one, with weights
+    # at most max_sample_staleness updates old
+    "overlap_sampling": False,
+    "max_sample_staleness": 1,
+    # Precision of the weights sent to the rollout workers: "float32",
+    # "float16" or "bfloat16"
+    "weight_sync_dtype": "float32",
+    # "split" writes the weights as a memory mappable file and the training
+    # state as a side file, in the background, see common/checkpoint.py
+    "checkpoint_format": "pickle",
 })
 # __sphinx_doc_end__
 # yapf: enable
@@ -98,4 +127,5 @@ DEFAULT_CONFIG = with_common_config({
 PPOTrainer = build_trainer(
     name="PPOExperimental",
     default_config=DEFAULT_CONFIG,
-    default_policy=CustomTorchPolicy)
+    default_policy=CustomTorchPolicy,
+    after_optimizer_step=sync_worker_postprocessing)
@@ -5,6 +5,18 @@ from skimage.util import view_as_windows
 
 torch, nn = try_import_torch()
 
+from ..common.augment import BatchAugmenter
+from ..common.episode_stats import add_episode_columns, completed_episodes
+from ..common.frame_dedup import decode_frame_stacks
+from ..common.gae import calculate_gae
+from ..common.loss_combiner import route_head
+from ..common.minibatch_loader import MinibatchLoader
+from ..common.mixed_precision import MixedPrecision
+from ..common.reward_norm import RewardNormalizer, RunningMeanStd, update_mean_var_count_from_moments
+from ..common.weight_sync import WeightSyncChannel
+from ..common.worker_postprocessing import (WorkerPostprocessor, NORMALIZED_REWARDS, DISCOUNTED_RETURNS,
+                                           BOOTSTRAP_VALUE, VALUE_TARGETS)
+
 def neglogp_actions(pi_logits, actions):
     return nn.functional.cross_entropy(pi_logits, actions, reduction='none')
 
@@ -130,50 +142,3 @@ class RetuneSelector:
         
     def set_num_retunes(self, nr):
         self.num_retunes = nr
-
-class RewardNormalizer(object):
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
-    def __init__(self, gamma=0.99, cliprew=10.0, epsilon=1e-8):
-        self.epsilon = epsilon
-        self.gamma = gamma
-        self.ret_rms = RunningMeanStd(shape=())
-        self.cliprew = cliprew
-        self.ret = 0. # size updates after first pass
-        
-    def normalize(self, rews, news, reset_returns=True):
-        self.ret = self.ret * self.gamma + rews
-        self.ret_rms.update(self.ret)
-        rews = np.clip(rews / np.sqrt(self.ret_rms.var + self.epsilon), -self.cliprew, self.cliprew)
-        if reset_returns:
-            self.ret[np.array(news, dtype=bool)] = 0. ## Values should be True of False to set positional index
-        return rews
-    
-class RunningMeanStd(object):
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
-    def __init__(self, epsilon=1e-4, shape=()):
-        self.mean = np.zeros(shape, 'float64')
-        self.var = np.ones(shape, 'float64')
-        self.count = epsilon
-
-    def update(self, x):
-        batch_mean = np.mean(x, axis=0)
-        batch_var = np.var(x, axis=0)
-        batch_count = x.shape[0]
-        self.update_from_moments(batch_mean, batch_var, batch_count)
-
-    def update_from_moments(self, batch_mean, batch_var, batch_count):
-        self.mean, self.var, self.count = update_mean_var_count_from_moments(
-            self.mean, self.var, self.count, batch_mean, batch_var, batch_count)
-
-def update_mean_var_count_from_moments(mean, var, count, batch_mean, batch_var, batch_count):
-    delta = batch_mean - mean
-    tot_count = count + batch_count
-
-    new_mean = mean + delta * batch_count / tot_count
-    m_a = var * count
-    m_b = batch_var * batch_count
-    M2 = m_a + m_b + np.square(delta) * count * batch_count / tot_count
-    new_var = M2 / tot_count
-    new_count = tot_count
-
-    return new_mean, new_var, new_count
\ No newline at end of file
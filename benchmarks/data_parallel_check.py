@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Checks that data-parallel learners (common/data_parallel.py) end the PPG
+policy phase with the weights of a single learner trained on the whole
+minibatches, then times both
+
+Each learner is a process with its own copy of the model, training on its
+share of every minibatch with the gradients all-reduced over gloo, the same
+as with num_learners in the config. The single learner runs in this process.
+On a machine with few cores, the learners compete for them and the timing
+says little.
+
+Usage:
+    python -m benchmarks.data_parallel_check --num-learners 2 --batch-size 512
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from gym.spaces import Discrete
+
+from algorithms.common.data_parallel import LearnerGroup, _free_port
+from algorithms.common.minibatch_loader import MinibatchLoader
+from algorithms.common.mixed_precision import MixedPrecision
+from algorithms.common.profiler import PhaseProfiler
+from algorithms.ppg_experimental.custom_torch_ppg import CustomTorchPolicy as PPGPolicy
+from algorithms.ppg_experimental.utils import dist_build
+from benchmarks.fused_backward_check import (NUM_ACTIONS, OBS_SPACE, PPG_MODEL_CONFIG, CLIPRANGE, VFCLIPRANGE,
+                                             ENT_COEF, VF_COEF, LR, policy_stub)
+from models.impala_ppg import ImpalaCNN as PPGModel
+
+LOSS_ARGS = (CLIPRANGE, VFCLIPRANGE, 0.5, ENT_COEF, VF_COEF)
+
+
+def make_batch(nbatch, seed):
+    rng = np.random.RandomState(seed)
+    obs = rng.randint(0, 256, size=(nbatch, *OBS_SPACE.shape), dtype=np.uint8)
+    returns = rng.randn(nbatch).astype(np.float32)
+    actions = rng.randint(0, NUM_ACTIONS, size=nbatch)
+    values = returns + 0.1 * rng.randn(nbatch).astype(np.float32)
+    logp = (-np.log(NUM_ACTIONS) + 0.1 * rng.randn(nbatch)).astype(np.float32)
+    advs = rng.randn(nbatch).astype(np.float32)
+    return obs, returns, actions, values, logp, advs
+
+
+def make_policy(batch_size, learners, num_learners):
+    """
+    A policy with what _train_policy_phase uses, the parameter groups as in init_training
+    SGD instead of Adam: Adam's first steps are about lr for any gradient, so float
+    rounding in the all-reduce of near-zero gradients would show as lr sized differences
+    """
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+    model = PPGModel(OBS_SPACE, Discrete(NUM_ACTIONS), NUM_ACTIONS, PPG_MODEL_CONFIG, "ppg", device)
+    aux_params = set(model.aux_vf.parameters())
+    value_params = set(model.value_fc.parameters())
+    network_params = list(model.parameters())
+    aux_optim_params = [p for p in network_params if p not in value_params]
+    ppo_optim_params = [p for p in aux_optim_params if p not in aux_params]
+    return policy_stub(PPGPolicy, model=model, device=device, make_distr=dist_build(Discrete(NUM_ACTIONS)),
+                       config={"single_optimizer": False}, profiler=PhaseProfiler(device),
+                       pi_phase_precision=MixedPrecision(device, False, None),
+                       minibatch_loader=MinibatchLoader(device), mem_limited_batch_size=batch_size,
+                       accumulate_train_batches=1, num_learners=num_learners, learners=learners,
+                       optimizer=torch.optim.SGD(ppo_optim_params, lr=LR),
+                       aux_optimizer=torch.optim.SGD(aux_optim_params, lr=LR),
+                       value_optimizer=torch.optim.SGD([p for p in network_params if p in value_params], lr=LR))
+
+
+def train(policy, batch, epoch_inds):
+    lrs = policy._learning_rates()
+    start = time.perf_counter()
+    policy._train_policy_phase(epoch_inds, LOSS_ARGS, lrs, batch)
+    return time.perf_counter() - start
+
+
+def learner_main(rank, world_size, init_method, batch_size, batch, epoch_inds, results):
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+    dist.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size)
+    policy = make_policy(batch_size, LearnerGroup(rank, world_size), world_size)
+    seconds = train(policy, batch, epoch_inds)
+    if rank == 0:
+        results.put((seconds, {name: p.detach().numpy() for name, p in policy.model.named_parameters()}))
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def run(num_learners=2, batch_size=512, num_minibatches=4, epochs=1, seed=0):
+    nbatch = batch_size * num_minibatches
+    batch = make_batch(nbatch, seed)
+    rng = np.random.RandomState(seed)
+    epoch_inds = [rng.permutation(nbatch) for _ in range(epochs)]
+
+    single = make_policy(batch_size, None, 1)
+    single_seconds = train(single, batch, epoch_inds)
+
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+    init_method = "tcp://127.0.0.1:{}".format(_free_port())
+    processes = [ctx.Process(target=learner_main, args=(rank, num_learners, init_method, batch_size,
+                                                         batch, epoch_inds, results))
+                 for rank in range(num_learners)]
+    for process in processes:
+        process.start()
+    parallel_seconds, parallel_params = results.get()
+    for process in processes:
+        process.join()
+
+    max_diff, match = 0., True
+    for name, p in single.model.named_parameters():
+        reference = p.detach().numpy()
+        max_diff = max(max_diff, float(np.abs(reference - parallel_params[name]).max()))
+        match &= np.allclose(reference, parallel_params[name], rtol=1e-4, atol=1e-5)
+    return {"max_abs_diff": max_diff, "match": bool(match),
+            "single_ms": 1000 * single_seconds, "parallel_ms": 1000 * parallel_seconds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and time data-parallel learners on the policy phase.")
+    parser.add_argument("--num-learners", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--num-minibatches", type=int, default=4)
+    parser.add_argument("--epochs", type=int, default=1)
+    args = parser.parse_args()
+
+    res = run(args.num_learners, args.batch_size, args.num_minibatches, args.epochs)
+    print("weights after the policy phase {} (max abs diff {:.2e})".format(
+        "match" if res["match"] else "DIFFER", res["max_abs_diff"]))
+    print("single {:8.1f} ms  {} learners {:8.1f} ms  ({:.2f}x)".format(
+        res["single_ms"], args.num_learners, res["parallel_ms"], res["single_ms"] / res["parallel_ms"]))
+    if not res["match"]:
+        sys.exit(1)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Steps/sec of the frame stacking wrappers in envs/ on a fake procgen env,
+so only the wrapper cost is measured
+
+Usage:
+    python -m benchmarks.framestack_benchmark --steps 20000
+"""
+import argparse
+import time
+
+import gym
+import numpy as np
+from gym.spaces import Box, Discrete
+
+from envs.frame_stacked_procgen import FrameStackByChannels, FasterFrameStack2
+from envs.reduced_framestack import ReducedFrameStack
+from envs.ring_framestack import RingFrameStack
+
+
+class FakeProcgenEnv(gym.Env):
+    """ Procgen shaped env that cycles through pregenerated frames """
+    def __init__(self, episode_length=500, num_frames=64, seed=0):
+        self.observation_space = Box(low=0, high=255, shape=(64, 64, 3), dtype=np.uint8)
+        self.action_space = Discrete(15)
+        self.episode_length = episode_length
+        rng = np.random.RandomState(seed)
+        self._frames = rng.randint(0, 256, size=(num_frames, 64, 64, 3), dtype=np.uint8)
+        self._t = 0
+
+    def reset(self, **kwargs):
+        self._t = 0
+        return self._frames[0]
+
+    def step(self, action):
+        self._t += 1
+        obs = self._frames[self._t % len(self._frames)]
+        return obs, 0.0, self._t >= self.episode_length, {}
+
+
+WRAPPERS = {
+    "FrameStackByChannels": lambda env, k: FrameStackByChannels(env, k),
+    "FasterFrameStack2": lambda env, k: FasterFrameStack2(env) if k == 2 else None,
+    "ReducedFrameStack": lambda env, k: ReducedFrameStack(env, k),
+    "RingFrameStack": lambda env, k: RingFrameStack(env, k),
+    "RingFrameStack(view)": lambda env, k: RingFrameStack(env, k, copy_obs=False),
+}
+
+
+def steps_per_sec(env, nsteps):
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(nsteps):
+        _, _, done, _ = env.step(0)
+        if done:
+            env.reset()
+    return nsteps / (time.perf_counter() - start)
+
+
+def run(nsteps=20000, stacks=(2, 4)):
+    results = {}
+    for k in stacks:
+        for name, make in WRAPPERS.items():
+            env = make(FakeProcgenEnv(), k)
+            if env is not None:
+                results["k{}/{}".format(k, name)] = steps_per_sec(env, nsteps)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark frame stacking wrappers.")
+    parser.add_argument("--steps", type=int, default=20000)
+    args = parser.parse_args()
+
+    baseline = steps_per_sec(FakeProcgenEnv(), args.steps)
+    print("{:<28} {:>12.0f} steps/s".format("no wrapper", baseline))
+    for key, sps in run(args.steps).items():
+        print("{:<28} {:>12.0f} steps/s".format(key, sps))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Checks that the single backward of the policy phase gives every optimizer's
+parameters the same gradients as the separate backward passes it replaced,
+then times both
+
+PPG: loss.backward() then vf_loss.backward(), against one backward of the sum
+PPO: backward, value head grads cloned and zeroed, a second backward on the
+     detached latent and the clones added back, against route_head and one
+     backward (common/loss_combiner.py)
+
+Gradients are accumulated over two minibatches, as with accumulate_train_batches,
+so grads left over from an earlier minibatch are covered too.
+
+Usage:
+    python -m benchmarks.fused_backward_check --batch-size 256
+"""
+import argparse
+import copy
+import sys
+import time
+
+import numpy as np
+import torch
+from gym.spaces import Box, Discrete
+
+from algorithms.common.mixed_precision import MixedPrecision
+from algorithms.common.profiler import PhaseProfiler
+from algorithms.ppg_experimental.custom_torch_ppg import CustomTorchPolicy as PPGPolicy
+from algorithms.ppg_experimental.utils import dist_build
+from algorithms.ppo_experimental.custom_torch_policy import CustomTorchPolicy as PPOPolicy
+from algorithms.ppo_experimental.utils import neglogp_actions, pi_entropy
+from models.impala_ppg import ImpalaCNN as PPGModel
+from models.impala_ppo_experimental import ImpalaCNN as PPOModel
+
+NUM_ACTIONS = 15
+OBS_SPACE = Box(low=0, high=255, shape=(64, 64, 6), dtype=np.uint8)
+# Shapes from experiments/ppg-experimental.yaml and ppo-experimental.yaml
+PPG_MODEL_CONFIG = {"custom_model_config": {"depths": [32, 64, 64], "nlatents": 512, "init_normed": True,
+                                            "use_layernorm": False, "diff_framestack": True}}
+PPO_MODEL_CONFIG = {"custom_model_config": {"depths": [32, 64, 64], "nlatents": 512, "use_layernorm": True,
+                                            "diff_framestack": True, "d2rl": False}}
+CLIPRANGE, VFCLIPRANGE, ENT_COEF, VF_COEF, LR = 0.2, 0.2, 0.01, 0.5, 5e-4
+NUM_ACCUMULATE = 2
+
+
+def make_minibatch(batch_size, device, rng):
+    obs = torch.from_numpy(rng.randint(0, 256, size=(batch_size, *OBS_SPACE.shape), dtype=np.uint8))
+    returns = torch.from_numpy(rng.randn(batch_size).astype(np.float32))
+    actions = torch.from_numpy(rng.randint(0, NUM_ACTIONS, size=batch_size))
+    values = returns + 0.1 * torch.from_numpy(rng.randn(batch_size).astype(np.float32))
+    logp_old = float(-np.log(NUM_ACTIONS)) + 0.1 * torch.from_numpy(rng.randn(batch_size).astype(np.float32))
+    advs = torch.from_numpy(rng.randn(batch_size).astype(np.float32))
+    return [t.to(device) for t in (obs, returns, actions, values, logp_old, advs)]
+
+
+def policy_stub(policy_cls, **attributes):
+    """ A policy with just the attributes its policy phase methods use, without building it """
+    policy = policy_cls.__new__(policy_cls)
+    policy.__dict__.update(attributes)
+    return policy
+
+
+def gradients(model):
+    return {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+
+
+def compare(groups, reference, fused, rtol=1e-4, atol=1e-6):
+    """ Max abs difference per parameter group, and whether all gradients match """
+    diffs, match = {}, reference.keys() == fused.keys()
+    for group, names in groups.items():
+        diff = 0.
+        for name in names:
+            if name in reference and name in fused:
+                diff = max(diff, (reference[name] - fused[name]).abs().max().item())
+                match &= torch.allclose(reference[name], fused[name], rtol=rtol, atol=atol)
+        diffs[group] = diff
+    return diffs, match
+
+
+def time_steps(step, model, minibatches, repeats):
+    step(minibatches)  # warmup
+    times = []
+    for _ in range(repeats):
+        model.zero_grad()
+        start = time.perf_counter()
+        step(minibatches)
+        if minibatches[0][0].is_cuda:
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - start) / len(minibatches))
+    return float(np.median(times))
+
+
+def check_ppg(device, minibatches, repeats):
+    torch.manual_seed(0)
+    model = PPGModel(OBS_SPACE, Discrete(NUM_ACTIONS), NUM_ACTIONS, PPG_MODEL_CONFIG, "ppg", device).to(device)
+    fused_model = copy.deepcopy(model)
+    make_distr = dist_build(Discrete(NUM_ACTIONS))
+    legacy = policy_stub(PPGPolicy, model=model, make_distr=make_distr)
+    fused = policy_stub(PPGPolicy, model=fused_model, make_distr=make_distr, config={"single_optimizer": False},
+                        profiler=PhaseProfiler(device), pi_phase_precision=MixedPrecision(device, False, None))
+    loss_args = (CLIPRANGE, VFCLIPRANGE, None, ENT_COEF, VF_COEF)
+
+    def legacy_step(minibatches):
+        for minibatch in minibatches:
+            loss, vf_loss = PPGPolicy._calc_pi_vf_loss(legacy, False, NUM_ACCUMULATE, *loss_args, *minibatch)
+            loss.backward()
+            vf_loss.backward()
+
+    def fused_step(minibatches):
+        for minibatch in minibatches:
+            PPGPolicy._batch_train(fused, False, NUM_ACCUMULATE, *loss_args, *minibatch)
+
+    legacy_step(minibatches)
+    fused_step(minibatches)
+    # The parameters of the pi (and aux) optimizer and of the value optimizer in init_training
+    value_names = ["value_fc." + name for name, _ in model.value_fc.named_parameters()]
+    groups = {"pi": [name for name, _ in model.named_parameters() if name not in value_names],
+              "value": value_names}
+    diffs, match = compare(groups, gradients(model), gradients(fused_model))
+    return {"max_abs_diff": diffs, "match": match,
+            "legacy_ms": 1000 * time_steps(legacy_step, model, minibatches, repeats),
+            "fused_ms": 1000 * time_steps(fused_step, fused_model, minibatches, repeats)}
+
+
+def legacy_ppo_batch_train(model, obs, returns, actions, values, neglogpac_old, advs):
+    """ The PPO policy phase backward before route_head """
+    vpred, pi_logits = model.vf_pi(obs, ret_numpy=False, no_grad=False, to_torch=False)
+    neglogpac = neglogp_actions(pi_logits, actions)
+    entropy = torch.mean(pi_entropy(pi_logits))
+    vpredclipped = values + torch.clamp(vpred - values, -VFCLIPRANGE, VFCLIPRANGE)
+    vf_loss = .5 * torch.mean(torch.max(torch.pow((vpred - returns), 2), torch.pow((vpredclipped - returns), 2)))
+    ratio = torch.exp(neglogpac_old - neglogpac)
+    pg_loss = torch.mean(torch.max(-advs * ratio, -advs * torch.clamp(ratio, 1 - CLIPRANGE, 1 + CLIPRANGE)))
+    loss = (pg_loss - entropy * ENT_COEF + vf_loss * VF_COEF) / NUM_ACCUMULATE
+
+    if model.value_fc.weight.grad is not None:
+        value_fc_old_grads = [model.value_fc.weight.grad.clone(), model.value_fc.bias.grad.clone()]
+    else:
+        value_fc_old_grads = None
+    loss.backward()
+    model.value_fc.zero_grad()
+    det_value = model.value_fc(model._latent.detach()).squeeze(1)
+    det_value_loss = .5 * torch.pow((det_value - returns), 2).mean()
+    det_value_loss.backward()
+    if value_fc_old_grads is not None:
+        model.value_fc.weight.grad += value_fc_old_grads[0]
+        model.value_fc.bias.grad += value_fc_old_grads[1]
+
+
+def check_ppo(device, minibatches, repeats):
+    torch.manual_seed(0)
+    model = PPOModel(OBS_SPACE, Discrete(NUM_ACTIONS), NUM_ACTIONS, PPO_MODEL_CONFIG, "ppo", device).to(device)
+    fused_model = copy.deepcopy(model)
+    fused = policy_stub(PPOPolicy, model=fused_model, optimizer=torch.optim.Adam(fused_model.parameters(), lr=LR),
+                        pi_phase_precision=MixedPrecision(device, False, None))
+    # The PPO policy phase takes -logp, neglogpacs in learn_on_batch
+    minibatches = [mb[:4] + [-mb[4]] + mb[5:] for mb in minibatches]
+
+    def legacy_step(minibatches):
+        for minibatch in minibatches:
+            legacy_ppo_batch_train(model, *minibatch)
+
+    def fused_step(minibatches):
+        for minibatch in minibatches:
+            PPOPolicy._batch_train(fused, False, NUM_ACCUMULATE, LR, CLIPRANGE, VFCLIPRANGE, None,
+                                   ENT_COEF, VF_COEF, *minibatch)
+
+    legacy_step(minibatches)
+    fused_step(minibatches)
+    value_names = ["value_fc." + name for name, _ in model.value_fc.named_parameters()]
+    groups = {"trunk_and_pi": [name for name, _ in model.named_parameters() if name not in value_names],
+              "value": value_names}
+    diffs, match = compare(groups, gradients(model), gradients(fused_model))
+    return {"max_abs_diff": diffs, "match": match,
+            "legacy_ms": 1000 * time_steps(legacy_step, model, minibatches, repeats),
+            "fused_ms": 1000 * time_steps(fused_step, fused_model, minibatches, repeats)}
+
+
+def run(batch_size=256, device="cpu", repeats=5, seed=0):
+    device = torch.device(device)
+    rng = np.random.RandomState(seed)
+    minibatches = [make_minibatch(batch_size, device, rng) for _ in range(NUM_ACCUMULATE)]
+    return {"ppg": check_ppg(device, minibatches, repeats), "ppo": check_ppo(device, minibatches, repeats)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and time the fused policy phase backward.")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    results = run(args.batch_size, args.device, args.repeats)
+    for name, res in results.items():
+        print("{}: gradients {}".format(name, "match" if res["match"] else "DIFFER"))
+        for group, diff in res["max_abs_diff"].items():
+            print("    {:<14} max abs diff {:.2e}".format(group, diff))
+        print("    legacy {:8.2f} ms  fused {:8.2f} ms per minibatch  ({:.2f}x)".format(
+            res["legacy_ms"], res["fused_ms"], res["legacy_ms"] / res["fused_ms"]))
+    if not all(res["match"] for res in results.values()):
+        sys.exit(1)
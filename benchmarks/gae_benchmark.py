@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the shared GAE engine against the per-step python loop
+the policies used before, on the shapes of experiments/ppg-experimental.yaml
+
+Usage:
+    python -m benchmarks.gae_benchmark --repeats 20
+"""
+import argparse
+import time
+
+import numpy as np
+
+from algorithms.common.gae import calculate_gae, calculate_gae_buffer, torch
+
+
+def legacy_calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam):
+    lastgaelam = 0
+    nsteps = mb_values.shape[0]
+    mb_advs = np.empty_like(mb_values)
+    for t in reversed(range(nsteps)):
+        if t == nsteps - 1:
+            nextvalues = last_values
+        else:
+            nextvalues = mb_values[t+1]
+        nextnonterminal = 1.0 - mb_dones[t]
+        delta = mb_rewards[t] + gamma * nextvalues * nextnonterminal - mb_values[t]
+        mb_advs[t] = lastgaelam = delta + gamma * lam * nextnonterminal * lastgaelam
+    mb_returns = mb_advs + mb_values
+    return mb_returns, mb_advs
+
+
+def legacy_calculate_gae_buffer(values_buffer, dones_buffer, rewards_buffer, last_values, gamma, lam):
+    new_returns = np.empty_like(values_buffer)
+    nsegs = values_buffer.shape[0]
+    for s in reversed(range(nsegs)):
+        mb_returns, _ = legacy_calculate_gae(values_buffer[s], dones_buffer[s], rewards_buffer[s],
+                                             last_values, gamma, lam)
+        new_returns[s] = mb_returns
+        last_values = values_buffer[s][0]
+    return new_returns
+
+
+def make_data(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    values = rng.randn(*shape).astype(np.float32)
+    dones = rng.rand(*shape) < 0.01
+    rewards = (rng.rand(*shape) < 0.02).astype(np.float32) * 10
+    last_values = rng.randn(shape[-1]).astype(np.float32)
+    return values, dones, rewards, last_values
+
+
+def time_fn(fn, repeats):
+    fn() # warmup, includes jit compilation
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def run(nsteps=256, nenvs=112, n_pi=32, repeats=10, gamma=0.996, lam=0.95):
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    results = {}
+
+    rollout = make_data((nsteps, nenvs))
+    buffer = make_data((n_pi, nsteps, nenvs))
+    cases = {
+        "rollout": (rollout, legacy_calculate_gae, lambda *a, **kw: calculate_gae(*a, **kw)[0]),
+        "buffer": (buffer, legacy_calculate_gae_buffer, calculate_gae_buffer),
+    }
+    for name, (data, legacy_fn, new_fn) in cases.items():
+        reference = legacy_fn(*data, gamma, lam)
+        reference = reference[0] if isinstance(reference, tuple) else reference
+        results[name + "/legacy"] = time_fn(lambda: legacy_fn(*data, gamma, lam), repeats)
+        for backend in ("numpy", "torch"):
+            for use_float64 in (False, True):
+                key = "{}/{}{}".format(name, backend, "_f64" if use_float64 else "")
+                fn = lambda: new_fn(*data, gamma, lam, backend=backend, device=device, use_float64=use_float64)
+                assert np.allclose(fn(), reference, atol=1e-4), key
+                results[key] = time_fn(fn, repeats)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark GAE implementations.")
+    parser.add_argument("--nsteps", type=int, default=256)
+    parser.add_argument("--nenvs", type=int, default=112)
+    parser.add_argument("--n-pi", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    results = run(args.nsteps, args.nenvs, args.n_pi, args.repeats)
+    for key, sec in results.items():
+        legacy = results[key.split("/")[0] + "/legacy"]
+        print("{:<24} {:>10.3f} ms {:>8.1f}x".format(key, sec * 1000, legacy / sec))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the PPG experimental training hot paths, on cpu, with
+no ray cluster, gpu, network or procgen install needed
+
+The policy is built from experiments/ppg-experimental.yaml as the trainer
+would (scaled down to --num-envs envs and --n-pi rollouts in the aux
+replay, and to --aux-mbsize rollouts per aux minibatch and
+--max-minibatch-size observations per policy minibatch, so the defaults
+stay within a few GB of memory on a cpu-only machine), and trained on synthetic SampleBatches of the real per-step
+shapes. Each stage is timed on its own with the policy's own components:
+GAE, reward normalization, minibatch slicing, model forward/backward,
+augmentation, an epoch of aux minibatches with the legacy and the streaming
+sampler, the aux phase and env wrapper stepping (on a fake procgen
+env), plus whole learn_on_batch calls broken down with the phase profiler.
+
+Results are written as JSON, and --compare checks them against an earlier
+run and exits with status 1 if a stage got slower than --tolerance allows.
+
+Usage:
+    python -m benchmarks.hot_path_benchmark --out bench.json
+    python -m benchmarks.hot_path_benchmark --compare bench.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import types
+
+if __name__ == "__main__":
+    # Hide the gpu before torch is imported, the policy picks cuda when it sees one
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+import numpy as np
+import yaml
+from gym.spaces import Box, Discrete
+
+PROCGEN_ENV_NAMES = ["bigfish", "bossfight", "caveflyer", "chaser", "climber", "coinrun", "dodgeball",
+                     "fruitbot", "heist", "jumper", "leaper", "maze", "miner", "ninja", "plunder", "starpilot"]
+
+
+def _stub_procgen():
+    """ Stand-in procgen module, so the wrappers in envs/ import without procgen installed """
+    try:
+        import procgen.env  # noqa: F401
+    except ImportError:
+        procgen = types.ModuleType("procgen")
+        procgen.ProcgenEnv = None
+        procgen.env = types.ModuleType("procgen.env")
+        procgen.env.ENV_NAMES = PROCGEN_ENV_NAMES
+        sys.modules["procgen"] = procgen
+        sys.modules["procgen.env"] = procgen.env
+
+
+_stub_procgen()
+
+from ray.rllib.policy.sample_batch import SampleBatch
+from ray.tune.utils import merge_dicts
+
+import models.impala_ppg  # noqa: F401, registers impala_torch_ppg
+from algorithms.common.episode_stats import EPISODE_RETURN, EPISODE_LENGTH
+from algorithms.common.gae import calculate_gae, calculate_gae_buffer, torch
+from algorithms.common.replay_sampler import ReplaySampler
+from algorithms.ppg_experimental.ppg import DEFAULT_CONFIG
+from algorithms.ppg_experimental.custom_torch_ppg import CustomTorchPolicy
+from algorithms.ppg_experimental.utils import unroll
+from benchmarks.framestack_benchmark import FakeProcgenEnv
+from envs.frame_stacked_procgen import FrameStackByChannels, FasterFrameStack2
+from envs.reward_monitor import RewardMonitor
+
+NUM_ACTIONS = 15
+
+
+def load_config(config_file, num_envs, n_pi, retune_epochs, aux_mbsize=1, max_minibatch_size=256,
+                rollout_fragment_length=256):
+    with open(config_file) as f:
+        experiment = next(iter(yaml.safe_load(f).values()))
+    config = merge_dicts(DEFAULT_CONFIG, experiment["config"])
+    # One worker with num_envs envs gives the learner batches of num_envs * rollout_fragment_length
+    config.update(num_workers=1, num_envs_per_worker=num_envs, n_pi=n_pi,
+                  retune_epochs=retune_epochs, profile_phases=True, profile_trace_path=None,
+                  aux_mbsize=aux_mbsize, max_minibatch_size=max_minibatch_size,
+                  rollout_fragment_length=rollout_fragment_length)
+    return config
+
+
+def make_policy(config):
+    frame_stack = config["env_config"]["frame_stack"]
+    obs_space = Box(low=0, high=255, shape=(64, 64, 3 * frame_stack), dtype=np.uint8)
+    policy = CustomTorchPolicy(obs_space, Discrete(NUM_ACTIONS), config)
+    policy.init_training()
+    return policy
+
+
+def make_sample_batch(config, obs_shape, seed=0):
+    """ A learner batch of synthetic rollouts, env major like the concatenated worker fragments """
+    rng = np.random.RandomState(seed)
+    nbatch = config["num_envs_per_worker"] * config["rollout_fragment_length"]
+    obs = rng.randint(0, 256, size=(nbatch, *obs_shape), dtype=np.uint8)
+    logits = rng.randn(nbatch, NUM_ACTIONS).astype(np.float32)
+    logp = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+    actions = rng.randint(0, NUM_ACTIONS, size=nbatch)
+    return SampleBatch({
+        "obs": obs,
+        # Only the last step of each env is read, for the bootstrap value
+        "new_obs": obs,
+        "actions": actions,
+        "action_logp": logp[np.arange(nbatch), actions],
+        "values": rng.randn(nbatch).astype(np.float32),
+        "rewards": (rng.rand(nbatch) < 0.02).astype(np.float32) * config["env_config"]["return_max"],
+        "dones": rng.rand(nbatch) < 0.005,
+        EPISODE_RETURN: np.zeros(nbatch, dtype=np.float32),
+        EPISODE_LENGTH: np.zeros(nbatch, dtype=np.int32),
+    })
+
+
+def time_fn(fn, repeats):
+    fn()  # warmup
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {"median_ms": 1000 * times[len(times) // 2], "min_ms": 1000 * times[0], "repeats": repeats}
+
+
+def bench_stages(policy, samples, repeats, env_steps):
+    config = policy.config
+    nsteps = config["rollout_fragment_length"]
+    nenvs = policy.nbatch // nsteps
+    ts = (nenvs, nsteps)
+    gamma, lam = policy.gamma, config["lambda"]
+    gae_kwargs = dict(backend=config["gae_backend"], device=policy.device, use_float64=config["gae_float64"])
+
+    mb_dones = unroll(samples["dones"], ts)
+    mb_rewards = unroll(samples["rewards"], ts)
+    mb_values = unroll(samples["values"], ts)
+    last_values = mb_values[-1]
+    mb_news = np.concatenate([np.zeros((1, nenvs), dtype=bool), mb_dones[:-1]])
+    replay_shape = (config["n_pi"], nsteps, nenvs)
+    buffer = [np.broadcast_to(arr, replay_shape).copy() for arr in (mb_values, mb_dones, mb_rewards)]
+
+    arrays = [samples[k] for k in ("obs", "values", "actions", "values", "action_logp", "values")]
+    inds = np.arange(policy.nbatch)
+    loader = policy.minibatch_loader
+
+    def minibatch_slicing():
+        loader.set_batch(*arrays)
+        np.random.shuffle(inds)
+        for _ in loader.minibatches(inds, policy.mem_limited_batch_size):
+            pass
+        loader.release()
+
+    # Copied, the loader reuses its minibatch buffers
+    loader.set_batch(*arrays)
+    train_slices = [t.clone() for t in next(iter(loader.minibatches(inds, policy.mem_limited_batch_size)))]
+    loader.release()
+    loss_args = (config["clip_param"], config["vf_clip_param"], config["grad_clip"],
+                 policy.ent_coef, config["vf_loss_coeff"])
+
+    aux_batch_size = config["aux_mbsize"] * nsteps
+    aux_obs = policy.to_tensor(samples["obs"][:aux_batch_size])
+
+    # One epoch of aux minibatches on the device, from the replay of the policy
+    replay, aux_pi = policy.retune_selector.exp_replay, np.zeros((*replay_shape, NUM_ACTIONS), dtype=np.float32)
+    sampler = ReplaySampler(policy.device, replay_shape, flat_buffer=config["flattened_buffer"],
+                            block_size=config["aux_sampler_block_size"],
+                            device_cache_segments=config["aux_device_cache_segments"])
+
+    def aux_sampling_legacy():
+        for slices in policy.retune_selector.make_minibatches(aux_pi, buffer[0], config["aux_mbsize"]):
+            [policy.to_tensor(arr) for arr in slices]
+
+    def aux_sampling_streaming():
+        sampler.set_replay(replay, buffer[0], aux_pi)
+        for _ in sampler.minibatches(config["aux_mbsize"], np.random):
+            pass
+        sampler.release()
+
+    frame_stack = config["env_config"]["frame_stack"]
+    env = RewardMonitor(FakeProcgenEnv())
+    env = FasterFrameStack2(env) if frame_stack == 2 else FrameStackByChannels(env, frame_stack)
+
+    def env_stepping():
+        for _ in range(env_steps):
+            _, _, done, _ = env.step(0)
+            if done:
+                env.reset()
+
+    env.reset()
+    stages = {
+        "gae": lambda: calculate_gae(mb_values, mb_dones, mb_rewards, last_values, gamma, lam, **gae_kwargs),
+        "gae_aux_buffer": lambda: calculate_gae_buffer(*buffer, last_values, gamma, lam, **gae_kwargs),
+        "reward_normalization": lambda: policy.rewnorm.normalize_block(mb_rewards, mb_news, config["reset_returns"],
+                                                                        backend=config["gae_backend"],
+                                                                        device=policy.device),
+        "minibatch_slicing": minibatch_slicing,
+        "forward_backward": lambda: policy._batch_train(True, 1, *loss_args, *train_slices),
+        "augmentation": lambda: policy.augmenter(aux_obs),
+        "aux_sampling_legacy": aux_sampling_legacy,
+        "aux_sampling_streaming": aux_sampling_streaming,
+        "aux_phase": policy.aux_train,
+        "env_stepping": env_stepping,
+    }
+    results = {}
+    for name, fn in stages.items():
+        results[name] = time_fn(fn, repeats)
+    results["env_stepping"]["steps_per_sec"] = 1000 * env_steps / results["env_stepping"]["median_ms"]
+    return results
+
+
+def bench_learn_on_batch(policy, samples, iterations):
+    """ Whole learn_on_batch calls, the aux phase runs on every n_pi-th, with the mean ms of each phase per call """
+    policy.learn_on_batch(samples)  # warmup
+    policy.profiler.collect()
+    n_pi = policy.config["n_pi"]
+    iterations = max(n_pi, iterations // n_pi * n_pi)
+    for _ in range(iterations):
+        policy.learn_on_batch(samples)
+    profile = policy.profiler.collect()
+    result = {"iterations": iterations,
+              "phase_ms_per_call": {name: ms / iterations for name, ms in profile["phase_ms"].items()}}
+    result.update(profile.get("per_learn_second", {}))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(config_file, num_envs=16, n_pi=2, retune_epochs=1, repeats=5, iterations=4, env_steps=2000,
+        threads=None, seed=0, aux_mbsize=1, max_minibatch_size=256, rollout_fragment_length=256):
+    if threads:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    config = load_config(config_file, num_envs, n_pi, retune_epochs, aux_mbsize, max_minibatch_size,
+                         rollout_fragment_length)
+    config["augment_seed"] = seed
+    policy = make_policy(config)
+    samples = make_sample_batch(config, policy.observation_space.shape, seed)
+    # Fills the aux replay, for the aux phase stage
+    for _ in range(n_pi):
+        policy.learn_on_batch(samples)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "config_file": config_file,
+            "device": str(policy.device),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "batch_size": policy.nbatch,
+            "minibatch_size": policy.mem_limited_batch_size,
+            "replay_shape": list(policy.retune_selector.replay_shape),
+            "retune_epochs": retune_epochs,
+            "aux_mbsize": aux_mbsize,
+        },
+        "stages": bench_stages(policy, samples, repeats, env_steps),
+        "learn_on_batch": bench_learn_on_batch(policy, samples, iterations),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Prints the change of each stage, returns the stages more than tolerance slower than the baseline """
+    regressions = []
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        ratio = stage["median_ms"] / baseline["stages"][name]["median_ms"]
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(name)
+        print("{:<24} {:>10.3f} ms {:>10.3f} ms {:>+8.1%}{}".format(
+            name, baseline["stages"][name]["median_ms"], stage["median_ms"], ratio - 1,
+            "  REGRESSION" if slower else ""))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-f", "--config-file", default="experiments/ppg-experimental.yaml")
+    parser.add_argument("--num-envs", type=int, default=16,
+                        help="Envs in the learner batch, of rollout_fragment_length steps each.")
+    parser.add_argument("--n-pi", type=int, default=2, help="Rollouts in the aux replay.")
+    parser.add_argument("--retune-epochs", type=int, default=1)
+    parser.add_argument("--aux-mbsize", type=int, default=1,
+                        help="Rollouts per aux minibatch, the config's 4 needs several GB more on cpu.")
+    parser.add_argument("--max-minibatch-size", type=int, default=256,
+                        help="Observations per policy phase forward/backward.")
+    parser.add_argument("--rollout-fragment-length", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=4, help="learn_on_batch calls to profile.")
+    parser.add_argument("--env-steps", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads, fix it to compare runs.")
+    parser.add_argument("--out", default=None, help="JSON output file, printed otherwise.")
+    parser.add_argument("--compare", default=None, help="JSON output of an earlier run.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Slowdown of a stage's median time reported as a regression.")
+    args = parser.parse_args()
+
+    results = run(args.config_file, args.num_envs, args.n_pi, args.retune_epochs, args.repeats,
+                  args.iterations, args.env_steps, args.threads, aux_mbsize=args.aux_mbsize,
+                  max_minibatch_size=args.max_minibatch_size,
+                  rollout_fragment_length=args.rollout_fragment_length)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            sys.exit(1)
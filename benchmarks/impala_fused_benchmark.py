@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Checks models/impala_ppg_fused.py against models/impala_ppg.py on the same
+weights, then times forward (inference) and forward+backward of both
+
+Usage:
+    python -m benchmarks.impala_fused_benchmark --batch-sizes 256 2048 --device cpu
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from gym.spaces import Box, Discrete
+
+from models.impala_ppg import ImpalaCNN
+from models.impala_ppg_fused import FusedImpalaCNN
+
+MODEL_CONFIG = {
+    "custom_model_config": {
+        "depths": [32, 64, 64],
+        "nlatents": 512,
+        "init_normed": True,
+        "use_layernorm": False,
+        "diff_framestack": True,
+    }
+}
+
+
+def make_models(device, compile_mode="none", seed=0):
+    obs_space = Box(low=0, high=255, shape=(64, 64, 6), dtype=np.uint8)
+    action_space = Discrete(15)
+    config = {"custom_model_config": dict(MODEL_CONFIG["custom_model_config"], compile=compile_mode)}
+    torch.manual_seed(seed)
+    reference = ImpalaCNN(obs_space, action_space, 15, config, "reference", device).to(device)
+    fused = FusedImpalaCNN(obs_space, action_space, 15, config, "fused", device).to(device)
+    fused.load_state_dict(reference.state_dict())
+    return reference, fused
+
+
+def max_abs_diff(reference, fused, obs):
+    with torch.no_grad():
+        ref_logits, _ = reference.forward({"obs": obs}, None, None)
+        ref_value = reference.value_function()
+        logits, _ = fused.forward({"obs": obs}, None, None)
+        value = fused.value_function()
+    return max((ref_logits - logits).abs().max().item(), (ref_value - value).abs().max().item())
+
+
+def time_forward(model, obs, repeats, backward=False):
+    def step():
+        if backward:
+            logits, _ = model.forward({"obs": obs}, None, None)
+            (logits.sum() + model.value_function().sum()).backward()
+        else:
+            with torch.no_grad():
+                model.forward({"obs": obs}, None, None)
+    step()  # warmup, and compiles the fused trunk
+    if obs.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if obs.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def run(batch_sizes=(256, 2048), device="cpu", compile_mode="none", repeats=10, tolerance=1e-4):
+    device = torch.device(device)
+    reference, fused = make_models(device, compile_mode)
+    results = {}
+    for batch_size in batch_sizes:
+        obs = torch.randint(0, 256, (batch_size, 64, 64, 6), dtype=torch.uint8, device=device)
+        diff = max_abs_diff(reference, fused, obs)
+        assert diff < tolerance, "Fused model differs from ImpalaCNN by {}".format(diff)
+        results[batch_size] = {
+            "max_abs_diff": diff,
+            "reference_forward": time_forward(reference, obs, repeats),
+            "fused_forward": time_forward(fused, obs, repeats),
+            "reference_backward": time_forward(reference, obs, repeats, backward=True),
+            "fused_backward": time_forward(fused, obs, repeats, backward=True),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the fused ImpalaCNN.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[256, 2048])
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--compile", default="none", choices=["none", "trace", "compile"])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    for batch_size, res in run(args.batch_sizes, args.device, args.compile, args.repeats).items():
+        print("batch {:>5}  max abs diff {:.2e}".format(batch_size, res["max_abs_diff"]))
+        for phase in ("forward", "backward"):
+            ref, fused = res["reference_" + phase], res["fused_" + phase]
+            print("    {:<9} reference {:8.2f} ms  fused {:8.2f} ms  ({:.2f}x)".format(
+                phase, ref * 1e3, fused * 1e3, ref / fused))
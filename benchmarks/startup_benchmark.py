@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Startup time of registering everything (load_envs, load_models and all the
+algorithms, as train.py and rollout.py did) against registering only what an
+experiment uses (load_experiment_assets, skipping the unused framework).
+Each is timed in a fresh interpreter, like a new ray worker.
+
+Usage:
+    python -m benchmarks.startup_benchmark -f experiments/ppg-experimental.yaml --repeats 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+EAGER = """
+import time
+start = time.perf_counter()
+from utils.loader import load_envs, load_models, load_algorithms, load_preprocessors
+from ray.rllib.utils.framework import try_import_tf, try_import_torch
+try_import_tf()
+try_import_torch()
+load_envs(".")
+load_models(".")
+from algorithms import CUSTOM_ALGORITHMS
+load_algorithms(CUSTOM_ALGORITHMS)
+from preprocessors import CUSTOM_PREPROCESSORS
+load_preprocessors(CUSTOM_PREPROCESSORS)
+print(time.perf_counter() - start)
+"""
+
+LAZY = """
+import time
+start = time.perf_counter()
+from utils.loader import experiments_from_argv, skip_unused_frameworks, load_experiment_assets
+experiments = experiments_from_argv(["-f", {config_file!r}])
+skip_unused_frameworks(experiments)
+import ray.rllib
+from algorithms import CUSTOM_ALGORITHMS
+from preprocessors import CUSTOM_PREPROCESSORS
+load_experiment_assets(experiments, CUSTOM_ALGORITHMS, CUSTOM_PREPROCESSORS, ".")
+print(time.perf_counter() - start)
+"""
+
+LOADED_FRAMEWORKS = """
+import sys
+print(",".join(name for name in ("tensorflow", "torch", "keras", "skimage") if name in sys.modules))
+"""
+
+
+def time_startup(code, repeats):
+    times, frameworks = [], None
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", code + LOADED_FRAMEWORKS], stdout=subprocess.PIPE,
+                             check=True, universal_newlines=True, cwd=os.getcwd()).stdout.split("\n")
+        times.append(float(out[0]))
+        frameworks = out[1]
+    times.sort()
+    return {"median_s": times[len(times) // 2], "min_s": times[0], "imported": frameworks}
+
+
+def run(config_file, repeats):
+    return {
+        "config_file": config_file,
+        "eager": time_startup(EAGER, repeats),
+        "lazy": time_startup(LAZY.format(config_file=config_file), repeats),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-f", "--config-file", default="experiments/ppg-experimental.yaml")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.config_file, args.repeats), indent=2))
@@ -10,6 +10,8 @@ from ray.rllib.agents.callbacks import DefaultCallbacks
 
 import numpy as np
 
+from algorithms.common.frame_dedup import encode_frame_stacks
+
 class CustomCallbacks(DefaultCallbacks):
     """
     Please refer to : 
@@ -39,7 +41,10 @@ class CustomCallbacks(DefaultCallbacks):
                 metrics for the episode.
             kwargs: Forward compatibility placeholder.
         """
-        pass
+        # Hands the discounted return of the env slot on to the new episode
+        for policy in policies.values():
+            if policy.config.get("worker_side_postprocessing", False):
+                policy.worker_postprocessor.start_episode(episode)
 
     def on_episode_step(self, worker: RolloutWorker, base_env: BaseEnv,
                         episode: MultiAgentEpisode, **kwargs):
@@ -115,7 +120,9 @@ class CustomCallbacks(DefaultCallbacks):
                 object to modify the samples generated.
             kwargs: Forward compatibility placeholder.
         """
-        pass
+        # Decoded in the policy's learn_on_batch
+        if worker.policy_config.get("dedup_frame_stack", False) and isinstance(samples, SampleBatch):
+            encode_frame_stacks(samples)
 
     def on_train_result(self, trainer, result: dict, **kwargs):
         """Called at the end of Trainable.train().
@@ -125,12 +132,16 @@ class CustomCallbacks(DefaultCallbacks):
                 You can mutate this object to add additional metrics.
             kwargs: Forward compatibility placeholder.
         """
-        # In this case we also print the mean timesteps throughput
-        # for easier reference in the logs
-        # print("=============================================================")
-        # print(" Timesteps Throughput : {} ts/sec".format(TBD))
-        # print("=============================================================")
+        if result.get('time_this_iter_s'):
+            result['env_steps_per_sec'] = result['timesteps_this_iter'] / result['time_this_iter_s']
         trainer_policy = trainer.get_policy()
+        # Per-phase learner timings, with profile_phases in the config
+        profiler = getattr(trainer_policy, 'profiler', None)
+        if profiler is not None and profiler.enabled:
+            profile = profiler.collect()
+            result['profile'] = profile
+            if 'learner_samples' in profile.get('per_learn_second', {}):
+                result['learner_samples_per_sec'] = profile['per_learn_second']['learner_samples']
         result['current_lr'] = trainer_policy.lr
         result['current_gamma'] = trainer_policy.gamma
         result['entropy_coef'] = trainer_policy.ent_coef
@@ -7,6 +7,7 @@ from ray.tune import registry
 
 from envs.procgen_env_wrapper import ProcgenEnvWrapper
 from envs.reward_monitor import RewardMonitor
+from envs.procgen_vector_env import make_procgen_vector_env
 
 class FrameStackByChannels(Wrapper):
     def __init__(self, env, num_stack):
@@ -55,7 +56,10 @@ class FasterFrameStack2(Wrapper):
         return self.stackedobs.copy()
     
 def maybe_framestack(config):
+    if config.get('vectorized_num_envs', 0) > 0:
+        return make_procgen_vector_env(config)
     config_copy = config.copy()
+    config_copy.pop('vectorized_num_envs', None)
     fs = config_copy.pop('frame_stack')
     if fs == 2:
         return FasterFrameStack2(RewardMonitor(ProcgenEnvWrapper(config_copy)))
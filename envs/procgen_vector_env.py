@@ -0,0 +1,114 @@
+import numpy as np
+
+from gym.spaces import Box
+from procgen import ProcgenEnv
+from procgen.env import ENV_NAMES as VALID_ENV_NAMES
+
+from ray.rllib.env.vector_env import VectorEnv
+from ray.tune import registry
+
+class ProcgenVectorEnv(VectorEnv):
+    """
+    RLlib VectorEnv over procgen's native vectorized env, which steps all
+    games in one C++ call instead of one gym env per game stepped from python
+
+    Reward monitoring and frame stacking are folded in as batched ops and
+    match RewardMonitor + FasterFrameStack2 / FrameStackByChannels per env:
+    - info['episode'] = {'r', 'l'} is added on the step an episode ends
+    - the stack holds the last `frame_stack` frames along channels and is
+      refilled with the current frame on reset_at
+
+    Procgen resets games on its own when they end, so the obs returned with
+    done=True is already the first frame of the next episode (same as the gym
+    env), and reset_at only has to restart the frame stack of that env.
+    """
+    def __init__(self, config, num_envs, frame_stack=1):
+        self._default_config = {
+            "num_levels" : 0,
+            "env_name" : "coinrun",
+            "start_level" : 0,
+            "paint_vel_info" : False,
+            "use_generated_assets" : False,
+            "center_agent" : True,
+            "use_sequential_levels" : False,
+            "distribution_mode" : "easy"
+        }
+        self.config = dict(self._default_config, **config)
+        for key in ("return_min", "return_blind", "return_max"):
+            self.config.pop(key, None)
+        env_name = self.config.pop("env_name")
+        assert env_name in VALID_ENV_NAMES
+
+        self.env = ProcgenEnv(num_envs=num_envs, env_name=env_name, **self.config)
+        self.num_envs = num_envs
+        self.frame_stack = frame_stack
+        self.action_space = self.env.action_space
+
+        wos = self.env.observation_space["rgb"]
+        h, w, c = wos.shape
+        self.observation_space = Box(low=np.tile(wos.low, frame_stack),
+                                     high=np.tile(wos.high, frame_stack), dtype=wos.dtype)
+
+        # Mirrored ring of frames per env, see envs/ring_framestack.py
+        self._c = c
+        self._buffer = np.zeros((num_envs, h, w, 2 * frame_stack * c), dtype=np.uint8)
+        self._slots = self._buffer.view('V{}'.format(c))
+        self._pixel = 'V{}'.format(c)
+        self._pos = 0
+        self._last_obs = None
+
+        self.epret = np.zeros(num_envs, dtype=np.float64)
+        self.eplen = np.zeros(num_envs, dtype=np.int64)
+
+    def _stacked(self):
+        start = (self._pos + 1) * self._c
+        window = self._buffer[..., start:start + self.frame_stack * self._c]
+        return np.ascontiguousarray(window)
+
+    def _restack(self, index, frame):
+        self._buffer[index] = np.tile(frame, 2 * self.frame_stack)
+
+    def vector_reset(self):
+        self._last_obs = self.env.reset()["rgb"]
+        for i in range(self.num_envs):
+            self._restack(i, self._last_obs[i])
+        self._pos = self.frame_stack - 1
+        self.epret[:] = 0
+        self.eplen[:] = 0
+        return self._stacked()
+
+    def reset_at(self, index):
+        self._restack(index, self._last_obs[index])
+        self.epret[index] = 0
+        self.eplen[index] = 0
+        start = (self._pos + 1) * self._c
+        return self._buffer[index, ..., start:start + self.frame_stack * self._c].copy()
+
+    def vector_step(self, actions):
+        obs, rews, dones, infos = self.env.step(np.asarray(actions))
+        self._last_obs = obs["rgb"]
+
+        self._pos = (self._pos + 1) % self.frame_stack
+        frames = np.ascontiguousarray(self._last_obs).view(self._pixel)[..., 0]
+        self._slots[..., self._pos] = frames
+        self._slots[..., self._pos + self.frame_stack] = frames
+
+        self.epret += rews
+        self.eplen += 1
+        for i in np.flatnonzero(dones):
+            infos[i]['episode'] = {'r': float(self.epret[i]), 'l': int(self.eplen[i])}
+        self.epret[dones] = 0
+        self.eplen[dones] = 0
+        return self._stacked(), rews, dones, infos
+
+    def get_unwrapped(self):
+        return []
+
+def make_procgen_vector_env(config):
+    config_copy = config.copy()
+    num_envs = config_copy.pop("vectorized_num_envs")
+    frame_stack = config_copy.pop("frame_stack", 1)
+    return ProcgenVectorEnv(config_copy, num_envs, frame_stack)
+
+# Register Env in Ray
+registry.register_env("procgen_vector_env", make_procgen_vector_env)
@@ -21,13 +21,12 @@ class RewardMonitor(Wrapper):
         observation, reward, done, info = self.env.step(action)
         self.epret += reward
         self.eplen += 1
-        newinfo = info.copy()
         if done:
-            epinfo = {'r': self.epret, 'l': self.eplen}
-            newinfo['episode'] = epinfo
+            # Only copy the info on episode ends, not on every step
+            info = dict(info, episode={'r': self.epret, 'l': self.eplen})
             self.epret = 0
             self.eplen = 0
-        return observation, reward, done, newinfo
+        return observation, reward, done, info
 
     
 registry.register_env(
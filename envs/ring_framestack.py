@@ -0,0 +1,74 @@
+import numpy as np
+
+from gym.spaces import Box
+from gym import Wrapper
+
+from ray.tune import registry
+
+from envs.procgen_env_wrapper import ProcgenEnvWrapper
+from envs.reward_monitor import RewardMonitor
+
+class RingFrameStack(Wrapper):
+    """
+    Stacks the last `num_stack` frames along channels, like FrameStackByChannels
+
+    Frames live in a preallocated (H, W, 2 * num_stack * C) uint8 buffer and every new
+    frame is written to slot i and its mirror i + num_stack, so the last num_stack
+    frames are always one contiguous window of slots, which is already laid out as
+    (H, W, num_stack * C). Nothing is rolled or shifted per step.
+
+    New frames are written as C-byte void pixels rather than C separate bytes,
+    which is what makes the interleaved writes cheap.
+
+    copy_obs=False returns the window view itself, it is only valid until the
+    next step/reset, use it when the caller copies the observation anyway.
+    """
+    def __init__(self, env, num_stack, copy_obs=True):
+        super().__init__(env)
+        self.num_stack = num_stack
+        self.copy_obs = copy_obs
+
+        wos = env.observation_space
+        assert wos.dtype == np.uint8 and len(wos.shape) == 3, "Only supports uint8 images"
+        h, w, c = wos.shape
+        low = np.tile(wos.low, num_stack)
+        high = np.tile(wos.high, num_stack)
+        self.observation_space = Box(low=low, high=high, dtype=wos.dtype)
+
+        self._c = c
+        self._buffer = np.zeros((h, w, 2 * num_stack * c), dtype=np.uint8)
+        self._slots = self._buffer.view('V{}'.format(c)) # (H, W, 2 * num_stack)
+        self._pixel = 'V{}'.format(c)
+        self._pos = 0
+
+    def _stacked(self):
+        start = (self._pos + 1) * self._c
+        window = self._buffer[..., start:start + self.num_stack * self._c]
+        if not self.copy_obs:
+            return window
+        return window.copy()
+
+    def _write(self, observation):
+        frame = np.ascontiguousarray(observation).view(self._pixel)[..., 0]
+        self._slots[..., self._pos] = frame
+        self._slots[..., self._pos + self.num_stack] = frame
+
+    def step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        self._pos = (self._pos + 1) % self.num_stack
+        self._write(observation)
+        return self._stacked(), reward, done, info
+
+    def reset(self, **kwargs):
+        observation = self.env.reset(**kwargs)
+        self._buffer[...] = np.tile(observation, 2 * self.num_stack)
+        self._pos = self.num_stack - 1
+        return self._stacked()
+
+def ring_framestack(config):
+    config_copy = config.copy()
+    fs = config_copy.pop('frame_stack')
+    return RingFrameStack(RewardMonitor(ProcgenEnvWrapper(config_copy)), fs)
+    
+# Register Env in Ray
+registry.register_env("ring_stacked_procgen", ring_framestack)
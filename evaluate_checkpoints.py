@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import ray
+from ray.tune.registry import get_trainable_cls
+
+from algorithms.common.checkpoint import load_checkpoint, restore_worker, \
+    worker_state as checkpoint_worker_state, WEIGHTS_SUFFIX
+from rollout import load_rollout_config, compute_batched_actions, \
+    _flatten_action, CUSTOM_ALGORITHMS, CUSTOM_PREPROCESSORS
+from utils.loader import load_experiment_assets
+
+"""
+Evaluates every checkpoint of an experiment on the same fixed set of
+episode seeds, to pick the best of the `keep_checkpoints_num` kept ones.
+
+Each checkpoint is read once on the driver, without its training state;
+its weights go to the object store and every evaluation actor loads them
+once. The episodes of a checkpoint are split into chunks that the actors
+pick up as they become free, and each actor plays its chunk with one
+batched forward pass per step. Results are cached under --cache-dir by a
+hash of the checkpoint files and the evaluation settings, so repeating a sweep only evaluates new checkpoints.
+"""
+
+EXAMPLE_USAGE = """
+Example Usage:
+
+python ./evaluate_checkpoints.py \
+    ~/ray_results/procgen-ppo/<experiment-name> \
+    --run PPGExperimental \
+    --episodes 1000 \
+    --num-actors 8
+"""
+
+
+def create_parser(parser_creator=None):
+    parser_creator = parser_creator or argparse.ArgumentParser
+    parser = parser_creator(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Evaluate all checkpoints of an experiment on a fixed "
+        "set of episode seeds.",
+        epilog=EXAMPLE_USAGE)
+
+    parser.add_argument(
+        "checkpoints",
+        type=str,
+        help="Directory searched recursively for checkpoints, or a glob of "
+        "checkpoint files or directories.")
+    required_named = parser.add_argument_group("required named arguments")
+    required_named.add_argument(
+        "--run",
+        type=str,
+        required=True,
+        help="The algorithm the checkpoints were trained with.")
+    parser.add_argument(
+        "--env", type=str, help="The gym environment to use, defaults to "
+        "the one in the checkpoint's params.pkl.")
+    parser.add_argument(
+        "--episodes",
+        default=100,
+        type=int,
+        help="Number of episodes per checkpoint.")
+    parser.add_argument(
+        "--seed",
+        default=0,
+        type=int,
+        help="Episode k is played with seed `seed + k`, the level for "
+        "procgen envs, for every checkpoint.")
+    parser.add_argument(
+        "--num-actors",
+        default=4,
+        type=int,
+        help="Number of evaluation processes.")
+    parser.add_argument(
+        "--chunk-size",
+        default=16,
+        type=int,
+        help="Episodes handed to an actor at a time, they are played "
+        "together as one batch.")
+    parser.add_argument(
+        "--config",
+        default="{}",
+        type=json.loads,
+        help="Algorithm-specific configuration, merged with the "
+        "checkpoint's params.pkl and `evaluation_config` like rollout.py.")
+    parser.add_argument(
+        "--cache-dir",
+        default="~/ray_results/evaluation_cache",
+        help="Directory of cached per-checkpoint results.")
+    parser.add_argument(
+        "--out",
+        default=None,
+        help="Summary table output (.csv or .json), next to the "
+        "checkpoints by default.")
+    return parser
+
+
+def find_checkpoints(pattern):
+    """Checkpoint files (the ones with a .tune_metadata next to them)"""
+    paths = glob.glob(os.path.expanduser(pattern))
+    checkpoints = set()
+    for path in paths:
+        if os.path.isdir(path):
+            metadata = glob.glob(
+                os.path.join(path, "**", "*.tune_metadata"), recursive=True)
+            checkpoints.update(m[:-len(".tune_metadata")] for m in metadata)
+        elif os.path.exists(path + ".tune_metadata"):
+            checkpoints.add(path)
+    return sorted(checkpoints, key=checkpoint_sort_key)
+
+
+def checkpoint_sort_key(checkpoint):
+    name = os.path.basename(checkpoint)
+    iteration = name.rsplit("-", 1)[-1]
+    return (os.path.dirname(os.path.dirname(checkpoint)),
+            int(iteration) if iteration.isdigit() else -1)
+
+
+def load_worker_state(checkpoint):
+    """The local worker's saved state (weights and filters) and a hash of
+    the checkpoint files it comes from"""
+    checkpoint_hash = hashlib.sha1()
+    for path in (checkpoint, checkpoint + WEIGHTS_SUFFIX):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                checkpoint_hash.update(f.read())
+    worker_state = checkpoint_worker_state(
+        load_checkpoint(checkpoint, training_state=False))
+    return worker_state, checkpoint_hash.hexdigest()
+
+
+def make_seeded_env(agent, seed):
+    env_config = dict(agent.config["env_config"])
+    # One plain env per episode, not the training's vectorized one
+    env_config.pop("vectorized_num_envs", None)
+    if "start_level" in env_config:
+        # Procgen, the seed is the level
+        env_config.update(start_level=seed, num_levels=1)
+        return agent.env_creator(env_config)
+    env = agent.env_creator(env_config)
+    env.seed(seed)
+    return env
+
+
+@ray.remote(num_cpus=1)
+class EvaluationActor:
+    def __init__(self, run, env, config):
+        self.agent = get_trainable_cls(run)(env=env, config=config)
+        self.checkpoint_hash = None
+
+    def evaluate(self, checkpoint_hash, worker_state, seeds):
+        """Plays one episode per seed, all of them batched together.
+        Returns the (seed, reward, length) of every episode."""
+        if checkpoint_hash != self.checkpoint_hash:
+            restore_worker(self.agent.workers.local_worker(), worker_state)
+            self.checkpoint_hash = checkpoint_hash
+        envs = [make_seeded_env(self.agent, seed) for seed in seeds]
+        obs = [env.reset() for env in envs]
+        active = list(range(len(envs)))
+        action_init = _flatten_action(
+            self.agent.get_policy().action_space.sample())
+        prev_actions = np.stack([action_init] * len(envs))
+        prev_rewards = np.zeros(len(envs))
+        rewards = np.zeros(len(envs))
+        lengths = np.zeros(len(envs), dtype=np.int64)
+        while active:
+            actions = compute_batched_actions(
+                self.agent, [obs[i] for i in active], prev_actions[active],
+                prev_rewards[active])
+            still_active = []
+            for i, action in zip(active, actions):
+                obs[i], reward, done, _ = envs[i].step(action)
+                prev_actions[i] = action
+                prev_rewards[i] = reward
+                rewards[i] += reward
+                lengths[i] += 1
+                if done:
+                    envs[i].close()
+                else:
+                    still_active.append(i)
+            active = still_active
+        return [(int(seed), float(reward), int(length))
+                for seed, reward, length in zip(seeds, rewards, lengths)]
+
+
+def evaluation_key(checkpoint_hash, args, env):
+    settings = json.dumps([checkpoint_hash, args.run, env, args.episodes,
+                           args.seed, args.config], sort_keys=True)
+    return hashlib.sha1(settings.encode()).hexdigest()
+
+
+def summarize(checkpoint, episodes, cached):
+    rewards = np.array([reward for _, reward, _ in episodes])
+    lengths = np.array([length for _, _, length in episodes])
+    return {
+        "checkpoint": checkpoint,
+        "episodes": len(episodes),
+        "reward_mean": float(rewards.mean()),
+        "reward_std": float(rewards.std()),
+        "reward_min": float(rewards.min()),
+        "reward_max": float(rewards.max()),
+        "length_mean": float(lengths.mean()),
+        "cached": cached,
+    }
+
+
+def write_summary(rows, out):
+    if out.endswith(".json"):
+        with open(out, "w") as f:
+            json.dump(rows, f, indent=2)
+        return
+    columns = list(rows[0].keys())
+    with open(out, "w") as f:
+        f.write(",".join(columns) + "\n")
+        for row in rows:
+            f.write(",".join(str(row[c]) for c in columns) + "\n")
+
+
+def print_summary(rows):
+    print("{:>10} {:>10} {:>10} {:>8}  {}".format("reward", "std", "length",
+                                                   "episodes", "checkpoint"))
+    for row in rows:
+        print("{:>10.3f} {:>10.3f} {:>10.1f} {:>8}  {}{}".format(
+            row["reward_mean"], row["reward_std"], row["length_mean"],
+            row["episodes"], row["checkpoint"],
+            " (cached)" if row["cached"] else ""))
+
+
+def run(args, parser):
+    checkpoints = find_checkpoints(args.checkpoints)
+    if not checkpoints:
+        parser.error("no checkpoints found in {}".format(args.checkpoints))
+
+    config = load_rollout_config(checkpoints[0], args.config)
+    env = args.env or config.get("env")
+    if not env:
+        parser.error("the following arguments are required: --env")
+    # Registered before ray.init, so the actors see them too
+    load_experiment_assets({"sweep": {"run": args.run, "env": env,
+                                      "config": config}},
+                           CUSTOM_ALGORITHMS, CUSTOM_PREPROCESSORS, os.getcwd())
+    # The actors only need the local worker to act
+    config.update(num_workers=0, num_gpus=0, evaluation_interval=None)
+
+    cache_dir = os.path.expanduser(args.cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    seeds = list(range(args.seed, args.seed + args.episodes))
+    chunks = [seeds[i:i + args.chunk_size]
+              for i in range(0, len(seeds), args.chunk_size)]
+
+    ray.init()
+    actors = None
+    rows = []
+    for checkpoint in checkpoints:
+        worker_state, checkpoint_hash = load_worker_state(checkpoint)
+        cache_path = os.path.join(
+            cache_dir, evaluation_key(checkpoint_hash, args, env) + ".json")
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                rows.append(summarize(checkpoint, json.load(f), cached=True))
+            continue
+
+        if actors is None:
+            actors = [EvaluationActor.remote(args.run, env, config)
+                      for _ in range(args.num_actors)]
+        worker_state = ray.put(worker_state)
+        # Hand the next chunk to whichever actor finishes first
+        pending = {}
+        for actor, chunk in zip(actors, chunks):
+            pending[actor.evaluate.remote(checkpoint_hash, worker_state,
+                                          chunk)] = actor
+        next_chunk = len(pending)
+        episodes = []
+        while pending:
+            [ready], _ = ray.wait(list(pending))
+            actor = pending.pop(ready)
+            episodes.extend(ray.get(ready))
+            if next_chunk < len(chunks):
+                pending[actor.evaluate.remote(
+                    checkpoint_hash, worker_state, chunks[next_chunk])] = actor
+                next_chunk += 1
+        episodes.sort()
+
+        # Written only once complete, an interrupted sweep redoes this one
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump(episodes, f)
+        os.replace(cache_path + ".tmp", cache_path)
+        rows.append(summarize(checkpoint, episodes, cached=False))
+        print("{}: reward: {:.3f} over {} episodes".format(
+            checkpoint, rows[-1]["reward_mean"], len(episodes)))
+
+    # Best first, in the printed table and the written summary
+    rows.sort(key=lambda row: -row["reward_mean"])
+    print_summary(rows)
+    out = args.out or os.path.join(
+        os.path.commonpath([os.path.dirname(c) for c in checkpoints]),
+        "evaluation_summary.csv")
+    write_summary(rows, out)
+    print("Summary written to {}".format(out))
+
+
+if __name__ == "__main__":
+    parser = create_parser()
+    args = parser.parse_args()
+    run(args, parser)
@@ -0,0 +1,99 @@
+from ray.rllib.models import ModelCatalog
+from ray.rllib.models.torch.torch_modelv2 import TorchModelV2
+from ray.rllib.utils.annotations import override
+from ray.rllib.utils import try_import_torch
+
+from models.impala_ppg import ImpalaCNN
+
+torch, nn = try_import_torch()
+
+
+class FusedImpalaTrunk(nn.Module):
+    """
+    Observation to latent part of ImpalaCNN, on the parameters of the model.
+
+    The uint8 NHWC observation is viewed as channels-last NCHW without a copy, and
+    the /255 scaling and the diff framestack are folded into the first conv weight:
+        conv(W, [a, b, a - b] / 255) = conv([W_a + W_d, W_b - W_d] / 255, [a, b])
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.conv_seqs = model.conv_seqs
+        self.hidden_fc = model.hidden_fc
+        self.use_layernorm = model.use_layernorm
+        if self.use_layernorm:
+            self.layernorm = model.layernorm
+        self.diff_framestack = model.diff_framestack
+
+    def first_conv_weight(self):
+        w = self.conv_seqs[0].conv.weight
+        if self.diff_framestack:
+            w = torch.cat([w[:, :3] + w[:, 6:], w[:, 3:6] - w[:, 6:]], dim=1)
+        return (w * (1 / 255.0)).contiguous(memory_format=torch.channels_last)
+
+    def forward(self, obs):
+        x = obs.permute(0, 3, 1, 2).float()  # NHWC memory is channels-last NCHW
+        for i, conv_seq in enumerate(self.conv_seqs):
+            if i == 0:
+                x = nn.functional.conv2d(x, self.first_conv_weight(), conv_seq.conv.bias, padding=1)
+            else:
+                x = conv_seq.conv(x)
+            x = nn.functional.max_pool2d(x, kernel_size=3, stride=2, padding=1)
+            x = conv_seq.res_block0(x)
+            x = conv_seq.res_block1(x)
+        x = torch.flatten(x, start_dim=1)
+        x = nn.functional.relu(x)
+        x = self.hidden_fc(x)
+        if self.use_layernorm:
+            x = self.layernorm(x)
+            x = torch.tanh(x)
+        else:
+            x = nn.functional.relu(x)
+        return x
+
+
+class FusedImpalaCNN(ImpalaCNN):
+    """
+    Drop-in variant of models/impala_ppg.py ImpalaCNN with the same parameters
+    (checkpoints and weights are interchangeable) and a faster forward:
+    channels-last convs, scaling and diff framestack fused into the first conv,
+    no per-call shape asserts.
+
+    custom_model_config["compile"] can be "trace" (TorchScript) or "compile"
+    (torch.compile, torch >= 2.0). The trunk is compiled on its first call,
+    which is after the policy moved the model to its device.
+    """
+
+    def __init__(self, obs_space, action_space, num_outputs, model_config,
+                 name, device):
+        super().__init__(obs_space, action_space, num_outputs, model_config, name, device)
+        self.compile_mode = model_config['custom_model_config'].get('compile') or "none"
+        assert self.compile_mode in ("none", "trace", "compile"), \
+            "Unknown compile mode {}".format(self.compile_mode)
+        if self.compile_mode == "compile":
+            assert hasattr(torch, "compile"), "torch.compile needs torch >= 2.0"
+        self.to(memory_format=torch.channels_last)
+        # Not registered as submodules, so the state dict matches ImpalaCNN
+        self.__dict__['_trunk'] = FusedImpalaTrunk(self)
+        self.__dict__['_compiled_trunk'] = None
+
+    def _run_trunk(self, obs):
+        if self.compile_mode == "none":
+            return self._trunk(obs)
+        if self._compiled_trunk is None:
+            if self.compile_mode == "trace":
+                self.__dict__['_compiled_trunk'] = torch.jit.trace(self._trunk, obs[:1])
+            else:
+                self.__dict__['_compiled_trunk'] = torch.compile(self._trunk)
+        return self._compiled_trunk(obs)
+
+    @override(TorchModelV2)
+    def forward(self, input_dict, state, seq_lens):
+        x = self._run_trunk(input_dict["obs"])
+        logits = self.pi_fc(x)
+        value = self.value_fc(x.detach())
+        self._value = value.squeeze(1)
+        self._aux_value = self.aux_vf(x).squeeze(1)
+        return logits, state
+
+ModelCatalog.register_custom_model("impala_torch_ppg_fused", FusedImpalaCNN)
@@ -145,7 +145,7 @@ class ImpalaCNN(TorchModelV2, nn.Module):
         logits = self.pi_fc(x)
         value = self.value_fc(x)
         self._value = value.squeeze(1)
-        self._detached_latent = x.detach()
+        self._latent = x
         return logits, state
 
     @override(TorchModelV2)
@@ -8,12 +8,21 @@ import os
 from pathlib import Path
 import pickle
 import shelve
+import sys
+
+from utils.loader import checkpoint_experiment_from_argv, skip_unused_frameworks, load_experiment_assets
+
+if __name__ == "__main__":
+    # Before anything imports ray.rllib, which imports every framework it finds
+    skip_unused_frameworks(checkpoint_experiment_from_argv(sys.argv[1:]))
 
 import gym
 import gym.wrappers
+import numpy as np
 import ray
 from ray.rllib.env import MultiAgentEnv
 from ray.rllib.env.base_env import _DUMMY_AGENT_ID
+from ray.rllib.env.vector_env import VectorEnv
 try:
     from ray.rllib.evaluation.episode import _flatten_action
 except Exception:
@@ -21,12 +30,13 @@ except Exception:
     from ray.rllib.utils.space_utils import flatten_to_single_ndarray as _flatten_action
 
 from ray.rllib.evaluation.worker_set import WorkerSet
+from ray.rllib.policy.policy import clip_action
 from ray.rllib.policy.sample_batch import DEFAULT_POLICY_ID
 from ray.rllib.utils.deprecation import deprecation_warning
 from ray.tune.utils import merge_dicts
 from ray.tune.registry import get_trainable_cls
 
-from utils.loader import load_envs, load_models, load_algorithms, load_preprocessors
+from utils.rollout_recorder import RolloutRecorder
 
 """
 Note : This script has been adapted from :
@@ -43,25 +53,22 @@ python ./rollout.py \
     --episodes 100 
 """
 
-# Register all necessary assets in tune registries
-load_envs(os.getcwd()) # Load envs
-load_models(os.getcwd()) # Load models
-# Load custom algorithms
 from algorithms import CUSTOM_ALGORITHMS
-load_algorithms(CUSTOM_ALGORITHMS)
-# Load custom preprocessors
 from preprocessors import CUSTOM_PREPROCESSORS
-load_preprocessors(CUSTOM_PREPROCESSORS)
 
 
 class RolloutSaver:
     """Utility class for storing rollouts.
 
-    Currently supports two behaviours: the original, which
+    Currently supports three behaviours: the original, which
     simply dumps everything to a pickle file once complete,
-    and a mode which stores each rollout as an entry in a Python
-    shelf db file. The latter mode is more robust to memory problems
-    or crashes part-way through the rollout generation. Each rollout
+    a mode which stores each rollout as an entry in a Python
+    shelf db file, and a columnar mode which streams the steps into
+    compressed chunks on disk (see utils/rollout_recorder.py, read
+    back with RolloutReader). The latter two modes are more robust to
+    memory problems or crashes part-way through the rollout
+    generation; the columnar one also keeps memory bounded within
+    long episodes and stores every observation once. Each rollout
     is stored with a key based on the episode number (0-indexed),
     and the number of episodes is stored with the key "num_episodes",
     so to load the shelf file, use something like:
@@ -79,15 +86,20 @@ class RolloutSaver:
                  write_update_file=False,
                  target_steps=None,
                  target_episodes=None,
-                 save_info=False):
+                 save_info=False,
+                 use_columnar=False):
         self._outfile = outfile
         self._update_file = None
         self._use_shelve = use_shelve
         self._write_update_file = write_update_file
         self._shelf = None
+        self._use_columnar = use_columnar
+        self._recorder = None
+        # Rollouts in progress, one per env index when rolling out batched envs
+        self._episode_writers = {}
         self._num_episodes = 0
         self._rollouts = []
-        self._current_rollout = []
+        self._current_rollouts = {}
         self._total_steps = 0
         self._target_episodes = target_episodes
         self._target_steps = target_steps
@@ -103,7 +115,10 @@ class RolloutSaver:
 
     def __enter__(self):
         if self._outfile:
-            if self._use_shelve:
+            if self._use_columnar:
+                # Stream each rollout into the columnar recording as it comes in
+                self._recorder = RolloutRecorder(self._outfile, save_info=self._save_info)
+            elif self._use_shelve:
                 # Open a shelf file to store each rollout as they come in
                 self._shelf = shelve.open(self._outfile)
             else:
@@ -125,11 +140,14 @@ class RolloutSaver:
         return self
 
     def __exit__(self, type, value, traceback):
-        if self._shelf:
+        if self._recorder:
+            self._recorder.close()
+            self._recorder = None
+        elif self._shelf:
             # Close the shelf file, and store the number of episodes for ease
             self._shelf["num_episodes"] = self._num_episodes
             self._shelf.close()
-        elif self._outfile and not self._use_shelve:
+        elif self._outfile and not self._use_shelve and not self._use_columnar:
             # Dump everything as one big pickle:
             pickle.dump(self._rollouts, open(self._outfile, "wb"))
         if self._update_file:
@@ -147,32 +165,41 @@ class RolloutSaver:
         else:
             return "{} episodes completed".format(self._num_episodes)
 
-    def begin_rollout(self):
-        self._current_rollout = []
+    def begin_rollout(self, env_index=0):
+        self._current_rollouts[env_index] = []
+        if self._recorder:
+            self._episode_writers[env_index] = self._recorder.begin_episode()
 
-    def end_rollout(self):
+    def end_rollout(self, env_index=0):
+        current_rollout = self._current_rollouts.pop(env_index)
         if self._outfile:
-            if self._use_shelve:
+            if self._recorder:
+                # Flush the rest of the episode and add it to the index
+                self._episode_writers.pop(env_index).end()
+            elif self._use_shelve:
                 # Save this episode as a new entry in the shelf database,
                 # using the episode number as the key.
-                self._shelf[str(self._num_episodes)] = self._current_rollout
+                self._shelf[str(self._num_episodes)] = current_rollout
             else:
                 # Append this rollout to our list, to save laer.
-                self._rollouts.append(self._current_rollout)
+                self._rollouts.append(current_rollout)
         self._num_episodes += 1
         if self._update_file:
             self._update_file.seek(0)
             self._update_file.write(self._get_progress() + "\n")
             self._update_file.flush()
 
-    def append_step(self, obs, action, next_obs, reward, done, info):
+    def append_step(self, obs, action, next_obs, reward, done, info,
+                    env_index=0):
         """Add a step to the current rollout, if we are saving them"""
-        if self._outfile:
+        if self._recorder:
+            self._episode_writers[env_index].add_step(obs, action, next_obs, reward, done, info)
+        elif self._outfile:
             if self._save_info:
-                self._current_rollout.append(
+                self._current_rollouts[env_index].append(
                     [obs, action, next_obs, reward, done, info])
             else:
-                self._current_rollout.append(
+                self._current_rollouts[env_index].append(
                     [obs, action, next_obs, reward, done])
         self._total_steps += 1
 
@@ -224,6 +251,14 @@ def create_parser(parser_creator=None):
         "--episodes",
         default=0,
         help="Number of complete episodes to roll out (overrides --steps).")
+    parser.add_argument(
+        "--num-envs",
+        default=1,
+        type=int,
+        help="Number of envs to roll out at once, their observations are "
+        "batched into a single forward pass. Episodes are split evenly "
+        "across the envs. Not supported with --video-dir, LSTM policies or "
+        "multi-agent envs; nothing is rendered.")
     parser.add_argument("--out", default=None, help="Output filename.")
     parser.add_argument(
         "--config",
@@ -244,6 +279,15 @@ def create_parser(parser_creator=None):
         action="store_true",
         help="Save rollouts into a python shelf file (will save each episode "
         "as it is generated). An output filename must be set using --out.")
+    parser.add_argument(
+        "--use-columnar",
+        default=False,
+        action="store_true",
+        help="Stream rollouts into a directory of compressed, columnar "
+        "chunks with an episode index (memory stays bounded and finished "
+        "episodes survive a crash). Read back with "
+        "utils.rollout_recorder.RolloutReader. An output directory must be "
+        "set using --out.")
     parser.add_argument(
         "--track-progress",
         default=False,
@@ -254,10 +298,12 @@ def create_parser(parser_creator=None):
     return parser
 
 
-def run(args, parser):
+def load_rollout_config(checkpoint, cli_config):
+    """The checkpoint's params.pkl merged with its `evaluation_config` and
+    the command line `--config`."""
     config = {}
     # Load configuration from checkpoint file.
-    config_dir = os.path.dirname(args.checkpoint)
+    config_dir = os.path.dirname(checkpoint)
     config_path = os.path.join(config_dir, "params.pkl")
     # Try parent directory.
     if not os.path.exists(config_path):
@@ -265,7 +311,7 @@ def run(args, parser):
 
     # If no pkl file found, require command line `--config`.
     if not os.path.exists(config_path):
-        if not args.config:
+        if not cli_config:
             raise ValueError(
                 "Could not find params.pkl in either the checkpoint dir or "
                 "its parent directory AND no config given on command line!")
@@ -278,16 +324,26 @@ def run(args, parser):
     # Set num_workers to be at least 2.
     if "num_workers" in config:
         config["num_workers"] = min(2, config["num_workers"])
+    # Acting needs no data-parallel learner processes
+    if "num_learners" in config:
+        config["num_learners"] = 1
 
     # Merge with `evaluation_config`.
     evaluation_config = copy.deepcopy(config.get("evaluation_config", {}))
     config = merge_dicts(config, evaluation_config)
     # Merge with command line `--config` settings.
-    config = merge_dicts(config, args.config)
+    return merge_dicts(config, cli_config)
+
+
+def run(args, parser):
+    config = load_rollout_config(args.checkpoint, args.config)
     if not args.env:
         if not config.get("env"):
             parser.error("the following arguments are required: --env")
         args.env = config.get("env")
+    # Register the envs, models, algorithms and preprocessors used
+    load_experiment_assets({"rollout": {"run": args.run, "env": args.env, "config": config}},
+                           CUSTOM_ALGORITHMS, CUSTOM_PREPROCESSORS, os.getcwd())
 
     ray.init()
 
@@ -295,7 +351,11 @@ def run(args, parser):
     cls = get_trainable_cls(args.run)
     agent = cls(env=args.env, config=config)
     # Load state from checkpoint.
-    agent.restore(args.checkpoint)
+    if hasattr(agent, "restore_for_evaluation"):
+        # Skips the optimizer and other training state
+        agent.restore_for_evaluation(args.checkpoint)
+    else:
+        agent.restore(args.checkpoint)
     num_steps = int(args.steps)
     num_episodes = int(args.episodes)
 
@@ -317,9 +377,21 @@ def run(args, parser):
             write_update_file=args.track_progress,
             target_steps=num_steps,
             target_episodes=num_episodes,
-            save_info=args.save_info) as saver:
-        rollout(agent, args.env, num_steps, num_episodes, saver,
-                args.no_render, video_dir)
+            save_info=args.save_info,
+            use_columnar=args.use_columnar) as saver:
+        # Envs of a vectorized training config (vectorized_num_envs) are
+        # VectorEnvs already, that rollout() can't step
+        vectorized = hasattr(agent, "workers") and isinstance(
+            agent.workers.local_worker().env, VectorEnv)
+        if args.num_envs > 1 or vectorized:
+            if video_dir:
+                parser.error("--video-dir is not supported with --num-envs "
+                             "or vectorized envs")
+            rollout_vectorized(agent, args.num_envs, num_steps, num_episodes,
+                               saver)
+        else:
+            rollout(agent, args.env, num_steps, num_episodes, saver,
+                    args.no_render, video_dir)
 
 
 class DefaultMapping(collections.defaultdict):
@@ -460,6 +532,124 @@ def rollout(agent,
             episodes += 1
 
 
+
+def compute_batched_actions(agent, obs, prev_actions, prev_rewards,
+                            policy_id=DEFAULT_POLICY_ID):
+    """Trainer.compute_action for a list of observations, in one forward
+    pass. Returns the list of flattened actions."""
+    worker = agent.workers.local_worker()
+    policy = agent.get_policy(policy_id)
+    preprocessor = worker.preprocessors[policy_id]
+    obs_filter = worker.filters[policy_id]
+    obs_batch = np.stack([
+        obs_filter(preprocessor.transform(o), update=False) for o in obs
+    ])
+    actions, _, _ = policy.compute_actions(
+        obs_batch,
+        prev_action_batch=prev_actions,
+        prev_reward_batch=prev_rewards)
+    if agent.config["clip_actions"]:
+        actions = [clip_action(a, policy.action_space) for a in actions]
+    return [_flatten_action(a) for a in actions]
+
+
+def make_vector_env(agent, num_envs):
+    """num_envs copies of the trainer's env as a VectorEnv"""
+    env_config = dict(agent.config["env_config"])
+    if "vectorized_num_envs" in env_config:
+        # Natively vectorized envs, e.g. procgen_vector_env
+        env_config["vectorized_num_envs"] = num_envs
+    env = agent.env_creator(env_config)
+    if isinstance(env, VectorEnv):
+        return env
+    return VectorEnv.wrap(
+        make_env=lambda vector_index: agent.env_creator(env_config),
+        existing_envs=[env],
+        num_envs=num_envs)
+
+
+def rollout_vectorized(agent, num_envs, num_steps, num_episodes=0,
+                       saver=None):
+    """Same as rollout(), with num_envs envs stepped together and the
+    actions of all of them computed in one batch.
+
+    With num_episodes set every env plays a fixed share of the episodes, so
+    short episodes aren't over-represented by envs that happen to finish
+    first. Episodes still running when num_steps is reached are reported
+    unfinished, like rollout() does."""
+    if saver is None:
+        saver = RolloutSaver()
+
+    worker = agent.workers.local_worker()
+    if worker.multiagent:
+        raise ValueError("--num-envs doesn't support multi-agent envs")
+    policy = agent.get_policy(DEFAULT_POLICY_ID)
+    if policy.get_initial_state():
+        raise ValueError("--num-envs doesn't support recurrent policies")
+
+    env = make_vector_env(agent, num_envs)
+    num_envs = env.num_envs
+    if num_episodes:
+        quotas = np.full(num_envs, num_episodes // num_envs)
+        quotas[:num_episodes % num_envs] += 1
+    else:
+        quotas = np.full(num_envs, np.inf)
+    env_episodes = np.zeros(num_envs, dtype=np.int64)
+
+    action_init = _flatten_action(policy.action_space.sample())
+    obs = list(env.vector_reset())
+    prev_actions = np.stack([action_init] * num_envs)
+    prev_rewards = np.zeros(num_envs)
+    reward_totals = np.zeros(num_envs)
+    episode_steps = np.zeros(num_envs, dtype=np.int64)
+
+    steps = 0
+    episodes = 0
+    while keep_going(steps, num_steps, episodes, num_episodes):
+        actions = compute_batched_actions(agent, obs, prev_actions,
+                                          prev_rewards)
+        next_obs, rewards, dones, infos = env.vector_step(actions)
+        next_obs = list(next_obs)
+        prev_actions = np.stack(actions)
+        prev_rewards = np.asarray(rewards, dtype=np.float64)
+
+        for i in range(num_envs):
+            if env_episodes[i] >= quotas[i]:
+                # This env has played its share
+                continue
+            if episode_steps[i] == 0:
+                saver.begin_rollout(i)
+            saver.append_step(obs[i], actions[i], next_obs[i], rewards[i],
+                              dones[i], infos[i], env_index=i)
+            steps += 1
+            reward_totals[i] += rewards[i]
+            episode_steps[i] += 1
+            if dones[i]:
+                saver.end_rollout(i)
+                print("Episode #{}: reward: {} steps: {}".format(
+                    episodes, reward_totals[i], episode_steps[i]))
+                episodes += 1
+                env_episodes[i] += 1
+                reward_totals[i] = 0.
+                episode_steps[i] = 0
+            if not keep_going(steps, num_steps, episodes, num_episodes):
+                break
+        for i in np.flatnonzero(dones):
+            next_obs[i] = env.reset_at(i)
+            prev_actions[i] = action_init
+            prev_rewards[i] = 0.
+        obs = next_obs
+
+    # Episodes cut off by the step limit, numbered after the finished ones
+    episode_number = episodes
+    for i in range(num_envs):
+        if episode_steps[i]:
+            saver.end_rollout(i)
+            print("Episode #{}: reward: {} steps: {}".format(
+                episode_number, reward_totals[i], episode_steps[i]))
+            episode_number += 1
+
+
 if __name__ == "__main__":
     parser = create_parser()
     args = parser.parse_args()
@@ -472,6 +662,13 @@ if __name__ == "__main__":
         raise ValueError(
             "If you set --use-shelve, you must provide an output file via "
             "--out as well!")
+    # --use-columnar w/o --out option.
+    if args.use_columnar and not args.out:
+        raise ValueError(
+            "If you set --use-columnar, you must provide an output directory "
+            "via --out as well!")
+    if args.use_columnar and args.use_shelve:
+        raise ValueError("--use-columnar and --use-shelve can't be combined!")
     # --track-progress w/o --out option.
     if args.track_progress and not args.out:
         raise ValueError(
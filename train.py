@@ -3,23 +3,23 @@
 import argparse
 import os
 from pathlib import Path
+import sys
 import yaml
 
+from utils.loader import experiments_from_argv, skip_unused_frameworks, load_experiment_assets
+
+# Before anything imports ray.rllib, which imports every framework it finds
+skip_unused_frameworks(experiments_from_argv(sys.argv[1:]))
+
 import ray
 from ray.cluster_utils import Cluster
 from ray.tune.config_parser import make_parser
 from ray.tune.result import DEFAULT_RESULTS_DIR
 from ray.tune.resources import resources_to_json
 from ray.tune.tune import _make_scheduler, run_experiments
-from ray.rllib.utils.framework import try_import_tf, try_import_torch
 
-from utils.loader import load_envs, load_models, load_algorithms, load_preprocessors
 from callbacks import CustomCallbacks
 
-# Try to import both backends for flag checking/warnings.
-tf = try_import_tf()
-torch, _ = try_import_torch()
-
 """
 Note : This script has been adapted from :
     https://github.com/ray-project/ray/blob/master/rllib/train.py
@@ -36,15 +36,8 @@ Training with Config:
 Note that -f overrides all other trial-specific command-line options.
 """
 
-# Register all necessary assets in tune registries
-load_envs(os.getcwd()) # Load envs
-load_models(os.getcwd()) # Load models
-# Load custom algorithms
 from algorithms import CUSTOM_ALGORITHMS
-load_algorithms(CUSTOM_ALGORITHMS)
-# Load custom preprocessors
 from preprocessors import CUSTOM_PREPROCESSORS
-load_preprocessors(CUSTOM_PREPROCESSORS)
 
 print(ray.rllib.contrib.registry.CONTRIBUTED_ALGORITHMS)
 
@@ -206,6 +199,9 @@ def run(args, parser):
         ### Add Custom Callbacks
         exp["config"]["callbacks"] = CustomCallbacks
 
+    # Register the envs, models, algorithms and preprocessors the experiments use
+    load_experiment_assets(experiments, CUSTOM_ALGORITHMS, CUSTOM_PREPROCESSORS, os.getcwd())
+
     if args.ray_num_nodes:
         cluster = Cluster()
         for _ in range(args.ray_num_nodes):
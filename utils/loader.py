@@ -1,6 +1,9 @@
 #!/usr/bin/env python
+import argparse
 import os
 import glob
+import json
+import re
 
 import types
 import importlib.machinery
@@ -103,3 +106,149 @@ def load_preprocessors(CUSTOM_PREPROCESSORS):
 
     for _precessor_name, _processor_class in CUSTOM_PREPROCESSORS.items():
         ModelCatalog.register_custom_preprocessor(_precessor_name, _processor_class)
+
+
+"""
+Lazy loading of only what an experiment uses
+
+load_envs and load_models source every file in envs/ and models/, which
+imports both frameworks, keras, skimage, ... for every experiment. Instead,
+build_manifest maps the names registered in those files to the file that
+registers them, found in the sources without importing anything, and
+load_experiment_assets only sources the files (and imports the algorithms
+and preprocessors) the experiment specs refer to.
+
+RLlib imports TF and Torch wherever it finds them, unless the
+RLLIB_TEST_NO_TF_IMPORT / RLLIB_TEST_NO_TORCH_IMPORT variables are set.
+skip_unused_frameworks sets the one for the framework no experiment uses.
+It has to run before anything imports ray.rllib, and the ray workers
+started afterwards inherit it.
+"""
+
+_REGISTRATIONS = {
+    "envs": re.compile(r"register_env\(\s*[\"']([^\"']+)[\"']"),
+    "models": re.compile(r"register_custom_model\(\s*[\"']([^\"']+)[\"']"),
+}
+
+
+def build_manifest(local_dir="."):
+    """
+    {"envs": {name: file}, "models": {name: file}} for the names registered
+    in the files of the `envs` and `models` folders
+    """
+    manifest = {}
+    for kind, pattern in _REGISTRATIONS.items():
+        manifest[kind] = {}
+        for _file_path in sorted(glob.glob(os.path.join(local_dir, kind, "*.py"))):
+            with open(_file_path) as f:
+                for name in pattern.findall(f.read()):
+                    manifest[kind][name] = _file_path
+    return manifest
+
+
+def experiment_framework(config):
+    if config.get("framework") in ("torch", "tf"):
+        return config["framework"]
+    return "torch" if config.get("use_pytorch") else "tf"
+
+
+def experiment_assets(experiments):
+    """
+    Names of the envs, models, algorithms and preprocessors, and the
+    frameworks, used by a dict of tune experiment specs
+    """
+    assets = {"envs": set(), "models": set(), "algorithms": set(),
+              "preprocessors": set(), "frameworks": set()}
+    for spec in experiments.values():
+        config = spec.get("config", {})
+        model = config.get("model", {})
+        for env in (spec.get("env"), config.get("env")):
+            if env:
+                assets["envs"].add(env)
+        if model.get("custom_model"):
+            assets["models"].add(model["custom_model"])
+        if model.get("custom_preprocessor"):
+            assets["preprocessors"].add(model["custom_preprocessor"])
+        if spec.get("run"):
+            assets["algorithms"].add(spec["run"])
+        assets["frameworks"].add(experiment_framework(config))
+    return assets
+
+
+def load_experiment_assets(experiments, CUSTOM_ALGORITHMS, CUSTOM_PREPROCESSORS, local_dir="."):
+    """
+    Registers the custom envs, models, algorithms and preprocessors the
+    experiments refer to, and nothing else. Names that aren't in this
+    repository (gym envs, RLlib's algorithms) are left to ray.
+    """
+    assets = experiment_assets(experiments)
+    manifest = build_manifest(local_dir)
+    _file_paths = []
+    for kind in ("envs", "models"):
+        for name in sorted(assets[kind]):
+            _file_path = manifest[kind].get(name)
+            if _file_path and _file_path not in _file_paths:
+                _file_paths.append(_file_path)
+    for _file_path in _file_paths:
+        _source_file(_file_path)
+    load_algorithms({name: CUSTOM_ALGORITHMS[name] for name in assets["algorithms"]
+                     if name in CUSTOM_ALGORITHMS})
+    load_preprocessors({name: CUSTOM_PREPROCESSORS[name] for name in assets["preprocessors"]
+                        if name in CUSTOM_PREPROCESSORS})
+    return assets
+
+
+def skip_unused_frameworks(experiments):
+    """ Keeps RLlib from importing the framework none of the experiments use """
+    frameworks = experiment_assets(experiments)["frameworks"] if experiments else set()
+    if frameworks == {"torch"}:
+        os.environ.setdefault("RLLIB_TEST_NO_TF_IMPORT", "1")
+    elif frameworks == {"tf"}:
+        os.environ.setdefault("RLLIB_TEST_NO_TORCH_IMPORT", "1")
+    return frameworks
+
+
+def experiments_from_argv(argv):
+    """ The experiments of `train.py -f <file>`, read before ray is imported, {} without -f """
+    import yaml
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-f", "--config-file", default=None)
+    args, _ = parser.parse_known_args(argv)
+    if not args.config_file:
+        return {}
+    with open(args.config_file) as f:
+        return yaml.safe_load(f)
+
+
+def checkpoint_experiment(checkpoint, run=None, env=None, config=None):
+    """
+    The experiment a checkpoint was trained with, as a spec of
+    experiment_assets, from the params.json tune writes next to params.pkl
+    (which can't be unpickled without importing ray)
+    """
+    params = None
+    config_dir = os.path.dirname(checkpoint)
+    for params_path in (os.path.join(config_dir, "params.json"),
+                        os.path.join(config_dir, "../params.json")):
+        if os.path.exists(params_path):
+            with open(params_path) as f:
+                params = json.load(f)
+            break
+    if params is None:
+        return {}
+    params.update(config or {})
+    return {"checkpoint": {"run": run, "env": env or params.get("env"), "config": params}}
+
+
+def checkpoint_experiment_from_argv(argv):
+    """ checkpoint_experiment for `rollout.py <checkpoint> ...`, read before ray is imported """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("checkpoint", nargs="?", default=None)
+    parser.add_argument("--run", default=None)
+    parser.add_argument("--env", default=None)
+    parser.add_argument("--config", default="{}", type=json.loads)
+    args, _ = parser.parse_known_args(argv)
+    if not args.checkpoint:
+        return {}
+    return checkpoint_experiment(args.checkpoint, args.run, args.env, args.config)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+import json
+import mmap
+import os
+import pickle
+import zlib
+
+import numpy as np
+
+"""
+Streaming, columnar storage for evaluation rollouts
+
+A recording is a directory with two append-only files:
+- data.bin    compressed chunks of columns, written as the steps come in
+- index.jsonl one line per finished episode, with the offsets of its chunks
+
+Each episode stores the columns obs (episode length + 1 entries, so every
+observation is stored once: next_obs[t] is obs[t + 1]), actions, rewards,
+dones and optionally infos. Values that don't fit in a numpy array (dicts,
+multi-agent observations, infos) are pickled instead.
+
+An episode only exists once its index line is written, which happens after
+its chunks are flushed. A crash part-way through loses the episodes in
+flight and leaves some unreferenced bytes at the end of data.bin, nothing
+else. Opening an existing recording again appends to it.
+
+Reading back:
+
+    reader = RolloutReader("rollouts")
+    for episode_index in range(len(reader)):
+        episode = reader[episode_index]  # dict of column -> array
+"""
+
+DATA_FILE = "data.bin"
+INDEX_FILE = "index.jsonl"
+COMPRESSIONS = ("zlib", "none")
+PICKLED = "pickle"
+
+
+class EpisodeWriter:
+    """ Buffers the steps of one episode and flushes them in chunks of `chunk_steps` """
+    def __init__(self, recorder, save_info):
+        self._recorder = recorder
+        self._save_info = save_info
+        self._buffers = {"obs": [], "actions": [], "rewards": [], "dones": []}
+        if save_info:
+            self._buffers["infos"] = []
+        self._chunks = {name: [] for name in self._buffers}
+        self._columns = {}
+        self.steps = 0
+        self.reward = 0.
+
+    def add_step(self, obs, action, next_obs, reward, done, info=None):
+        if self.steps == 0:
+            self._add("obs", obs)
+        self._add("obs", next_obs)
+        self._add("actions", action)
+        self._add("rewards", reward)
+        self._add("dones", done)
+        if self._save_info:
+            self._add("infos", info)
+        self.steps += 1
+        if np.isscalar(reward):
+            self.reward += float(reward)
+
+    def _add(self, name, value):
+        buffer = self._buffers[name]
+        buffer.append(value)
+        if len(buffer) >= self._recorder.chunk_steps:
+            self._flush(name)
+
+    def _flush(self, name):
+        buffer = self._buffers[name]
+        if not buffer:
+            return
+        column, payload = _encode_column(buffer)
+        if name not in self._columns:
+            self._columns[name] = column
+        elif self._columns[name] != column:
+            # e.g. ints in the first chunk and floats in a later one
+            raise ValueError("Column {} changed from {} to {}".format(name, self._columns[name], column))
+        offset, nbytes = self._recorder._write(payload)
+        self._chunks[name].append([offset, nbytes, len(buffer)])
+        self._buffers[name] = []
+
+    def end(self, **metadata):
+        """ Flush the rest of the episode and add it to the index, returns its episode index """
+        for name in self._buffers:
+            self._flush(name)
+        entry = {"steps": self.steps, "reward": self.reward, "columns": {}}
+        for name, chunks in self._chunks.items():
+            if chunks:
+                entry["columns"][name] = dict(self._columns[name], chunks=chunks)
+        entry.update(metadata)
+        return self._recorder._add_to_index(entry)
+
+
+class RolloutRecorder:
+    def __init__(self, path, compression="zlib", level=1, chunk_steps=256, save_info=False):
+        assert compression in COMPRESSIONS, "Unknown compression {}".format(compression)
+        self.path = path
+        self.compression = compression
+        self.level = level
+        self.chunk_steps = chunk_steps
+        self.save_info = save_info
+        os.makedirs(path, exist_ok=True)
+        self.num_episodes = _repair_index(os.path.join(path, INDEX_FILE))
+        self._data = open(os.path.join(path, DATA_FILE), "ab")
+        self._index = open(os.path.join(path, INDEX_FILE), "a")
+
+    def begin_episode(self):
+        return EpisodeWriter(self, self.save_info)
+
+    def _write(self, payload):
+        if self.compression == "zlib":
+            payload = zlib.compress(payload, self.level)
+        offset = self._data.tell()
+        self._data.write(payload)
+        return offset, len(payload)
+
+    def _add_to_index(self, entry):
+        entry = dict(entry, episode=self.num_episodes, compression=self.compression)
+        # The chunks have to be on disk before the index line points at them
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._index.write(json.dumps(entry) + "\n")
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self.num_episodes += 1
+        return entry["episode"]
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class RolloutReader:
+    """
+    Episodes of a recording, with data.bin memory mapped
+
+    Chunks are read (and decompressed) from the mapping only when their
+    episode is accessed. Uncompressed single chunk columns are returned as
+    read-only views of the mapping without any copy.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.episodes = _read_index(os.path.join(path, INDEX_FILE))
+        self._file = open(os.path.join(path, DATA_FILE), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def __getitem__(self, episode_index):
+        entry = self.episodes[episode_index]
+        return {name: self._read_column(entry, name) for name in entry["columns"]}
+
+    def __iter__(self):
+        for episode_index in range(len(self)):
+            yield self[episode_index]
+
+    def column(self, episode_index, name):
+        return self._read_column(self.episodes[episode_index], name)
+
+    def steps(self, episode_index):
+        """ The episode as [obs, action, next_obs, reward, done(, info)] lists, like the pickle output """
+        episode = self[episode_index]
+        obs = episode["obs"]
+        columns = [obs[:-1], episode["actions"], obs[1:], episode["rewards"], episode["dones"]]
+        if "infos" in episode:
+            columns.append(episode["infos"])
+        return [list(step) for step in zip(*columns)]
+
+    def _read_column(self, entry, name):
+        column = entry["columns"][name]
+        parts = []
+        for offset, nbytes, count in column["chunks"]:
+            raw = memoryview(self._map)[offset:offset + nbytes]
+            if entry["compression"] == "zlib":
+                raw = zlib.decompress(raw)
+            parts.append(_decode_chunk(raw, column, count))
+        if column["dtype"] == PICKLED:
+            return [value for part in parts for value in part]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass # Arrays returned without a copy still use it, unmapped once they're gone
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _encode_column(values):
+    try:
+        arr = np.asarray(values)
+    except ValueError:
+        arr = None
+    if arr is None or arr.dtype == object:
+        return {"dtype": PICKLED}, pickle.dumps(list(values), protocol=pickle.HIGHEST_PROTOCOL)
+    arr = np.ascontiguousarray(arr)
+    return {"dtype": arr.dtype.str, "shape": list(arr.shape[1:])}, arr.tobytes()
+
+
+def _decode_chunk(raw, column, count):
+    if column["dtype"] == PICKLED:
+        return pickle.loads(raw)
+    return np.frombuffer(raw, dtype=np.dtype(column["dtype"])).reshape(count, *column["shape"])
+
+
+def _read_index(index_path):
+    episodes = []
+    if not os.path.exists(index_path):
+        return episodes
+    with open(index_path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break # Torn write of the last line
+            episodes.append(json.loads(line))
+    return episodes
+
+
+def _repair_index(index_path):
+    """ Drops a torn last line left by a crash, returns the number of episodes """
+    if not os.path.exists(index_path):
+        return 0
+    with open(index_path, "rb+") as f:
+        content = f.read()
+        end = content.rfind(b"\n") + 1
+        if end != len(content):
+            f.truncate(end)
+    return content[:end].count(b"\n")